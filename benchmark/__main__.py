@@ -0,0 +1,132 @@
+"""
+Benchmarks the payment, refund and cancellation endpoints against local stand-ins for the upstream services.
+
+    python -m benchmark --accounts 10000 --concurrency 16 --duration 30 --latency 0.05
+
+Starts the currency service and PNS stand-ins, seeds a SQLite database, serves the API with benchmark.settings
+and drives it at the requested concurrency, then reports throughput and p50/p95/p99 latency.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmark.load import runLoad, formatSummary, ENDPOINTS
+from benchmark.stubs import StubServer
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+
+def parseMix(value):
+    # e.g. "payment=8,refund=1,cancellation=1"
+    mix = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError('Unknown endpoint "{}"'.format(name))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def waitForPort(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("API server did not start listening on port {}".format(port))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="benchmark an API that is already running instead of starting one")
+    parser.add_argument("--db", help="SQLite file to seed, defaults to a temporary file")
+    parser.add_argument("--no-seed", action="store_true", help="reuse the database given by --db as it is")
+    parser.add_argument("--accounts", type=int, default=1000, help="personal accounts to seed")
+    parser.add_argument("--businesses", type=int, default=10, help="business accounts to seed")
+    parser.add_argument("--transactions", type=int, default=1000, help="completed transactions to seed")
+    parser.add_argument("--replicas", type=int, default=0,
+                        help="copies of the seeded database to serve account lookups from as read replicas")
+    parser.add_argument("--mix", type=parseMix, default={"payment": 1.0},
+                        help="endpoints and their weights, e.g. payment=8,refund=1,cancellation=1")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at once")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to run for")
+    parser.add_argument("--requests", type=int, help="stop after this many requests instead of after --duration")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the stand-ins take to respond")
+    parser.add_argument("--jitter", type=float, default=0.0, help="most seconds added to or taken from latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of stand-in responses that fail")
+    parser.add_argument("--stub-port", type=int, default=0, help="port for the stand-ins, defaults to a free one")
+    parser.add_argument("--seed", type=int, default=0, help="seeds the data, the load and the stand-ins")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    stubs = StubServer(("127.0.0.1", args.stub_port), args.latency, args.jitter, args.error_rate, args.seed)
+    stubs.start()
+
+    database = args.db or os.path.join(tempfile.mkdtemp(prefix="cw2-benchmark-"), "benchmark.sqlite3")
+    os.environ["BENCHMARK_DB"] = database
+    os.environ["BENCHMARK_CURRENCY_URL"] = stubs.url + "currency/"
+    os.environ["BENCHMARK_PNS_URL"] = stubs.url + "pns/"
+    os.environ["DJANGO_SETTINGS_MODULE"] = "benchmark.settings"
+
+    if not args.no_seed:
+        import django
+        django.setup()
+        from benchmark.seed import seed
+
+        start = time.perf_counter()
+        seed(args.accounts, args.businesses, args.transactions, seedValue=args.seed)
+        print("Seeded {} in {:.1f}s".format(database, time.perf_counter() - start))
+
+    # replicas are copies taken after seeding, the API only writes accounts through the primary
+    replicas = []
+    for index in range(args.replicas):
+        replicas.append("{}.replica{}".format(database, index + 1))
+        shutil.copyfile(database, replicas[-1])
+    os.environ["BENCHMARK_REPLICAS"] = os.pathsep.join(replicas)
+
+    server = None
+    url = args.url
+    if url is None:
+        port = freePort()
+        server = subprocess.Popen([sys.executable, str(BASE_DIR / "manage.py"), "runserver", "--noreload",
+                                   "127.0.0.1:{}".format(port)], env=os.environ.copy(),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = "http://127.0.0.1:{}/".format(port)
+    try:
+        if server is not None:
+            waitForPort(port, 30)
+        print("Driving {} at concurrency {} (stand-ins at {})".format(url, args.concurrency, stubs.url))
+        result = runLoad(url, args.mix, args.concurrency, duration=None if args.requests else args.duration,
+                         total=args.requests, accounts=args.accounts, businesses=args.businesses,
+                         transactions=args.transactions, seedValue=args.seed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        stubs.shutdown()
+
+    summary = result.summary()
+    print(formatSummary(summary))
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(dict(summary, arguments=vars(args)), output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
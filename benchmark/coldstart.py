@@ -0,0 +1,139 @@
+"""
+Measures how long a fresh worker takes to answer its first request, and the time each later request spends outside
+the view in middleware, URL resolution and response handling, for each settings profile.
+
+    python -m benchmark.coldstart --runs 10 --requests 2000
+
+Each run starts a new interpreter that loads the profile's WSGI entry point and calls it directly, so no server
+or database is involved. Requests go to /metrics, which every profile serves without touching the database.
+"""
+
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# the settings profile each WSGI entry point loads
+PROFILES = {"full": "cw2.wsgi", "api": "cw2.api_wsgi"}
+
+PATH = "/metrics"
+
+
+def makeEnviron():
+    return {"REQUEST_METHOD": "GET", "PATH_INFO": PATH, "SCRIPT_NAME": "", "QUERY_STRING": "",
+            "SERVER_NAME": "127.0.0.1", "SERVER_PORT": "80", "SERVER_PROTOCOL": "HTTP/1.1",
+            "HTTP_HOST": "127.0.0.1", "REMOTE_ADDR": "127.0.0.1", "wsgi.input": io.BytesIO(),
+            "wsgi.errors": sys.stderr, "wsgi.url_scheme": "http", "wsgi.multithread": False,
+            "wsgi.multiprocess": True, "wsgi.run_once": False, "wsgi.version": (1, 0)}
+
+
+def call(application):
+    response = application(makeEnviron(), lambda status, headers, excInfo=None: None)
+    try:
+        b"".join(response)
+    finally:
+        response.close()
+
+
+def measure(entryPoint, requests):
+    """
+    Runs in the child interpreter.
+
+    :param entryPoint: the WSGI module to load
+    :param requests: the requests to time after the first
+    :return: seconds to load the entry point and to answer the first request, and mean seconds per request
+        through the application and through the view alone
+    """
+    import importlib
+
+    started = time.perf_counter()
+    application = importlib.import_module(entryPoint).application
+    loaded = time.perf_counter()
+    call(application)
+    first = time.perf_counter()
+
+    handled = time.perf_counter()
+    for _ in range(requests):
+        call(application)
+    handled = (time.perf_counter() - handled) / requests
+
+    from django.core.handlers.wsgi import WSGIRequest
+    from django.urls import resolve
+    view = resolve(PATH).func
+    viewOnly = time.perf_counter()
+    for _ in range(requests):
+        view(WSGIRequest(makeEnviron()))
+    viewOnly = (time.perf_counter() - viewOnly) / requests
+
+    return {"load": loaded - started, "first": first - loaded, "request": handled, "view": viewOnly}
+
+
+def runChild(entryPoint, requests):
+    """
+
+    :param entryPoint: the WSGI module to load
+    :param requests: the requests to time after the first
+    :return: the child's measurements
+    """
+    env = os.environ.copy()
+    # the entry point picks its own settings
+    env.pop("DJANGO_SETTINGS_MODULE", None)
+    output = subprocess.run([sys.executable, "-m", "benchmark.coldstart", "--child", entryPoint,
+                             "--requests", str(requests)], cwd=BASE_DIR, env=env, check=True,
+                            stdout=subprocess.PIPE).stdout
+    return json.loads(output)
+
+
+def formatResults(results):
+    """
+
+    :param results: the measurements of each run, by profile
+    :return: a table of the median of each measurement for printing
+    """
+    lines = ["{:<8}{:>12}{:>12}{:>12}{:>14}{:>14}".format("profile", "load ms", "first ms", "cold ms",
+                                                         "request us", "overhead us")]
+    for name, runs in results.items():
+        median = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        lines.append("{:<8}{:>12.1f}{:>12.1f}{:>12.1f}{:>14.1f}{:>14.1f}".format(
+            name, median["load"] * 1000, median["first"] * 1000, (median["load"] + median["first"]) * 1000,
+            median["request"] * 1e6, (median["request"] - median["view"]) * 1e6))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", choices=PROFILES, default=list(PROFILES),
+                        help="settings profiles to compare")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters started per profile")
+    parser.add_argument("--requests", type=int, default=1000, help="requests timed in each run after the first")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--json", help="also write every run's results to this file")
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child, args.requests)))
+        return
+
+    # runs of each profile are interleaved so that a change in machine load affects both alike
+    results = {name: [] for name in args.profiles}
+    for _ in range(args.runs):
+        for name in args.profiles:
+            results[name].append(runChild(PROFILES[name], args.requests))
+
+    print(formatResults(results))
+    print("load is importing the entry point, first is answering the first request, cold is both, overhead is "
+          "the time per request spent outside the view")
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(dict(results=results, arguments=vars(args)), output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+from cw2.seed_data import BUSINESS_OFFSET, EXPIRY, cardNumber, cvv, sortCode, personName, personEmail, \
+    businessName
+
+# every seeded transaction is a payment of this much
+SEEDED_AMOUNT = 10.0
+SEEDED_CURRENCY = "EUR"
+
+
+def paymentBody(payer, payee, amount=10.0, payerCurrency="GBP", payeeCurrency="EUR"):
+    """
+
+    :param payer: the index of a seeded personal account
+    :param payee: the index of a seeded business account
+    :return: an InitiatePayment body that passes validation and lookups against the seeded database
+    """
+    return {"CardNumber": cardNumber(payer),
+            "CVV": cvv(payer),
+            "Expiry": EXPIRY.date().isoformat(),
+            "CardHolderName": personName(payer),
+            "CardHolderAddress": "1 Benchmark Road",
+            "Email": personEmail(payer),
+            "PayeeBankAccNum": str(BUSINESS_OFFSET + payee),
+            "PayeeBankSortCode": sortCode(BUSINESS_OFFSET + payee),
+            "RecipientName": businessName(payee),
+            "Amount": amount,
+            "PayerCurrencyCode": payerCurrency,
+            "PayeeCurrencyCode": payeeCurrency
+            }
+
+
+def refundBody(transactionId):
+    """
+
+    :param transactionId: the ID of a seeded transaction
+    :return: an InitiateRefund body for half the seeded amount, which still fits once the converter has applied a
+    rate of up to 2
+    """
+    return {"TransactionUUID": str(transactionId), "Amount": SEEDED_AMOUNT / 2, "CurrencyCode": SEEDED_CURRENCY}
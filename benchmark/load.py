@@ -0,0 +1,167 @@
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter
+
+import requests
+
+from benchmark.data import paymentBody, refundBody
+
+ENDPOINTS = {
+    "payment": "initiatepayment/",
+    "refund": "initiaterefund/",
+    "cancellation": "initiatecancellation/",
+}
+
+
+class LoadResult:
+    """
+    Latencies and outcomes collected from one load run.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.outcomes = {}
+        self.lock = threading.Lock()
+        self.started = None
+        self.finished = None
+
+    def record(self, endpoint, latency, outcome):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(latency)
+            self.outcomes.setdefault(endpoint, Counter())[outcome] += 1
+
+    def summary(self):
+        """
+
+        :return: throughput and latency percentiles, overall and per endpoint
+        """
+        elapsed = self.finished - self.started
+        summary = {"elapsed": elapsed, "endpoints": {}}
+        everything = []
+        for endpoint, latencies in sorted(self.latencies.items()):
+            everything.extend(latencies)
+            summary["endpoints"][endpoint] = dict(describe(latencies, elapsed),
+                                                  outcomes=dict(self.outcomes[endpoint]))
+        summary["total"] = describe(everything, elapsed)
+        return summary
+
+
+def percentile(ordered, fraction):
+    # nearest rank on an already sorted list
+    if not ordered:
+        return None
+    return ordered[max(int(math.ceil(fraction * len(ordered))) - 1, 0)]
+
+
+def describe(latencies, elapsed):
+    ordered = sorted(latencies)
+    return {"requests": len(ordered),
+            "throughput": len(ordered) / elapsed if elapsed else 0.0,
+            "p50": percentile(ordered, 0.50),
+            "p95": percentile(ordered, 0.95),
+            "p99": percentile(ordered, 0.99),
+            "max": ordered[-1] if ordered else None}
+
+
+def outcomeOf(response):
+    # the API's own error code says more than the HTTP status
+    try:
+        errorCode = response.json().get("ErrorCode")
+    except ValueError:
+        errorCode = None
+    if errorCode is None:
+        return str(response.status_code)
+    return "{} ({})".format(response.status_code, errorCode)
+
+
+def runLoad(baseUrl, mix, concurrency, duration=None, total=None, accounts=1, businesses=1, transactions=0,
+            seedValue=0, timeout=30):
+    """
+    Sends requests from concurrency threads until duration seconds have passed or total requests have been sent.
+
+    :param baseUrl: where the API is served, e.g. http://127.0.0.1:8000/
+    :param mix: a dict of endpoint name to its relative weight
+    :param accounts: the number of seeded personal accounts payments are made from
+    :param businesses: the number of seeded business accounts payments are made to
+    :param transactions: the number of seeded transactions available to refund or cancel
+    :return: the LoadResult of the run
+    """
+    result = LoadResult()
+    endpoints = list(mix)
+    weights = [mix[endpoint] for endpoint in endpoints]
+    # each seeded transaction is refunded or cancelled at most once
+    transactionIds = itertools.count(1)
+    sent = itertools.count()
+    idsLock = threading.Lock()
+
+    def nextTransactionId():
+        with idsLock:
+            transactionId = next(transactionIds)
+        return transactionId if transactionId <= transactions else None
+
+    def worker(number):
+        generator = random.Random(seedValue * 1000003 + number)
+        session = requests.Session()
+        while True:
+            if total is not None and next(sent) >= total:
+                return
+            if duration is not None and time.perf_counter() - result.started >= duration:
+                return
+            endpoint = generator.choices(endpoints, weights)[0]
+            if endpoint == "payment":
+                body = paymentBody(generator.randrange(accounts), generator.randrange(businesses),
+                                   amount=float(generator.randint(100, 10000)) / 100)
+            else:
+                transactionId = nextTransactionId()
+                if transactionId is None:
+                    # nothing left to refund or cancel, so send payments instead
+                    endpoint = "payment"
+                    body = paymentBody(generator.randrange(accounts), generator.randrange(businesses))
+                elif endpoint == "refund":
+                    body = refundBody(transactionId)
+                else:
+                    body = {"TransactionUUID": str(transactionId)}
+            start = time.perf_counter()
+            try:
+                response = session.post(baseUrl.rstrip("/") + "/" + ENDPOINTS[endpoint], data=json.dumps(body),
+                                        timeout=timeout)
+                outcome = outcomeOf(response)
+            except requests.RequestException as e:
+                outcome = type(e).__name__
+            result.record(endpoint, time.perf_counter() - start, outcome)
+
+    threads = [threading.Thread(target=worker, args=(number,), daemon=True) for number in range(concurrency)]
+    result.started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    result.finished = time.perf_counter()
+    return result
+
+
+def formatSummary(summary):
+    """
+
+    :param summary: the summary of a LoadResult
+    :return: a table of the summary for printing
+    """
+
+    def milliseconds(value):
+        return "-" if value is None else "{:.1f}".format(value * 1000)
+
+    lines = ["{:<14}{:>10}{:>12}{:>10}{:>10}{:>10}{:>10}".format("endpoint", "requests", "req/s", "p50 ms",
+                                                                 "p95 ms", "p99 ms", "max ms")]
+    rows = list(summary["endpoints"].items()) + [("total", summary["total"])]
+    for name, stats in rows:
+        lines.append("{:<14}{:>10}{:>12.1f}{:>10}{:>10}{:>10}{:>10}".format(
+            name, stats["requests"], stats["throughput"], milliseconds(stats["p50"]), milliseconds(stats["p95"]),
+            milliseconds(stats["p99"]), milliseconds(stats["max"])))
+    for name, stats in summary["endpoints"].items():
+        outcomes = ", ".join("{}: {}".format(outcome, count) for outcome, count in sorted(stats["outcomes"].items()))
+        lines.append("{} outcomes: {}".format(name, outcomes))
+    return "\n".join(lines)
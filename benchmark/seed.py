@@ -0,0 +1,53 @@
+import random
+from datetime import datetime, timezone
+
+from django.core.management import call_command
+from django.db import transaction
+
+from benchmark.data import SEEDED_AMOUNT, SEEDED_CURRENCY
+from cw2.seed_data import BUSINESS_OFFSET, EXPIRY, cardNumber, cvv, sortCode, personName, personEmail, businessName
+from cw2.models import Transaction, PersonalAccount, BusinessAccount, PaymentDetails, BankDetails, cardFingerprint
+
+
+def seed(accounts, businesses, transactions, batchSize=5000, seedValue=0):
+    """
+    Creates the tables and fills them with accounts that paymentBody can pay between, plus completed transactions
+    numbered 1 to transactions for the refund and cancellation endpoints.
+
+    :param accounts: the number of personal accounts
+    :param businesses: the number of business accounts
+    :param transactions: the number of completed transactions
+    :param batchSize: rows per bulk insert
+    :param seedValue: seeds the choice of payer and payee for each transaction
+    """
+    call_command("migrate", run_syncdb=True, verbosity=0)
+    generator = random.Random(seedValue)
+
+    def insert(model, rows):
+        model.objects.bulk_create(rows, batch_size=batchSize)
+
+    with transaction.atomic():
+        insert(PaymentDetails, [PaymentDetails(paymentId=index, cardNumber=cardNumber(index), securityCode=cvv(index),
+                                               expiryDate=EXPIRY, cardFingerprint=cardFingerprint(cardNumber(index)))
+                                for index in list(range(accounts)) +
+                                list(range(BUSINESS_OFFSET, BUSINESS_OFFSET + businesses))])
+        insert(BankDetails, [BankDetails(accountNumber=index, sortCode=sortCode(index), accountName=personName(index))
+                             for index in range(accounts)])
+        insert(BankDetails, [BankDetails(accountNumber=BUSINESS_OFFSET + index, sortCode=sortCode(BUSINESS_OFFSET + index),
+                                         accountName=businessName(index))
+                             for index in range(businesses)])
+        insert(PersonalAccount, [PersonalAccount(accountNumber=index, paymentDetails_id=index, bankDetails_id=index,
+                                                 email=personEmail(index), password="", phoneNumber="",
+                                                 fullName=personName(index))
+                                 for index in range(accounts)])
+        insert(BusinessAccount, [BusinessAccount(accountNumber=BUSINESS_OFFSET + index,
+                                                 paymentDetails_id=BUSINESS_OFFSET + index,
+                                                 bankDetails_id=BUSINESS_OFFSET + index, businessNumber=index,
+                                                 businessName=businessName(index), businessEmail="", businessPhoneNumber="")
+                                 for index in range(businesses)])
+        now = datetime.now(timezone.utc)
+        insert(Transaction, [Transaction(id=index, payer_id=generator.randrange(accounts),
+                                         payee_id=BUSINESS_OFFSET + generator.randrange(businesses),
+                                         amount=SEEDED_AMOUNT, currency=SEEDED_CURRENCY, date=now,
+                                         transactionStatus="Complete")
+                             for index in range(1, transactions + 1)])
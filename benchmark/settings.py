@@ -0,0 +1,36 @@
+"""
+Django settings for running cw2 under the benchmark harness.
+
+Uses the project settings with the database, its read replicas and upstream services swapped for local
+stand-ins, which benchmark/__main__.py passes in through the environment.
+"""
+
+import os
+
+from cw2.settings import *
+
+DEBUG = False
+
+ALLOWED_HOSTS = ['127.0.0.1', 'localhost']
+
+# transactions wait their turn for SQLite's one write lock rather than failing when another holds it
+DATABASES = {
+    'default': {
+        'ENGINE': 'benchmark.sqlite',
+        'NAME': os.environ.get('BENCHMARK_DB', str(BASE_DIR / 'benchmark.sqlite3')),
+    }
+}
+
+# copies of the seeded database standing in for read replicas
+for index, replica in enumerate(filter(None, os.environ.get('BENCHMARK_REPLICAS', '').split(os.pathsep))):
+    DATABASES['replica{}'.format(index + 1)] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': replica}
+
+DATABASE_REPLICAS = dict(DATABASE_REPLICAS, ALIASES=[alias for alias in DATABASES if alias != 'default'])
+
+UPSTREAM_URLS = {
+    'CURRENCY': os.environ.get('BENCHMARK_CURRENCY_URL', 'http://127.0.0.1:8001/currency/'),
+    'PNS': os.environ.get('BENCHMARK_PNS_URL', 'http://127.0.0.1:8001/pns/'),
+}
+
+# every request comes from the one load generator, so client and card limits would cap the measurement
+RATE_LIMIT = dict(RATE_LIMIT, ENABLED=False)
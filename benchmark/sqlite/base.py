@@ -0,0 +1,12 @@
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    SQLite, with transactions that take the write lock as they begin. SQLite ignores select_for_update, so two
+    transactions that read a row and then write can't both upgrade to the write lock, and one fails at once with
+    "database is locked" instead of waiting.
+    """
+
+    def _start_transaction_under_autocommit(self):
+        self.cursor().execute("BEGIN IMMEDIATE")
@@ -0,0 +1,106 @@
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# transaction IDs handed out by the PNS stand-in start well above any seeded transaction
+FIRST_TRANSACTION_ID = 1000000000
+
+# rate applied to every currency pair by the currency service stand-in
+RATE = 1.1
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the currency service and the PNS, with configurable latency and error rate.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, jitter=0.0, errorRate=0.0, seedValue=None):
+        """
+
+        :param address: the (host, port) to listen on, port 0 picks a free one
+        :param latency: seconds each response is delayed by
+        :param jitter: the most seconds added to or taken from latency, picked uniformly per request
+        :param errorRate: the fraction of requests answered with a 500
+        """
+        super().__init__(address, StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.random = random.Random(seedValue)
+        self.randomLock = threading.Lock()
+        self.transactionIds = itertools.count(FIRST_TRANSACTION_ID)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}/".format(host, port)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def draw(self):
+        # delay and whether to fail, drawn together so runs with a seed are repeatable
+        with self.randomLock:
+            delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+            failed = self.random.random() < self.errorRate
+        return max(delay, 0.0), failed
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        delay, failed = self.server.draw()
+        time.sleep(delay)
+
+        if failed:
+            return self.reply(500, {"Comment": "Stub failure"})
+        if self.path.rstrip("/").endswith("currency/convert"):
+            data = json.loads(body)
+            return self.reply(200, {"Amount": data["Amount"] * RATE})
+        if self.path.rstrip("/").endswith("pns/initiatetransactionpns"):
+            return self.reply(200, {"TransactionUUID": next(self.server.transactionIds), "Comment": "Stub payment"})
+        if self.path.rstrip("/").endswith("pns/initiaterefundpns"):
+            data = parse_qs(body.decode())
+            return self.reply(200, {"TransactionUUID": data.get("TransactionUUID", [None])[0], "Comment": "Stub refund"})
+        return self.reply(404, {"Comment": "Unknown stub endpoint {}".format(self.path)})
+
+    def reply(self, status, data):
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the currency service and PNS stand-ins on their own.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="most seconds added to or taken from latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = StubServer((args.host, args.port), args.latency, args.jitter, args.error_rate, args.seed)
+    print("Stand-ins listening on {}currency/ and {}pns/".format(server.url, server.url))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
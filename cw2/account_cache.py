@@ -0,0 +1,141 @@
+import threading
+
+from django.conf import settings
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.utils.crypto import salted_hmac
+
+from cw2.currency_cache import LocalRateBackend, DjangoRateBackend
+from cw2.models import PaymentDetails, PersonalAccount, BankDetails, BusinessAccount
+
+# defaults used when ACCOUNT_CACHE does not override them
+DEFAULT_ACCOUNT_CACHE = {
+    "ENABLED": True,
+    "BACKEND": "local",  # "local" for an in-process cache, "django" for Django's cache framework
+    "TTL": 300,  # seconds resolved accounts are trusted for, bounds staleness in processes that missed a change
+    "MAX_ENTRIES": 10000,  # in-process only, least recently used accounts are evicted first
+    "CACHE_ALIAS": "default",  # django only, which entry of CACHES to use
+    "KEY_PREFIX": "cw2:account",  # django only, namespaces account keys in the shared cache
+}
+
+# card details and account names are hashed with the secret key so they never appear in cache keys
+KEY_SALT = "cw2.account_cache"
+
+_backend = None
+_backendLock = threading.Lock()
+
+
+def getConfig():
+    return dict(DEFAULT_ACCOUNT_CACHE, **getattr(settings, "ACCOUNT_CACHE", {}))
+
+
+def getAccountBackend():
+    """
+
+    :return: the account cache backend configured by ACCOUNT_CACHE, created on first use, or None if disabled
+    """
+    global _backend
+    if _backend is None:
+        with _backendLock:
+            if _backend is None:
+                config = getConfig()
+                if not config["ENABLED"]:
+                    return None
+                # the rate cache backends hold any picklable value, so accounts reuse them
+                if config["BACKEND"] == "django":
+                    _backend = DjangoRateBackend(config["TTL"], config["CACHE_ALIAS"], config["KEY_PREFIX"])
+                elif config["BACKEND"] == "local":
+                    _backend = LocalRateBackend(config["TTL"], config["MAX_ENTRIES"])
+                else:
+                    raise ValueError('Unknown account cache backend "{}"'.format(config["BACKEND"]))
+    return _backend
+
+
+def resetAccountBackend():
+    """
+    Forgets the configured backend so that it is rebuilt from settings on next use.
+    """
+    global _backend
+    with _backendLock:
+        _backend = None
+
+
+def payerKey(cardNumber, securityCode):
+    return "payer", salted_hmac(KEY_SALT, "{}:{}".format(cardNumber, securityCode)).hexdigest()
+
+
+def payeeKey(accountNumber, sortCode, accountName):
+    return "payee", salted_hmac(KEY_SALT, "{}:{}:{}".format(int(accountNumber), sortCode, accountName)).hexdigest()
+
+
+def getRows(key):
+    """
+
+    :param key: a payerKey or payeeKey
+    :return: the lookup rows cached under the key, or None if they aren't cached
+    """
+    backend = getAccountBackend()
+    if backend is None:
+        return None
+    return backend.get(key)
+
+
+def storeRows(key, rows):
+    """
+
+    :param key: a payerKey or payeeKey
+    :param rows: the rows the lookup found, an empty list is cached too so unknown cards also skip the database
+    """
+    backend = getAccountBackend()
+    if backend is not None:
+        backend.set(key, rows)
+
+
+def forget(keys):
+    backend = getAccountBackend()
+    if backend is not None:
+        for key in keys:
+            backend.delete(key)
+
+
+# the cache keys whose rows include an instance of each model
+def keysFor(instance):
+    """
+
+    :param instance: a PaymentDetails, PersonalAccount, BankDetails or BusinessAccount
+    :return: the payerKey or payeeKey entries that may hold the instance
+    """
+    if isinstance(instance, PaymentDetails):
+        return [payerKey(instance.cardNumber, instance.securityCode)]
+    if isinstance(instance, PersonalAccount):
+        return [payerKey(card["cardNumber"], card["securityCode"]) for card in
+                PaymentDetails.objects.filter(paymentId=instance.paymentDetails_id).values("cardNumber",
+                                                                                          "securityCode")]
+    if isinstance(instance, BankDetails):
+        return [payeeKey(instance.accountNumber, instance.sortCode, instance.accountName)]
+    if isinstance(instance, BusinessAccount):
+        return [payeeKey(bank["accountNumber"], bank["sortCode"], bank["accountName"]) for bank in
+                BankDetails.objects.filter(accountNumber=instance.bankDetails_id).values("accountNumber", "sortCode",
+                                                                                         "accountName")]
+    return []
+
+
+def forgetStored(sender, instance, raw=False, **kwargs):
+    # an update may move the instance to different keys, so the ones it had before are dropped too
+    if raw or instance.pk is None or getAccountBackend() is None:
+        return
+    stored = sender.objects.filter(pk=instance.pk).first()
+    if stored is not None:
+        forget(keysFor(stored))
+
+
+def forgetInstance(sender, instance, raw=False, **kwargs):
+    if not raw:
+        forget(keysFor(instance))
+
+
+def connectSignals():
+    # bulk_create and queryset update() send no signals, changes made that way are picked up once TTL runs out
+    for model in (PaymentDetails, PersonalAccount, BankDetails, BusinessAccount):
+        pre_save.connect(forgetStored, sender=model, dispatch_uid="account_cache_pre_save")
+        post_save.connect(forgetInstance, sender=model, dispatch_uid="account_cache_post_save")
+        post_delete.connect(forgetInstance, sender=model, dispatch_uid="account_cache_post_delete")
@@ -1,9 +1,117 @@
 from django.contrib import admin
-from cw2.models import Transaction, PersonalAccount, BusinessAccount, PaymentDetails, BankDetails
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 
-admin.site.register(Transaction)
-admin.site.register(PersonalAccount)
-admin.site.register(BusinessAccount)
-admin.site.register(PaymentDetails)
-admin.site.register(BankDetails)
+from cw2.models import Transaction, ArchivedTransaction, PersonalAccount, BusinessAccount, PaymentDetails, BankDetails, \
+    RefundEntry, cardFingerprint
 
+# rows counted exactly before the changelist settles for "at least this many"
+COUNT_LIMIT = 100000
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Numbers changelist pages without counting every row of a large table. An unfiltered PostgreSQL table uses the
+    planner's row estimate, anything else is counted up to COUNT_LIMIT rows.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where and connections[queryset.db].vendor == "postgresql":
+            with connections[queryset.db].cursor() as cursor:
+                cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+                               [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row is not None and row[0] > COUNT_LIMIT:
+                return row[0]
+        # a count over a LIMIT subquery stops reading once it reaches the limit
+        return queryset.order_by()[:COUNT_LIMIT].count()
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # the total shown next to filtered results would need a second, full count
+    show_full_result_count = False
+    list_per_page = 100
+
+
+@admin.register(Transaction)
+class TransactionAdmin(LargeTableAdmin):
+    list_display = ("id", "date", "transactionStatus", "amount", "currency", "payer", "payee")
+    # payer and payee names come from the same query rather than one query per row
+    list_select_related = ("payer", "payee")
+    raw_id_fields = ("payer", "payee", "originalTransaction")
+    # both filters and the hierarchy run on indexed columns, status alone and (date, id)
+    list_filter = ("transactionStatus", ("date", admin.DateFieldListFilter))
+    date_hierarchy = "date"
+    ordering = ("-date", "-id")
+    # exact ID lookups use the primary key, partial matches would scan the table
+    search_fields = ("=id",)
+
+
+@admin.register(ArchivedTransaction)
+class ArchivedTransactionAdmin(LargeTableAdmin):
+    list_display = ("id", "date", "transactionStatus", "amount", "currency", "payer", "payee", "archived")
+    list_select_related = ("payer", "payee")
+    raw_id_fields = ("payer", "payee", "originalTransaction")
+    # archived rows are history, so only the ID is searched and nothing is filtered on unindexed columns
+    ordering = ("-date", "-id")
+    search_fields = ("=id",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(RefundEntry)
+class RefundEntryAdmin(LargeTableAdmin):
+    # the IDs rather than the transactions, which may have been archived and would take a query per row
+    list_display = ("id", "created", "payment_id", "refund_id", "amount", "state")
+    raw_id_fields = ("payment", "refund")
+    ordering = ("-id",)
+    # entries are found by the payment they refund, which leads their index
+    search_fields = ("=payment__id",)
+
+    # the amount left to refund is worked out from the entries, so they're only written by refunds
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(PersonalAccount)
+class PersonalAccountAdmin(LargeTableAdmin):
+    list_display = ("accountNumber", "fullName", "email")
+    raw_id_fields = ("paymentDetails", "bankDetails")
+    search_fields = ("=accountNumber",)
+
+
+@admin.register(BusinessAccount)
+class BusinessAccountAdmin(LargeTableAdmin):
+    list_display = ("accountNumber", "businessName", "businessNumber")
+    raw_id_fields = ("paymentDetails", "bankDetails")
+    search_fields = ("=accountNumber",)
+
+
+@admin.register(PaymentDetails)
+class PaymentDetailsAdmin(LargeTableAdmin):
+    list_display = ("paymentId", "expiryDate")
+    search_fields = ("=paymentId",)
+
+    def get_search_results(self, request, queryset, search_term):
+        # a card number is found through its fingerprint's index rather than by scanning the card numbers
+        queryset, mayHaveDuplicates = super().get_search_results(request, queryset, search_term)
+        if search_term.strip():
+            queryset |= self.model.objects.filter(cardFingerprint=cardFingerprint(search_term.strip()))
+        return queryset, mayHaveDuplicates
+
+
+@admin.register(BankDetails)
+class BankDetailsAdmin(LargeTableAdmin):
+    list_display = ("accountNumber", "sortCode", "accountName")
+    search_fields = ("=accountNumber",)
@@ -0,0 +1,28 @@
+"""
+Django settings for workers that serve only the payment API.
+
+Uses the project settings without the admin, auth, sessions, messages and static files apps, or the middleware
+that serves them, since the API views are CSRF exempt and unauthenticated. The admin and the staff-only export stay
+on cw2.settings, which can share the same database.
+"""
+
+from cw2.settings import *
+
+INSTALLED_APPS = [
+    'cw2',
+]
+
+# CommonMiddleware's slash redirects can't carry a POST body, so clients already have to use the exact paths
+MIDDLEWARE = [
+    'cw2.timing.TimingMiddleware',
+    'cw2.rate_limit.RateLimitMiddleware',
+    'cw2.db_router.ReplicaPinMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+]
+
+ROOT_URLCONF = 'cw2.api_urls'
+
+# every response is JSON, so no template engine is configured
+TEMPLATES = []
+
+WSGI_APPLICATION = 'cw2.api_wsgi.application'
@@ -0,0 +1,24 @@
+"""cw2 API URL Configuration
+
+The payment endpoints, served on their own by cw2.api_settings and together with the admin and the staff-only
+export, history and settlement by cw2.urls.
+"""
+from django.urls import path
+import cw2.views as views
+import cw2.async_views as async_views
+import cw2.batch_views as batch_views
+import cw2.payment_queue as payment_queue
+import cw2.timing as timing
+
+urlpatterns = [
+    path('initiatepayment/', views.InitiatePayment),
+    path('initiatepayments/', batch_views.InitiatePayments),
+    path('payments/<uuid:paymentId>/', payment_queue.PaymentStatus),
+    path('initiaterefund/', views.InitiateRefund),
+    path('initiatecancellation/', views.InitiateCancellation),
+    path('metrics', timing.Metrics),
+    # non-blocking versions for deployments served through cw2.asgi
+    path('async/initiatepayment/', async_views.InitiatePayment),
+    path('async/initiaterefund/', async_views.InitiateRefund),
+    path('async/initiatecancellation/', async_views.InitiateCancellation),
+]
@@ -0,0 +1,16 @@
+"""
+WSGI config for cw2 workers that serve only the payment API.
+
+It exposes the WSGI callable as a module-level variable named ``application``, built with cw2.api_settings.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/wsgi/
+"""
+
+import os
+
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cw2.api_settings')
+
+application = get_wsgi_application()
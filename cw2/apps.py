@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class Cw2Config(AppConfig):
+    name = 'cw2'
+
+    def ready(self):
+        # resolved accounts are cached, so changes to them have to clear the cache
+        from cw2.account_cache import connectSignals
+        connectSignals()
@@ -0,0 +1,75 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from cw2.models import Transaction, TransactionStatus, ArchivedTransaction, RefundEntry, RefundState
+
+# defaults used when TRANSACTION_ARCHIVE does not override them
+DEFAULT_TRANSACTION_ARCHIVE = {
+    "COMPLETE_AFTER_DAYS": 180,  # completed payments can still be refunded or cancelled until then
+    "FINISHED_AFTER_DAYS": 30,  # cancelled and refunded payments stay in recent history until then
+    "BATCH_SIZE": 500,  # transactions moved per database transaction
+    "PAUSE": 0.1,  # seconds between batches, so writers get the table in between
+}
+
+# the columns copied to the archive
+TRANSACTION_FIELDS = tuple(field.attname for field in Transaction._meta.concrete_fields)
+
+
+def getConfig():
+    return dict(DEFAULT_TRANSACTION_ARCHIVE, **getattr(settings, "TRANSACTION_ARCHIVE", {}))
+
+
+def archivable(config, now=None):
+    """
+
+    :param config: the archive settings
+    :param now: the time the ages are measured from, defaults to now
+    :return: the name and queryset of each kind of transaction that can be archived
+    """
+    now = now or timezone.now()
+    completeBefore = now - timedelta(days=config["COMPLETE_AFTER_DAYS"])
+    finishedBefore = now - timedelta(days=config["FINISHED_AFTER_DAYS"])
+    # a refunded payment is archived with its refunds once it has been refunded in full, and a partly refunded one
+    # with its refunds once it is old enough, but never while a refund of it is still being sent
+    pending = RefundEntry.objects.filter(payment=OuterRef("pk"), state=RefundState.PENDING)
+    return (("completed", Transaction.objects.filter(~Exists(pending), transactionStatus=TransactionStatus.COMPLETE,
+                                                     date__lt=completeBefore)),
+            ("cancelled", Transaction.objects.filter(transactionStatus=TransactionStatus.CANCELLED,
+                                                     date__lt=finishedBefore)),
+            ("refunded", Transaction.objects.filter(
+                transactionStatus=TransactionStatus.REFUND, date__lt=finishedBefore,
+                originalTransaction__transactionStatus=TransactionStatus.REFUNDED)))
+
+
+def archiveBatch(candidates, batchSize):
+    """
+    Moves up to batchSize of the candidates, along with the payments they refund and the refunds of those payments,
+    to the archive in one database transaction.
+
+    :param candidates: a queryset of transactions that can be archived
+    :param batchSize: the most candidates to move
+    :return: the number of transactions moved
+    """
+    with atomic():
+        # rows a refund or cancellation is changing are skipped rather than waited for, where the database allows
+        ids = set(candidates.select_for_update(skip_locked=True).values_list("id", flat=True)[:batchSize])
+        if not ids:
+            return 0
+        # a refund and the payment it refunds move together, so neither points into the other table
+        ids |= set(Transaction.objects.filter(id__in=ids, originalTransaction__isnull=False)
+                   .values_list("originalTransaction_id", flat=True))
+        ids |= set(Transaction.objects.filter(originalTransaction_id__in=ids).values_list("id", flat=True))
+
+        now = timezone.now()
+        rows = Transaction.objects.select_for_update().filter(id__in=ids).values(*TRANSACTION_FIELDS)
+        ArchivedTransaction.objects.bulk_create([ArchivedTransaction(archived=now, **row) for row in rows])
+        Transaction.objects.filter(id__in=ids).delete()
+    return len(ids)
+
+
+def isArchived(transactionId):
+    return ArchivedTransaction.objects.filter(id=transactionId).exists()
@@ -0,0 +1,176 @@
+import json
+
+from asgiref.sync import sync_to_async
+
+from cw2 import http_client, timing
+from cw2.idempotency import idempotent
+from cw2.payment_queue import wantsQueue, queuePayment
+from cw2.currency_cache import cachedConversion, rememberConversion
+from cw2.error_handling import checkMethod, readUpstream
+from cw2.views import checkPayment, lookupPayer, lookupPayee, paymentCurrencyData, paymentPNSData, storePayment, \
+    checkRefund, checkCancellation, findCompleteTransaction, claimRefund, releaseRefund, refundCurrencyData, \
+    refundPNSData, storeRefund, cancelTransaction
+
+# the ORM is synchronous, so database work runs on a worker thread while the event loop keeps serving requests
+lookupPayerAsync = sync_to_async(lookupPayer)
+lookupPayeeAsync = sync_to_async(lookupPayee)
+storePaymentAsync = sync_to_async(storePayment)
+queuePaymentAsync = sync_to_async(queuePayment)
+findCompleteTransactionAsync = sync_to_async(findCompleteTransaction)
+claimRefundAsync = sync_to_async(claimRefund)
+releaseRefundAsync = sync_to_async(releaseRefund)
+storeRefundAsync = sync_to_async(storeRefund)
+cancelTransactionAsync = sync_to_async(cancelTransaction)
+
+
+def asyncCsrfExempt(view):
+    # django's csrf_exempt wraps views in a sync function, which would hide that the view is async
+    view.csrf_exempt = True
+    return view
+
+
+@asyncCsrfExempt
+@idempotent
+async def InitiatePayment(request):
+    # returns the data or error message and boolean indicating which that is
+    data, methodStatus = checkMethod(request)
+    # data contains error message if the body wasn't in the correct format
+    if not methodStatus:
+        return data
+
+    # stores the cleaned data if formatted correctly, else returns an error message
+    data, bodyStatus = checkPayment(data)
+    if not bodyStatus:
+        return data
+
+    # check that the payer card and personal account exist and match
+    payerData, payerStatus = await lookupPayerAsync(data)
+    if not payerStatus:
+        return payerData
+
+    # make sure that the payee details match those of a registered business account and
+    # that the corresponding bank details also match
+    businessData, payeeStatus = await lookupPayeeAsync(data)
+    if not payeeStatus:
+        return businessData
+
+    # clients that asked for it are answered now and the upstreams are contacted by a processpayments worker
+    if wantsQueue(request):
+        return await queuePaymentAsync(data, payerData, businessData)
+
+    currencyResponse = await ConvertCurrency(paymentCurrencyData(data))
+
+    # error has occurred when converting currency
+    currencyResponseData, currencyStatus = readUpstream(currencyResponse, 201)
+    if not currencyStatus:
+        return currencyResponseData
+
+    # we now talk to PNS and get them to initiate the payment itself
+    transactionResponse = await RequestTransactionPNS(paymentPNSData(data, currencyResponseData["Amount"]))
+
+    # error has occurred when doing transaction
+    transactionResponseData, transactionStatus = readUpstream(transactionResponse, 301)
+    if not transactionStatus:
+        return transactionResponseData
+
+    return await storePaymentAsync(data, payerData, businessData, transactionResponseData["TransactionUUID"],
+                                   currencyResponseData["Amount"])
+
+
+@asyncCsrfExempt
+@idempotent
+async def InitiateRefund(request):
+    # returns the data or error message and boolean indicating which that is
+    data, methodStatus = checkMethod(request)
+    # data contains error message if the body wasn't in the correct format
+    if not methodStatus:
+        return data
+
+    # stores the data if formatted correctly, else returns an error message
+    data, bodyStatus = checkRefund(data)
+    if not bodyStatus:
+        return data
+
+    # check transaction exists and can still be refunded
+    oldTransaction, transactionStatus = await findCompleteTransactionAsync(data["TransactionUUID"])
+    if not transactionStatus:
+        return oldTransaction
+
+    # the refund is converted into the currency the payment was made in
+    currencyResponse = await ConvertCurrency(refundCurrencyData(data, oldTransaction))
+
+    # error has occurred when converting currency
+    currencyResponseData, currencyStatus = readUpstream(currencyResponse, 201)
+    if not currencyStatus:
+        return currencyResponseData
+
+    # claim the amount before contacting the PNS, so concurrent refunds and cancellations can't also spend it
+    entry, claimStatus = await claimRefundAsync(oldTransaction, currencyResponseData["Amount"])
+    if not claimStatus:
+        return entry
+
+    # we now talk to PNS and get them to initiate the refund itself
+    transactionResponse = await RequestRefundPNS(refundPNSData(data, oldTransaction, entry))
+
+    # error has occurred when doing transaction
+    transactionResponseData, transactionStatus = readUpstream(transactionResponse, 403)
+    if not transactionStatus:
+        # the PNS may have refunded without answering, so the claim is kept until someone checks with it
+        if not getattr(transactionResponseData, "upstreamUnanswered", False):
+            await releaseRefundAsync(entry)
+        return transactionResponseData
+
+    return await storeRefundAsync(oldTransaction, entry)
+
+
+@asyncCsrfExempt
+async def InitiateCancellation(request):
+    # returns the data or error message and boolean indicating which that is
+    data, methodStatus = checkMethod(request)
+    # data contains error message if the body wasn't in the correct format
+    if not methodStatus:
+        return data
+
+    # stores the data if formatted correctly, else returns an error message
+    data, bodyStatus = checkCancellation(data)
+    if not bodyStatus:
+        return data
+
+    return await cancelTransactionAsync(data["TransactionUUID"])
+
+
+async def ConvertCurrency(data):
+    started = timing.start()
+
+    # convert locally if the rate is already known
+    response = cachedConversion(data)
+    if response is None:
+        # post to currency converter API and get response, conversions are safe to retry
+        response = await http_client.apost("CURRENCY", "convert/", idempotent=True, content=json.dumps(data))
+
+        # remember the rate for later conversions
+        rememberConversion(data, response)
+
+    timing.stop("currency", started)
+    return response
+
+
+async def RequestTransactionPNS(data):
+    # post to the PNS and get response
+    started = timing.start()
+    response = await http_client.apost("PNS", "initiatetransactionpns/", data=formData(data))
+    timing.stop("pns", started)
+    return response
+
+
+async def RequestRefundPNS(data):
+    # post to the PNS and get response
+    started = timing.start()
+    response = await http_client.apost("PNS", "initiaterefundpns/", data=formData(data))
+    timing.stop("pns", started)
+    return response
+
+
+def formData(data):
+    # form encode values the way requests does for the sync views, e.g. the expiry date
+    return {key: str(value) for key, value in data.items() if value is not None}
@@ -0,0 +1,218 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db.transaction import atomic
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+
+from cw2.error_handling import errorHandling, checkMethod, readUpstream
+from cw2.models import Transaction, PaymentDetails, BankDetails, cardFingerprint
+from cw2.settlement import recordPayments
+from cw2.views import checkPayment, withSecurityCode, matchPayer, matchPayee, paymentCurrencyData, paymentPNSData, \
+    makePaymentTransaction, ConvertCurrency, RequestTransactionPNS, PAYER_FIELDS, PAYEE_FIELDS
+
+# defaults used when PAYMENT_BATCH does not override them
+DEFAULT_PAYMENT_BATCH = {
+    "MAX_SIZE": 5000,  # payments accepted in one request
+    "PNS_CONCURRENCY": 10,  # PNS calls in flight at once for one batch
+    "QUERY_CHUNK": 500,  # values per IN clause, keeps under SQLite's variable limit
+}
+
+
+def getConfig():
+    return dict(DEFAULT_PAYMENT_BATCH, **getattr(settings, "PAYMENT_BATCH", {}))
+
+
+def chunked(values, size):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+@csrf_exempt
+def InitiatePayments(request):
+    # returns the data or error message and boolean indicating which that is
+    data, methodStatus = checkMethod(request)
+    # data contains error message if the body wasn't in the correct format
+    if not methodStatus:
+        return data
+
+    config = getConfig()
+
+    # the body must be a list of payments in the InitiatePayment format
+    if not isinstance(data, list):
+        return errorHandling(101)
+    if len(data) == 0:
+        return errorHandling(100)
+    if len(data) > config["MAX_SIZE"]:
+        return errorHandling(110, config["MAX_SIZE"])
+
+    # one result per payment, filled in as each payment succeeds or fails
+    results = [None] * len(data)
+    payments = {}
+
+    # validate every payment in the batch
+    for index, item in enumerate(data):
+        if not isinstance(item, dict):
+            results[index] = errorHandling(101)
+            continue
+        item, bodyStatus = checkPayment(item)
+        if not bodyStatus:
+            results[index] = item
+            continue
+        payments[index] = item
+
+    # resolve every payer and payee with one query per chunk of cards and bank accounts
+    payerRows = lookupPayers(payments.values(), config["QUERY_CHUNK"])
+    payeeRows = lookupPayees(payments.values(), config["QUERY_CHUNK"])
+    accounts = {}
+    for index, item in payments.items():
+        payerData, payerStatus = matchPayer(item, withSecurityCode(payerRows.get(item["CardNumber"], []), item["CVV"]))
+        if not payerStatus:
+            results[index] = payerData
+            continue
+        businessData, payeeStatus = matchPayee(item, payeeRows.get(payeeKey(item), []))
+        if not payeeStatus:
+            results[index] = businessData
+            continue
+        accounts[index] = (payerData, businessData)
+
+    # convert once per currency pair and apply that rate to the rest of the batch
+    rates = convertPairs({index: payments[index] for index in accounts}, config["PNS_CONCURRENCY"])
+
+    pending = {}
+    for index in accounts:
+        item = payments[index]
+        rate, rateError = rates[(item["PayerCurrencyCode"], item["PayeeCurrencyCode"])]
+        if rateError is not None:
+            results[index] = rateError
+            continue
+        pending[index] = item["Amount"] * rate
+
+    # send the payments to the PNS with a bounded number in flight
+    def requestPayment(index):
+        return index, RequestTransactionPNS(paymentPNSData(payments[index], pending[index]))
+
+    transactions = {}
+    with ThreadPoolExecutor(max_workers=config["PNS_CONCURRENCY"]) as executor:
+        for index, transactionResponse in executor.map(requestPayment, pending):
+            transactionResponseData, transactionStatus = readUpstream(transactionResponse, 301)
+            if not transactionStatus:
+                results[index] = transactionResponseData
+                continue
+            payerData, businessData = accounts[index]
+            transactions[index] = makePaymentTransaction(payments[index], payerData, businessData,
+                                                         transactionResponseData["TransactionUUID"], pending[index])
+
+    # store every accepted payment in one insert, along with their payees' settlement totals
+    for index, error in storeTransactions(transactions).items():
+        results[index] = error
+    for index, confirmedTransaction in transactions.items():
+        if results[index] is None:
+            results[index] = {"TransactionUUID": confirmedTransaction.id,
+                              "ErrorCode": None,
+                              "Comment": "Transaction processed successfully"
+                              }
+
+    # failed payments hold their error response, which is unpacked into the result list
+    results = [json.loads(result.content) if isinstance(result, JsonResponse) else result for result in results]
+
+    return JsonResponse({"Results": results}, status=200)
+
+
+# stores the payments the PNS has accepted
+def storeTransactions(transactions):
+    """
+
+    :param transactions: the unsaved transactions, keyed on their position in the batch
+    :return: the error response for each transaction that could not be stored
+    """
+    try:
+        with atomic():
+            Transaction.objects.bulk_create(transactions.values())
+            recordPayments(transactions.values())
+        return {}
+    except Exception:
+        # the PNS has already taken every one of these payments, so one bad row mustn't lose the rest
+        return storeEach(transactions)
+
+
+def storeEach(transactions):
+    """
+
+    :param transactions: the unsaved transactions, keyed on their position in the batch
+    :return: the error response for each transaction that could not be stored
+    """
+    errors = {}
+    for index, confirmedTransaction in transactions.items():
+        try:
+            with atomic():
+                confirmedTransaction.save(force_insert=True)
+                recordPayments([confirmedTransaction])
+        except Exception as e:
+            errors[index] = errorHandling(401, str(e))
+    return errors
+
+
+def payeeKey(item):
+    return int(item["PayeeBankAccNum"]), item["PayeeBankSortCode"], item["RecipientName"]
+
+
+# finds the PAYER_FIELDS rows for every card in the batch
+def lookupPayers(items, chunkSize):
+    """
+
+    :param items: the validated payments
+    :param chunkSize: the number of card numbers to look up per query
+    :return: the rows found, with their CVV, keyed on card number
+    """
+    rows = {}
+    fingerprints = {cardFingerprint(item["CardNumber"]): item["CardNumber"] for item in items}
+    for chunk in chunked(fingerprints, chunkSize):
+        for row in PaymentDetails.objects.filter(cardFingerprint__in=chunk).values("cardFingerprint", "securityCode",
+                                                                                    *PAYER_FIELDS):
+            rows.setdefault(fingerprints[row["cardFingerprint"]], []).append(row)
+    return rows
+
+
+# finds the PAYEE_FIELDS rows for every bank account in the batch
+def lookupPayees(items, chunkSize):
+    """
+
+    :param items: the validated payments
+    :param chunkSize: the number of bank accounts to look up per query
+    :return: the rows found, keyed on account number, sort code and account name
+    """
+    rows = {}
+    for accountNumbers in chunked({int(item["PayeeBankAccNum"]) for item in items}, chunkSize):
+        for row in BankDetails.objects.filter(accountNumber__in=accountNumbers).values("sortCode", "accountName",
+                                                                                       *PAYEE_FIELDS):
+            rows.setdefault((row["accountNumber"], row["sortCode"], row["accountName"]), []).append(row)
+    return rows
+
+
+# asks the currency converter once for each currency pair in the batch
+def convertPairs(items, concurrency):
+    """
+
+    :param items: the payments that passed validation and lookups, keyed on their position in the batch
+    :param concurrency: the number of conversions to run at once
+    :return: the rate or error response for each currency pair
+    """
+    # the largest payment of each pair is converted, the converter's rounding moves its rate the least
+    samples = {}
+    for item in items.values():
+        pair = (item["PayerCurrencyCode"], item["PayeeCurrencyCode"])
+        if pair not in samples or item["Amount"] > samples[pair]["Amount"]:
+            samples[pair] = item
+
+    def convert(pair):
+        currencyData = paymentCurrencyData(samples[pair])
+        currencyResponseData, currencyStatus = readUpstream(ConvertCurrency(currencyData), 201)
+        if not currencyStatus:
+            return pair, (None, currencyResponseData)
+        return pair, (float(currencyResponseData["Amount"]) / currencyData["Amount"], None)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return dict(executor.map(convert, samples))
@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+# defaults used when CIRCUIT_BREAKER does not override them
+DEFAULT_CIRCUIT_BREAKER = {
+    "ENABLED": True,
+    "WINDOW": 20,  # most recent calls the error and slow rates are taken over
+    "MIN_CALLS": 10,  # calls in the window before the circuit can open
+    "ERROR_RATE": 0.5,  # fraction of failed calls that opens the circuit
+    "SLOW_CALL": 2.0,  # seconds after which a call counts as slow
+    "SLOW_RATE": 0.8,  # fraction of slow calls that opens the circuit
+    "OPEN_FOR": 30,  # seconds calls fail fast before a probe is let through
+    "PROBES": 1,  # calls let through at once while half open
+}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+def getConfig():
+    return dict(DEFAULT_CIRCUIT_BREAKER, **getattr(settings, "CIRCUIT_BREAKER", {}))
+
+
+class CircuitBreaker:
+    """
+    Tracks the outcome and duration of recent calls to one upstream service. Once too many fail or are slow the
+    circuit opens and calls fail fast, until after OPEN_FOR seconds a probe call decides whether it closes again.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.state = CLOSED
+        self.outcomes = deque(maxlen=config["WINDOW"])  # (failed, slow) per call
+        self.openedAt = 0.0
+        self.probes = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+
+        :return: whether a call may be made, each allowed call must be followed by record
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if time.monotonic() - self.openedAt < self.config["OPEN_FOR"]:
+                    return False
+                self.state = HALF_OPEN
+                self.probes = 0
+            if self.probes >= self.config["PROBES"]:
+                return False
+            self.probes += 1
+            return True
+
+    def record(self, failed, duration):
+        """
+
+        :param failed: whether the call failed
+        :param duration: seconds the call took
+        """
+        slow = duration >= self.config["SLOW_CALL"]
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probes -= 1
+                if failed or slow:
+                    self.trip()
+                else:
+                    # the upstream has recovered, so start afresh
+                    self.state = CLOSED
+                    self.outcomes.clear()
+                return
+            if self.state == OPEN:
+                return
+            self.outcomes.append((failed, slow))
+            calls = len(self.outcomes)
+            if calls < self.config["MIN_CALLS"]:
+                return
+            failures = sum(failed for failed, slow in self.outcomes)
+            slowCalls = sum(slow for failed, slow in self.outcomes)
+            if failures >= self.config["ERROR_RATE"] * calls or slowCalls >= self.config["SLOW_RATE"] * calls:
+                self.trip()
+
+    def trip(self):
+        self.state = OPEN
+        self.openedAt = time.monotonic()
+        self.outcomes.clear()
+
+
+_breakers = {}
+_breakersLock = threading.Lock()
+
+
+def getBreaker(service):
+    """
+
+    :param service: the name of the upstream service, "CURRENCY" or "PNS"
+    :return: the process wide breaker for that service, or None if breakers are disabled
+    """
+    breaker = _breakers.get(service)
+    if breaker is None:
+        config = getConfig()
+        if not config["ENABLED"]:
+            return None
+        with _breakersLock:
+            breaker = _breakers.setdefault(service, CircuitBreaker(config))
+    return breaker
+
+
+def resetBreakers():
+    """
+    Forgets every breaker's state, the next call builds new ones with the current settings.
+    """
+    with _breakersLock:
+        _breakers.clear()
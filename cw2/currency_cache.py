@@ -0,0 +1,197 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+# defaults used when CURRENCY_RATE_CACHE does not override them
+DEFAULT_RATE_CACHE = {
+    "BACKEND": "local",  # "local" for an in-process cache, "django" for Django's cache framework
+    "TTL": 3600,  # seconds a rate is trusted for
+    # smallest amount a rate is worked out from, the converter rounds its result so a rate taken from a small
+    # conversion can be far off, e.g. 0.01 converted to 0.01
+    "MIN_AMOUNT": 100,
+    "MAX_ENTRIES": 1024,  # in-process only, least recently used rates are evicted first
+    "CACHE_ALIAS": "default",  # django only, which entry of CACHES to use
+    "KEY_PREFIX": "cw2:rate",  # django only, namespaces rate keys in the shared cache
+}
+
+
+class LocalRateBackend:
+    """
+    In-process LRU cache of exchange rates with a fixed time to live.
+    """
+
+    def __init__(self, ttl, maxEntries):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            rate, expires = entry
+            # stale rates are dropped rather than served
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return rate
+
+    def set(self, key, rate):
+        with self.lock:
+            self.entries[key] = (rate, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DjangoRateBackend:
+    """
+    Exchange rate cache stored in one of Django's configured caches, so rates are shared between processes.
+    Eviction is left to the cache backend itself.
+    """
+
+    def __init__(self, ttl, alias, prefix):
+        self.ttl = ttl
+        self.alias = alias
+        self.prefix = prefix
+
+    def makeKey(self, key):
+        return "{}:{}".format(self.prefix, ":".join(key))
+
+    def get(self, key):
+        return caches[self.alias].get(self.makeKey(key))
+
+    def set(self, key, rate):
+        caches[self.alias].set(self.makeKey(key), rate, timeout=self.ttl)
+
+    def delete(self, key):
+        caches[self.alias].delete(self.makeKey(key))
+
+    def clear(self):
+        caches[self.alias].clear()
+
+
+def getConfig():
+    return dict(DEFAULT_RATE_CACHE, **getattr(settings, "CURRENCY_RATE_CACHE", {}))
+
+
+_backend = None
+_backendLock = threading.Lock()
+
+
+def getRateBackend():
+    """
+
+    :return: the rate cache backend configured by CURRENCY_RATE_CACHE, created on first use
+    """
+    global _backend
+    if _backend is None:
+        with _backendLock:
+            if _backend is None:
+                config = getConfig()
+                if config["BACKEND"] == "django":
+                    _backend = DjangoRateBackend(config["TTL"], config["CACHE_ALIAS"], config["KEY_PREFIX"])
+                elif config["BACKEND"] == "local":
+                    _backend = LocalRateBackend(config["TTL"], config["MAX_ENTRIES"])
+                else:
+                    raise ValueError('Unknown currency rate cache backend "{}"'.format(config["BACKEND"]))
+    return _backend
+
+
+def resetRateBackend():
+    """
+    Forgets the configured backend so that it is rebuilt from settings on next use.
+    """
+    global _backend
+    with _backendLock:
+        _backend = None
+
+
+def rateKey(data):
+    """
+
+    :param data: the body sent to the currency converter
+    :return: the cache key for the rate the body would use
+    """
+    return str(data["CurrencyFrom"]), str(data["CurrencyTo"]), str(data["Date"])
+
+
+def getRate(data):
+    """
+
+    :param data: the body sent to the currency converter
+    :return: the cached rate for the conversion, or None if it isn't cached
+    """
+    return getRateBackend().get(rateKey(data))
+
+
+def storeRate(data, convertedAmount):
+    """
+
+    :param data: the body that was sent to the currency converter
+    :param convertedAmount: the amount the currency converter returned for the body
+    """
+    # a zero amount tells us nothing about the rate, and a small one too little to rely on once rounded
+    if not data["Amount"] or abs(data["Amount"]) < getConfig()["MIN_AMOUNT"]:
+        return
+    getRateBackend().set(rateKey(data), convertedAmount / data["Amount"])
+
+
+def cachedConversion(data):
+    """
+
+    :param data: the body that would be sent to the currency converter
+    :return: a response converted without the network, or None if the converter has to be asked
+    """
+    # nothing to convert
+    if data["CurrencyFrom"] == data["CurrencyTo"]:
+        return CachedConversion(data["Amount"])
+
+    # convert locally if we already know the rate for this pair and day
+    rate = getRate(data)
+    if rate is not None:
+        return CachedConversion(data["Amount"] * rate)
+
+    return None
+
+
+def rememberConversion(data, response):
+    """
+
+    :param data: the body that was sent to the currency converter
+    :param response: the currency converter's response
+    """
+    if response.status_code != 200:
+        return
+    try:
+        storeRate(data, float(response.json()["Amount"]))
+    except (ValueError, KeyError, TypeError):
+        pass
+
+
+class CachedConversion:
+    """
+    Stands in for the currency converter's response when the conversion was done locally.
+    """
+
+    status_code = 200
+
+    def __init__(self, amount):
+        self.amount = amount
+
+    def json(self):
+        return {"Amount": self.amount}
@@ -0,0 +1,114 @@
+import asyncio
+import itertools
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections, DatabaseError
+from django.utils.decorators import sync_and_async_middleware
+
+from cw2.models import PaymentDetails, PersonalAccount, BankDetails, BusinessAccount
+
+# defaults used when DATABASE_REPLICAS does not override them
+DEFAULT_DATABASE_REPLICAS = {
+    "ALIASES": (),  # entries of DATABASES that replicate the default database
+    "HEALTH_CHECK_INTERVAL": 5,  # seconds between checks that a replica still answers
+    "PIN_SECONDS": 2,  # seconds after a write to an account table that every process's reads stay on the primary
+}
+
+# account resolution only reads these, so they can be served slightly behind the primary
+REPLICATED_MODELS = (PaymentDetails, PersonalAccount, BankDetails, BusinessAccount)
+
+# whether the request being handled has written, after which it reads only from the primary
+_pinned = ContextVar("pinned", default=False)
+
+
+def getConfig():
+    return dict(DEFAULT_DATABASE_REPLICAS, **getattr(settings, "DATABASE_REPLICAS", {}))
+
+
+class ReplicaRouter:
+    """
+    Sends reads of account tables to a healthy replica and everything else, including every write and every read of
+    transactions, to the default database. A request that has written reads from the default database from then on.
+    """
+
+    def __init__(self):
+        config = getConfig()
+        self.replicas = tuple(config["ALIASES"])
+        self.interval = config["HEALTH_CHECK_INTERVAL"]
+        self.pinSeconds = config["PIN_SECONDS"]
+        self.cycle = itertools.cycle(self.replicas)
+        # alias to (healthy, time of last check)
+        self.health = {}
+        self.accountsWritten = 0.0
+        self.lock = threading.Lock()
+
+    def db_for_read(self, model, **hints):
+        if not self.replicas or model not in REPLICATED_MODELS or _pinned.get():
+            return "default"
+        # replicas may not have caught up with an account that has just changed
+        if time.monotonic() - self.accountsWritten < self.pinSeconds:
+            return "default"
+        for _ in range(len(self.replicas)):
+            with self.lock:
+                alias = next(self.cycle)
+            if self.isHealthy(alias):
+                return alias
+        return "default"
+
+    def db_for_write(self, model, **hints):
+        _pinned.set(True)
+        if model in REPLICATED_MODELS:
+            self.accountsWritten = time.monotonic()
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # every alias holds the same data
+        return True
+
+    def isHealthy(self, alias):
+        """
+
+        :param alias: an entry of DATABASES
+        :return: whether the replica answered its last check, run at most every HEALTH_CHECK_INTERVAL seconds
+        """
+        healthy, checked = self.health.get(alias, (True, None))
+        now = time.monotonic()
+        if checked is not None and now - checked < self.interval:
+            return healthy
+        # record the check first, so other threads keep using the last result rather than all checking at once
+        self.health[alias] = (healthy, now)
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute("SELECT 1 FROM {} LIMIT 1".format(PaymentDetails._meta.db_table))
+            healthy = True
+        except DatabaseError:
+            healthy = False
+        self.health[alias] = (healthy, now)
+        return healthy
+
+
+@sync_and_async_middleware
+def ReplicaPinMiddleware(get_response):
+    """
+    Starts each request unpinned, so that only writes made by the request itself keep its reads on the primary.
+    """
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            token = _pinned.set(False)
+            try:
+                return await get_response(request)
+            finally:
+                _pinned.reset(token)
+    else:
+        def middleware(request):
+            token = _pinned.set(False)
+            try:
+                return get_response(request)
+            finally:
+                _pinned.reset(token)
+
+    return middleware
@@ -3,6 +3,36 @@ import json
 from django.http import HttpResponse, JsonResponse
 
 
+# error messages for each code, built once at import
+ERROR_CODES = {
+    100: 'Request body empty.',
+    101: 'Request body in incorrect format',
+    102: 'Could not find field "{}".',
+    103: 'Field "{}" is a {}, when {} was expected.',
+    104: 'Invalid Field "{}"',
+    105: 'Request type is not POST',
+    106: 'Payer card details could not be found',
+    107: 'Payee bank account details could not be found',
+    108: 'Payer personal account could not be found',
+    109: 'Payee business account details could not be found',
+    110: 'Batch contains more than {} payments.',
+    111: 'Request type is not GET',
+    112: 'Idempotency key was already used for a different request.',
+    113: 'A request with this idempotency key is still being processed.',
+    114: 'Payment with ID {} could not be located.',
+    115: 'Too many requests for this {}, try again later.',
+    116: 'Server is busy, try again later.',
+    117: 'Transaction with ID {} has been archived and can no longer be changed.',
+    118: 'Refund is more than the {} left to refund.',
+    201: 'An error occurred with currency conversion.',
+    301: 'An error occurred with contacting the Payment Network Service.',
+    401: 'Could not make changes to database: {}',
+    402: 'Transaction with ID {} could not be located.',
+    403: 'Refund could not complete.',
+    404: 'Original transaction already refunded or cancelled.'
+}
+
+
 # gives formatted error messages
 def errorHandling(code, body=None, passedComment=False):
     """
@@ -12,32 +42,14 @@ def errorHandling(code, body=None, passedComment=False):
     :param passedComment: boolean value stating whether we are passing on a comment from a different API
     :return: an HTTP formatted error message
     """
-    codes = {
-        100: 'Request body empty.',
-        101: 'Request body in incorrect format',
-        102: 'Could not find field "{}".',
-        103: 'Field "{}" is a {}, when {} was expected.',
-        104: 'Invalid Field "{}"',
-        105: 'Request type is not POST',
-        106: 'Payer card details could not be found',
-        107: 'Payee bank account details could not be found',
-        108: 'Payer personal account could not be found',
-        109: 'Payee business account details could not be found',
-        201: 'An error occurred with currency conversion.',
-        301: 'An error occurred with contacting the Payment Network Service.',
-        401: 'Could not make changes to database: {}',
-        402: 'Transaction with ID {} could not be located.',
-        403: 'Refund could not complete.',
-        404: 'Original transaction already refunded or cancelled.'
-    }
     if not passedComment:
         # should maybe be changed to display the error returned by PNS
-        if code in (102, 104, 401, 402):
-            code_body = codes[code].format(body)
+        if code in (102, 104, 110, 114, 115, 117, 118, 401, 402):
+            code_body = ERROR_CODES[code].format(body)
         elif code == 103:
-            code_body = codes[code].format(body[0], type(body[1]).__name__, body[2].__name__)
+            code_body = ERROR_CODES[code].format(body[0], type(body[1]).__name__, body[2].__name__)
         else:
-            code_body = codes[code]
+            code_body = ERROR_CODES[code]
     else:
         code_body = body
     return JsonResponse({"ErrorCode": code, "Comment": code_body}, status=400)
@@ -59,33 +71,31 @@ def checkMethod(request):
             # if data exists then return it
             return data, True
         except Exception as e:  # body is in bad format
-            return errorHandling(101, body=str(e), passedComment=True)
+            return errorHandling(101, body=str(e), passedComment=True), False
 
 
-# Checks that the fields passed to the function are correct and aren't none
-def checkBody(data, required):
+# check an upstream service's response and pass on its comment if it failed
+def readUpstream(response, code):
     """
 
-    :param data: the data passed to the endpoint
-    :param required: the fields which are required for the endpoint
-    :return: None if all fields are there and none are not null, else returns an error message
+    :param response: the response from the currency converter or the PNS
+    :param code: the error code to report if the upstream failed
+    :return: the response body or error message and then boolean indicating which it is
     """
 
-    # check body isn't empty
-    if len(data) == 0:
-        return errorHandling(100)
-
-    # check no fields are missing and that all field are the correct data type
-    for field in required:
-        if field not in data:
-            return errorHandling(102, field)
-        if not isinstance(data[field], required[field]):
-            return errorHandling(103, [field, data[field], required[field]])
-
-    # check for no addition fields in the body
-    newFields = set(required).symmetric_difference(set(data))
-    if len(newFields) != 0:
-        return errorHandling(104, list(newFields)[0])
-
-    # if here then initial validation has been passed
-    return None
+    # a gateway error page is HTML or empty rather than JSON, so a failure's body is only read for its comment
+    try:
+        responseData = response.json()
+    except ValueError:
+        responseData = None
+    if response.status_code != 200:
+        if isinstance(responseData, dict) and "Comment" in responseData:
+            error = errorHandling(code, body=responseData["Comment"], passedComment=True)
+        else:
+            error = errorHandling(code)
+        # the upstream may have acted on a request it never answered, which an idempotency key must not repeat
+        error.upstreamUnanswered = getattr(response, "unanswered", False)
+        return error, False
+    if not isinstance(responseData, dict):
+        return errorHandling(code), False
+    return responseData, True
@@ -0,0 +1,118 @@
+import csv
+import json
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import StreamingHttpResponse
+
+from cw2.error_handling import errorHandling
+from cw2.history_views import parseMoment
+from cw2.models import Transaction, TransactionStatus
+
+# defaults used when TRANSACTION_EXPORT does not override them
+DEFAULT_TRANSACTION_EXPORT = {
+    "CHUNK_SIZE": 2000,  # rows fetched from the database at a time
+}
+
+# the exported columns and the fields they are read from, names are joined in the same query
+EXPORT_COLUMNS = (("TransactionUUID", "id"), ("Date", "date"), ("Status", "transactionStatus"),
+                  ("Amount", "amount"), ("CurrencyCode", "currency"), ("PayerAccountNumber", "payer_id"),
+                  ("PayerName", "payer__fullName"), ("PayeeAccountNumber", "payee_id"),
+                  ("PayeeName", "payee__businessName"), ("OriginalTransactionUUID", "originalTransaction_id"))
+
+FORMATS = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+
+
+def getConfig():
+    return dict(DEFAULT_TRANSACTION_EXPORT, **getattr(settings, "TRANSACTION_EXPORT", {}))
+
+
+# checks the filters of an export
+def checkExportQuery(params):
+    """
+
+    :param params: the from, to, payee, status and format parameters of the export
+    :return: the parsed parameters or error message and then boolean indicating which it is
+    """
+    query = {"from": None, "to": None, "payee": None, "status": None, "format": params.get("format") or "csv"}
+
+    for field in ("from", "to"):
+        if params.get(field):
+            query[field] = parseMoment(params[field])
+            if query[field] is None:
+                return errorHandling(104, field), False
+
+    if params.get("payee"):
+        if not params["payee"].isdigit():
+            return errorHandling(104, "payee"), False
+        query["payee"] = int(params["payee"])
+
+    if params.get("status"):
+        if params["status"] not in TransactionStatus.values:
+            return errorHandling(104, "status"), False
+        query["status"] = params["status"]
+
+    if query["format"] not in FORMATS:
+        return errorHandling(104, "format"), False
+
+    return query, True
+
+
+def exportRows(query):
+    """
+
+    :param query: the parsed parameters of the export
+    :return: the matching transactions as tuples in EXPORT_COLUMNS order, oldest first, read a chunk at a time
+    """
+    transactions = Transaction.objects.all()
+    if query["from"] is not None:
+        transactions = transactions.filter(date__gte=query["from"])
+    if query["to"] is not None:
+        transactions = transactions.filter(date__lt=query["to"])
+    if query["payee"] is not None:
+        transactions = transactions.filter(payee=query["payee"])
+    if query["status"] is not None:
+        transactions = transactions.filter(transactionStatus=query["status"])
+    # iterator() skips the queryset cache, so only one chunk of rows is held at once
+    return transactions.order_by("date", "id").values_list(*(field for _, field in EXPORT_COLUMNS)) \
+        .iterator(chunk_size=getConfig()["CHUNK_SIZE"])
+
+
+class Echo:
+    # a file-like object that hands back what csv.writer writes, so each row can be yielded as it is made
+    def write(self, value):
+        return value
+
+
+def exportLines(query):
+    """
+
+    :param query: the parsed parameters of the export
+    :return: the lines of the export in the requested format, header first for CSV
+    """
+    names = [name for name, _ in EXPORT_COLUMNS]
+    if query["format"] == "csv":
+        writer = csv.writer(Echo())
+        yield writer.writerow(names)
+        for row in exportRows(query):
+            yield writer.writerow([value.isoformat() if column == "Date" else value
+                                   for column, value in zip(names, row)])
+    else:
+        for row in exportRows(query):
+            yield json.dumps({column: value.isoformat() if column == "Date" else value
+                              for column, value in zip(names, row)}) + "\n"
+
+
+@staff_member_required
+def ExportTransactions(request):
+    # streams the matching transactions as CSV or NDJSON without holding them all in memory, for finance staff only
+    if request.method != "GET":
+        return errorHandling(111)
+
+    query, queryStatus = checkExportQuery(request.GET)
+    if not queryStatus:
+        return query
+
+    response = StreamingHttpResponse(exportLines(query), content_type=FORMATS[query["format"]])
+    response["Content-Disposition"] = 'attachment; filename="transactions.{}"'.format(query["format"])
+    return response
@@ -0,0 +1,178 @@
+import base64
+import heapq
+from datetime import datetime, time
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models import Q
+from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from cw2.error_handling import errorHandling
+from cw2.models import Transaction, ArchivedTransaction
+
+# defaults used when TRANSACTION_HISTORY does not override them
+DEFAULT_TRANSACTION_HISTORY = {
+    "PAGE_SIZE": 50,
+    "MAX_PAGE_SIZE": 500,
+}
+
+HISTORY_FIELDS = ("id", "payer_id", "payee_id", "amount", "currency", "date", "transactionStatus")
+
+
+def getConfig():
+    return dict(DEFAULT_TRANSACTION_HISTORY, **getattr(settings, "TRANSACTION_HISTORY", {}))
+
+
+# account numbers are sequential, so like the export these are for staff logins only
+@staff_member_required
+def PersonalHistory(request, accountNumber):
+    return transactionHistory(request, "payer", accountNumber)
+
+
+@staff_member_required
+def BusinessHistory(request, accountNumber):
+    return transactionHistory(request, "payee", accountNumber)
+
+
+# lists one account's transactions, newest first, a page at a time
+def transactionHistory(request, side, accountNumber):
+    """
+
+    :param request: the request sent to the endpoint, with optional status, from, to, limit, cursor and archived
+        parameters
+    :param side: "payer" for a personal account, "payee" for a business account
+    :param accountNumber: the account whose transactions are listed
+    :return: a page of transactions and the cursor for the next page, or an error message
+    """
+
+    if request.method != "GET":
+        return errorHandling(111)
+
+    query, queryStatus = checkHistoryQuery(request.GET)
+    if not queryStatus:
+        return query
+
+    rows = historyRows(Transaction, side, accountNumber, query)
+    if query["archived"]:
+        # both lists are newest first, so merging them gives the page as if the tables were one
+        rows = list(heapq.merge(rows, historyRows(ArchivedTransaction, side, accountNumber, query),
+                                key=lambda row: (row["date"], row["id"]), reverse=True))[:query["limit"] + 1]
+    nextCursor = None
+    if len(rows) > query["limit"]:
+        rows = rows[:query["limit"]]
+        nextCursor = encodeCursor(rows[-1]["date"], rows[-1]["id"])
+
+    responseData = {"Transactions": [{"TransactionUUID": row["id"],
+                                      "PayerAccountNumber": row["payer_id"],
+                                      "PayeeAccountNumber": row["payee_id"],
+                                      "Amount": row["amount"],
+                                      "CurrencyCode": row["currency"],
+                                      "Date": row["date"].isoformat(),
+                                      "Status": row["transactionStatus"]}
+                                     for row in rows],
+                    "NextCursor": nextCursor,
+                    "ErrorCode": None
+                    }
+
+    return JsonResponse(responseData, status=200)
+
+
+# reads up to one more than a page of an account's transactions from one table
+def historyRows(model, side, accountNumber, query):
+    """
+
+    :param model: Transaction, or ArchivedTransaction for archived rows
+    :param side: "payer" for a personal account, "payee" for a business account
+    :param accountNumber: the account whose transactions are listed
+    :param query: the parsed query parameters
+    :return: the HISTORY_FIELDS of each row, newest first
+    """
+
+    # the filters below all lead with the account, so each page is one range scan of an index on
+    # (account, [status,] date, id)
+    transactions = model.objects.filter(**{side: accountNumber})
+    if query["status"] is not None:
+        transactions = transactions.filter(transactionStatus=query["status"])
+    if query["from"] is not None:
+        transactions = transactions.filter(date__gte=query["from"])
+    if query["to"] is not None:
+        transactions = transactions.filter(date__lt=query["to"])
+
+    # keyset pagination, carry on from the last row of the previous page rather than skipping rows with OFFSET
+    if query["cursor"] is not None:
+        cursorDate, cursorId = query["cursor"]
+        transactions = transactions.filter(Q(date__lt=cursorDate) | Q(date=cursorDate, id__lt=cursorId))
+
+    # one extra row tells us whether there is another page
+    return list(transactions.order_by("-date", "-id").values(*HISTORY_FIELDS)[:query["limit"] + 1])
+
+
+# checks the query string of a history request
+def checkHistoryQuery(params):
+    """
+
+    :param params: the query parameters sent to the endpoint
+    :return: the parsed parameters or error message and then boolean indicating which it is
+    """
+
+    config = getConfig()
+    query = {"status": params.get("status") or None, "from": None, "to": None, "cursor": None,
+             "limit": config["PAGE_SIZE"], "archived": False}
+
+    for field in ("from", "to"):
+        if params.get(field):
+            query[field] = parseMoment(params[field])
+            if query[field] is None:
+                return errorHandling(104, field), False
+
+    if params.get("limit"):
+        if not params["limit"].isdigit() or not 0 < int(params["limit"]) <= config["MAX_PAGE_SIZE"]:
+            return errorHandling(104, "limit"), False
+        query["limit"] = int(params["limit"])
+
+    # archived transactions are only read when asked for
+    if params.get("archived"):
+        if params["archived"] not in ("true", "false"):
+            return errorHandling(104, "archived"), False
+        query["archived"] = params["archived"] == "true"
+
+    if params.get("cursor"):
+        query["cursor"] = decodeCursor(params["cursor"])
+        if query["cursor"] is None:
+            return errorHandling(104, "cursor"), False
+
+    return query, True
+
+
+def parseMoment(value):
+    # accepts an ISO date, taken as midnight UTC, or an ISO datetime
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            if day is None:
+                return None
+            moment = datetime.combine(day, time.min)
+    except ValueError:
+        return None
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment, timezone.utc)
+    return moment
+
+
+def encodeCursor(date, transactionId):
+    # an opaque token holding the (date, id) of the last row on the page
+    return base64.urlsafe_b64encode("{}|{}".format(date.isoformat(), transactionId).encode()).decode()
+
+
+def decodeCursor(cursor):
+    try:
+        date, transactionId = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        date = parse_datetime(date)
+        if date is None:
+            return None
+        return date, int(transactionId)
+    except ValueError:
+        return None
@@ -0,0 +1,355 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
+
+from cw2 import timing
+from cw2.circuit_breaker import getBreaker
+
+# defaults used when UPSTREAM_HTTP does not override them
+DEFAULT_UPSTREAM_HTTP = {
+    "CONNECT_TIMEOUT": 3.05,  # seconds to establish a connection
+    "READ_TIMEOUT": 10,  # seconds to wait for the upstream to respond
+    "POOL_CONNECTIONS": 4,  # number of hosts to keep pools for
+    "POOL_MAXSIZE": 20,  # kept-alive connections per host
+    "RETRIES": 2,  # extra attempts after the first
+    "BACKOFF_FACTOR": 0.2,  # sleeps 0.2s, 0.4s, ... between attempts
+    "HEDGE_AFTER": None,  # seconds after which a request that is safe to repeat is sent again, None to never
+}
+
+DEFAULT_UPSTREAM_URLS = {
+    "CURRENCY": "http://samshepherd.eu.pythonanywhere.com/currency/",
+    "PNS": "http://samshepherd.eu.pythonanywhere.com/pns/",
+}
+
+# statuses worth retrying when the request is safe to repeat
+RETRY_STATUSES = (502, 503, 504)
+
+
+class UnavailableResponse:
+    """
+    Stands in for an upstream response when the service could not be reached or timed out. unanswered is True when
+    the request was sent but no answer came back, so the upstream may still have acted on it.
+    """
+
+    status_code = 503
+
+    def __init__(self, comment, unanswered=False):
+        self.comment = comment
+        self.unanswered = unanswered
+
+    def json(self):
+        return {"Comment": self.comment}
+
+
+# settings are read on first use rather than on every call, closeSessions makes them be read again
+_config = None
+_urls = None
+
+
+def getConfig():
+    """
+
+    :return: the upstream HTTP settings merged over their defaults
+    """
+    global _config
+    if _config is None:
+        _config = dict(DEFAULT_UPSTREAM_HTTP, **getattr(settings, "UPSTREAM_HTTP", {}))
+    return _config
+
+
+def upstreamName(service, path):
+    # the label upstream calls are timed under, e.g. "pns/initiatetransactionpns"
+    return "{}/{}".format(service.lower(), path.strip("/"))
+
+
+def getServiceUrl(service, path):
+    """
+
+    :param service: the name of the upstream service, "CURRENCY" or "PNS"
+    :param path: the endpoint path relative to the service's base url
+    :return: the full url for the endpoint
+    """
+    global _urls
+    if _urls is None:
+        _urls = dict(DEFAULT_UPSTREAM_URLS, **getattr(settings, "UPSTREAM_URLS", {}))
+    return _urls[service].rstrip("/") + "/" + path.lstrip("/")
+
+
+def makeSession(idempotent):
+    """
+
+    :param idempotent: whether requests sent through the session are safe to repeat
+    :return: a session with a kept-alive connection pool and bounded retries
+    """
+    # the client libraries are imported on first use, so they don't slow down a worker's startup and an async worker
+    # never loads requests, nor a sync one httpx
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    config = getConfig()
+    if idempotent:
+        # repeat on connection failures, read failures and gateway errors
+        retry = Retry(total=config["RETRIES"], backoff_factor=config["BACKOFF_FACTOR"],
+                      status_forcelist=RETRY_STATUSES, allowed_methods=None, raise_on_status=False)
+    else:
+        # only repeat when the request can't have reached the upstream
+        retry = Retry(total=config["RETRIES"], connect=config["RETRIES"], read=0, status=0, other=0,
+                      backoff_factor=config["BACKOFF_FACTOR"], allowed_methods=None, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=config["POOL_CONNECTIONS"], pool_maxsize=config["POOL_MAXSIZE"],
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_sessions = {}
+_sessionsPid = None
+_sessionsLock = threading.Lock()
+
+
+def getSession(idempotent):
+    """
+
+    :param idempotent: whether requests sent through the session are safe to repeat
+    :return: the process wide session for that kind of request
+    """
+    global _sessionsPid
+    # pools can't be shared with a forked parent, so each worker process builds its own
+    if _sessionsPid != os.getpid():
+        with _sessionsLock:
+            if _sessionsPid != os.getpid():
+                _sessions.clear()
+                _sessionsPid = os.getpid()
+    session = _sessions.get(idempotent)
+    if session is None:
+        with _sessionsLock:
+            session = _sessions.get(idempotent)
+            if session is None:
+                session = _sessions[idempotent] = makeSession(idempotent)
+    return session
+
+
+def closeSessions():
+    """
+    Closes every pooled connection, the next request opens new ones with the current settings.
+    """
+    global _config, _urls
+    with _sessionsLock:
+        _config = _urls = None
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def isFailure(response):
+    # what the circuit breaker counts against an upstream, None when the call raised
+    return response is None or response.status_code >= 500
+
+
+def circuitOpen(service):
+    return UnavailableResponse("{} is unavailable, not sending requests to it for now.".format(service.lower()))
+
+
+def post(service, path, idempotent=False, **kwargs):
+    """
+
+    :param service: the name of the upstream service, "CURRENCY" or "PNS"
+    :param path: the endpoint path relative to the service's base url
+    :param idempotent: whether the request can safely be sent more than once
+    :param kwargs: passed on to requests, e.g. data or json
+    :return: the upstream response, or an UnavailableResponse if it couldn't be reached in time
+    """
+    config = getConfig()
+    # fail fast while the upstream is known to be failing
+    breaker = getBreaker(service)
+    if breaker is not None and not breaker.allow():
+        return circuitOpen(service)
+
+    url = getServiceUrl(service, path)
+    response = None
+    started = time.perf_counter()
+    try:
+        if idempotent and config["HEDGE_AFTER"] is not None:
+            response = sendHedged(url, config, **kwargs)
+        else:
+            response = send(url, idempotent, config, **kwargs)
+        return response
+    finally:
+        timing.observeUpstream(upstreamName(service, path), started)
+        if breaker is not None:
+            breaker.record(isFailure(response), time.perf_counter() - started)
+
+
+def send(url, idempotent, config, **kwargs):
+    import requests
+    try:
+        return getSession(idempotent).post(url, timeout=(config["CONNECT_TIMEOUT"], config["READ_TIMEOUT"]),
+                                           **kwargs)
+    except requests.RequestException as e:
+        return UnavailableResponse(str(e), unanswered=wasUnanswered(e))
+
+
+def wasUnanswered(error):
+    # retries that run out raise a ConnectionError wrapping urllib3's error, a read timeout or a dropped connection
+    # means the request had already been sent
+    import requests
+    from urllib3.exceptions import ProtocolError, ReadTimeoutError
+    cause = error.args[0] if error.args else None
+    cause = getattr(cause, "reason", cause)
+    return isinstance(error, requests.ReadTimeout) or isinstance(cause, (ReadTimeoutError, ProtocolError))
+
+
+_hedgePool = None
+_hedgePoolPid = None
+
+
+def getHedgePool():
+    global _hedgePool, _hedgePoolPid
+    # threads don't survive a fork, so each worker process builds its own pool
+    if _hedgePoolPid != os.getpid():
+        with _sessionsLock:
+            if _hedgePoolPid != os.getpid():
+                _hedgePool = ThreadPoolExecutor(max_workers=getConfig()["POOL_MAXSIZE"])
+                _hedgePoolPid = os.getpid()
+    return _hedgePool
+
+
+def sendHedged(url, config, **kwargs):
+    """
+
+    :param url: the full url for the endpoint
+    :param config: the upstream HTTP settings
+    :param kwargs: passed on to requests, e.g. data or json
+    :return: the first good response from the request or its hedge, sent if the request is slower than HEDGE_AFTER
+    """
+    pool = getHedgePool()
+    pending = {pool.submit(send, url, True, config, **kwargs)}
+    done, pending = wait(pending, timeout=config["HEDGE_AFTER"])
+    if not done:
+        pending.add(pool.submit(send, url, True, config, **kwargs))
+    while True:
+        if not done:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        response = done.pop().result()
+        # a failure only counts once there is nothing left to wait for
+        if not isFailure(response) or not (done or pending):
+            return response
+
+
+_asyncClients = {}
+
+
+def getAsyncClient():
+    """
+
+    :return: the async client for the running event loop
+    """
+    # connections belong to the loop that opened them, so each loop gets its own client
+    loop = asyncio.get_running_loop()
+    client = _asyncClients.get(loop)
+    if client is None or client.is_closed:
+        # forget clients whose loops have finished, e.g. async views run under WSGI
+        for oldLoop in [oldLoop for oldLoop in _asyncClients if oldLoop.is_closed()]:
+            del _asyncClients[oldLoop]
+        import httpx
+        config = getConfig()
+        limits = httpx.Limits(max_connections=config["POOL_MAXSIZE"],
+                              max_keepalive_connections=config["POOL_MAXSIZE"])
+        timeout = httpx.Timeout(config["READ_TIMEOUT"], connect=config["CONNECT_TIMEOUT"])
+        # the transport only repeats failed connection attempts, which is safe for any request
+        transport = httpx.AsyncHTTPTransport(retries=config["RETRIES"], limits=limits)
+        client = _asyncClients[loop] = httpx.AsyncClient(transport=transport, timeout=timeout)
+    return client
+
+
+async def closeAsyncClient():
+    """
+    Closes the async client opened on the running event loop.
+    """
+    client = _asyncClients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def apost(service, path, idempotent=False, **kwargs):
+    """
+
+    :param service: the name of the upstream service, "CURRENCY" or "PNS"
+    :param path: the endpoint path relative to the service's base url
+    :param idempotent: whether the request can safely be sent more than once
+    :param kwargs: passed on to httpx, e.g. content, data or json
+    :return: the upstream response, or an UnavailableResponse if it couldn't be reached in time
+    """
+    config = getConfig()
+    # fail fast while the upstream is known to be failing
+    breaker = getBreaker(service)
+    if breaker is not None and not breaker.allow():
+        return circuitOpen(service)
+
+    client = getAsyncClient()
+    url = getServiceUrl(service, path)
+    # requests that are safe to repeat are also retried on read failures and gateway errors
+    attempts = config["RETRIES"] + 1 if idempotent else 1
+    response = None
+    started = time.perf_counter()
+    try:
+        if idempotent and config["HEDGE_AFTER"] is not None:
+            response = await sendHedgedAsync(client, url, attempts, config, **kwargs)
+        else:
+            response = await sendAsync(client, url, attempts, config["BACKOFF_FACTOR"], **kwargs)
+        return response
+    finally:
+        timing.observeUpstream(upstreamName(service, path), started)
+        if breaker is not None:
+            breaker.record(isFailure(response), time.perf_counter() - started)
+
+
+async def sendHedgedAsync(client, url, attempts, config, **kwargs):
+    """
+
+    :param client: the async client for the running event loop
+    :param url: the full url for the endpoint
+    :param attempts: the attempts each copy of the request may make
+    :param config: the upstream HTTP settings
+    :param kwargs: passed on to httpx, e.g. content, data or json
+    :return: the first good response from the request or its hedge, sent if the request is slower than HEDGE_AFTER
+    """
+    pending = {asyncio.ensure_future(sendAsync(client, url, attempts, config["BACKOFF_FACTOR"], **kwargs))}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=config["HEDGE_AFTER"])
+        if not done:
+            pending.add(asyncio.ensure_future(sendAsync(client, url, attempts, config["BACKOFF_FACTOR"], **kwargs)))
+        while True:
+            if not done:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            response = done.pop().result()
+            # a failure only counts once there is nothing left to wait for
+            if not isFailure(response) or not (done or pending):
+                return response
+    finally:
+        # the slower copy is no longer needed
+        for task in pending:
+            task.cancel()
+
+
+async def sendAsync(client, url, attempts, backoffFactor, **kwargs):
+    # sends the request, trying again with backoff until one attempt gets a usable response
+    import httpx
+    for attempt in range(attempts):
+        if attempt:
+            await asyncio.sleep(backoffFactor * (2 ** (attempt - 1)))
+        try:
+            response = await client.post(url, **kwargs)
+        except httpx.HTTPError as e:
+            if attempt + 1 == attempts:
+                return UnavailableResponse(str(e), unanswered=isinstance(e, (httpx.ReadTimeout, httpx.ReadError,
+                                                                             httpx.RemoteProtocolError)))
+            continue
+        if response.status_code not in RETRY_STATUSES or attempt + 1 == attempts:
+            return response
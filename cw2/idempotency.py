@@ -0,0 +1,235 @@
+import asyncio
+import functools
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.utils import timezone
+
+from cw2.error_handling import errorHandling
+from cw2.models import IdempotencyKey
+
+# defaults used when IDEMPOTENCY does not override them
+DEFAULT_IDEMPOTENCY = {
+    "HEADER": "HTTP_IDEMPOTENCY_KEY",  # the Idempotency-Key header as it appears in request.META
+    "TTL": 24 * 60 * 60,  # seconds a stored response is replayed for
+    "WAIT_TIMEOUT": 30,  # seconds a repeat waits for the first request with its key to finish
+    "LOCK_TIMEOUT": 120,  # seconds after which an unfinished first request is assumed to have died
+    "POLL_INTERVAL": 0.05,  # first wait between checks on the first request, doubling up to 1 second
+}
+
+# errors caused by an upstream turning the request down, so a retry may succeed. A 401 after the PNS has taken a
+# payment, or an upstream that never answered, may have left a charge behind, so those responses are kept
+RETRYABLE_CODES = (201, 301, 403)
+
+PROCESSING = "processing"
+COMPLETE = "complete"
+
+
+def getConfig():
+    return dict(DEFAULT_IDEMPOTENCY, **getattr(settings, "IDEMPOTENCY", {}))
+
+
+def idempotent(view):
+    """
+    Lets clients send an Idempotency-Key header so that retrying a request replays the first response instead of
+    repeating the work. Repeats that arrive while the first request is still running wait for it to finish.
+    """
+    endpoint = view.__name__
+
+    if asyncio.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            key, keyStatus = readKey(request)
+            if not keyStatus:
+                return key
+            if key is None:
+                return await view(request, *args, **kwargs)
+
+            config = getConfig()
+            requestHash = hashBody(request)
+            deadline = time.monotonic() + config["WAIT_TIMEOUT"]
+            interval = config["POLL_INTERVAL"]
+            while True:
+                claimed, response = await sync_to_async(claimKey)(endpoint, key, requestHash, config)
+                if response is not None:
+                    return response
+                if claimed:
+                    break
+                if time.monotonic() >= deadline:
+                    return errorHandling(113)
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, 1.0)
+
+            try:
+                response = await view(request, *args, **kwargs)
+            except BaseException:
+                await sync_to_async(releaseKey)(endpoint, key)
+                raise
+            await sync_to_async(storeResponse)(endpoint, key, response)
+            return response
+    else:
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key, keyStatus = readKey(request)
+            if not keyStatus:
+                return key
+            if key is None:
+                return view(request, *args, **kwargs)
+
+            config = getConfig()
+            requestHash = hashBody(request)
+            deadline = time.monotonic() + config["WAIT_TIMEOUT"]
+            interval = config["POLL_INTERVAL"]
+            while True:
+                claimed, response = claimKey(endpoint, key, requestHash, config)
+                if response is not None:
+                    return response
+                if claimed:
+                    break
+                if time.monotonic() >= deadline:
+                    return errorHandling(113)
+                time.sleep(interval)
+                interval = min(interval * 2, 1.0)
+
+            try:
+                response = view(request, *args, **kwargs)
+            except BaseException:
+                releaseKey(endpoint, key)
+                raise
+            storeResponse(endpoint, key, response)
+            return response
+
+    return wrapper
+
+
+# reads the idempotency key header
+def readKey(request):
+    """
+
+    :param request: the request sent to the endpoint
+    :return: the key, None if there isn't one, or error message and then boolean indicating which it is
+    """
+    key = request.META.get(getConfig()["HEADER"])
+    if key is None:
+        return None, True
+    if not key or len(key) > IdempotencyKey._meta.get_field("key").max_length:
+        return errorHandling(104, "Idempotency-Key"), False
+    return key, True
+
+
+def hashBody(request):
+    return hashlib.sha256(request.body).hexdigest()
+
+
+# tries to become the request that does the work for a key
+def claimKey(endpoint, key, requestHash, config):
+    """
+
+    :param endpoint: the name of the view
+    :param key: the idempotency key sent by the client
+    :param requestHash: the hash of the request body
+    :param config: the idempotency settings
+    :return: whether the key was claimed, and the response to send instead of running the view, if any
+    """
+    now = timezone.now()
+    # repeats are the common case under retry storms, so look for the key before trying to insert it
+    existing = readKeyRow(endpoint, key)
+    if existing is None:
+        try:
+            with transaction.atomic():
+                IdempotencyKey.objects.create(endpoint=endpoint, key=key, requestHash=requestHash, state=PROCESSING,
+                                              created=now, updated=now)
+            return True, None
+        except IntegrityError:
+            existing = readKeyRow(endpoint, key)
+            # the row was released between our insert and this read, so try again straight away
+            if existing is None:
+                return claimKey(endpoint, key, requestHash, config)
+
+    # stored responses expire, after which the key can be used afresh
+    if existing["state"] == COMPLETE and existing["created"] < now - timedelta(seconds=config["TTL"]):
+        IdempotencyKey.objects.filter(pk=existing["pk"], state=COMPLETE).delete()
+        return claimKey(endpoint, key, requestHash, config)
+
+    if existing["requestHash"] != requestHash:
+        return False, errorHandling(112)
+
+    if existing["state"] == COMPLETE:
+        response = HttpResponse(existing["responseBody"], status=existing["responseStatus"],
+                                content_type="application/json")
+        response["Idempotent-Replayed"] = "true"
+        return False, response
+
+    # take over from a first request that has been processing for too long to still be alive
+    stale = now - timedelta(seconds=config["LOCK_TIMEOUT"])
+    if IdempotencyKey.objects.filter(pk=existing["pk"], state=PROCESSING, updated__lt=stale).update(updated=now):
+        return True, None
+
+    return False, None
+
+
+def readKeyRow(endpoint, key):
+    return IdempotencyKey.objects.filter(endpoint=endpoint, key=key).values("pk", "requestHash", "state",
+                                                                            "responseStatus", "responseBody",
+                                                                            "created").first()
+
+
+def releaseKey(endpoint, key):
+    # the request failed without a response, so a retry should run it again
+    IdempotencyKey.objects.filter(endpoint=endpoint, key=key, state=PROCESSING).delete()
+
+
+# stores the response for a key so repeats can be answered from it
+def storeResponse(endpoint, key, response):
+    """
+
+    :param endpoint: the name of the view
+    :param key: the idempotency key sent by the client
+    :param response: the response the view returned
+    """
+    if isRetryable(response):
+        releaseKey(endpoint, key)
+        return
+    IdempotencyKey.objects.filter(endpoint=endpoint, key=key).update(state=COMPLETE,
+                                                                     responseStatus=response.status_code,
+                                                                     responseBody=response.content.decode(),
+                                                                     updated=timezone.now())
+
+
+def isRetryable(response):
+    if getattr(response, "upstreamUnanswered", False):
+        return False
+    if response.status_code >= 500:
+        return True
+    if response.status_code == 400:
+        try:
+            return json.loads(response.content).get("ErrorCode") in RETRYABLE_CODES
+        except ValueError:
+            return False
+    return False
+
+
+# deletes the keys whose responses have expired, since most keys are never sent again to be expired by claimKey
+def purgeExpiredKeys(config, batchSize, now=None):
+    """
+
+    :param config: the idempotency settings
+    :param batchSize: the most keys deleted per query
+    :param now: the time the ages are measured from, defaults to now
+    :return: the number of keys deleted
+    """
+    now = now or timezone.now()
+    # a key still processing this long after it was created belongs to a request that died long ago
+    expired = IdempotencyKey.objects.filter(created__lt=now - timedelta(seconds=config["TTL"])).order_by("created")
+    deleted = 0
+    while True:
+        ids = list(expired.values_list("pk", flat=True)[:batchSize])
+        if not ids:
+            return deleted
+        deleted += IdempotencyKey.objects.filter(pk__in=ids).delete()[0]
@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from cw2.archive import getConfig, archivable, archiveBatch
+
+
+class Command(BaseCommand):
+    help = ("Moves finished transactions out of the transaction table into the archive, a batch per database "
+            "transaction. Defaults come from TRANSACTION_ARCHIVE.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--complete-after-days", type=int, help="age at which completed payments are archived")
+        parser.add_argument("--finished-after-days", type=int,
+                            help="age at which cancelled and refunded payments are archived")
+        parser.add_argument("--batch-size", type=int, help="transactions moved per database transaction")
+        parser.add_argument("--pause", type=float, help="seconds to wait between batches")
+
+    def handle(self, *args, **options):
+        config = getConfig()
+        for option in ("complete_after_days", "finished_after_days", "batch_size", "pause"):
+            if options[option] is not None:
+                config[option.upper()] = options[option]
+
+        for name, candidates in archivable(config):
+            started = time.perf_counter()
+            count = 0
+            while True:
+                moved = archiveBatch(candidates, config["BATCH_SIZE"])
+                if not moved:
+                    break
+                count += moved
+                time.sleep(config["PAUSE"])
+            self.stdout.write("{}: archived {} transactions in {:.1f}s".format(name, count,
+                                                                             time.perf_counter() - started))
@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.db.transaction import atomic
+
+from cw2.models import PaymentDetails, cardFingerprint
+
+
+class Command(BaseCommand):
+    help = ("Adds the card fingerprint column to a database created before it existed and fills it in for every "
+            "card. Run it again after changing CARD_FINGERPRINT_KEY, with --all.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=10000, help="cards updated per transaction")
+        parser.add_argument("--all", action="store_true", help="recompute fingerprints that are already set")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        # fingerprints are unique, so a card stored twice has to be resolved by hand first
+        duplicates = PaymentDetails.objects.values("cardNumber").annotate(cards=Count("paymentId")) \
+            .filter(cards__gt=1).values_list("cards", flat=True)
+        if duplicates:
+            raise CommandError("{} card numbers are stored more than once, each must belong to one payment ID"
+                               .format(len(duplicates)))
+        field = PaymentDetails._meta.get_field("cardFingerprint")
+        with connection.cursor() as cursor:
+            columns = [column.name for column in
+                       connection.introspection.get_table_description(cursor, PaymentDetails._meta.db_table)]
+        if field.column not in columns:
+            # there are no migrations, so the column and its unique index are added here
+            with connection.schema_editor() as editor:
+                editor.add_field(PaymentDetails, field)
+            self.stdout.write("Added {}.{}".format(PaymentDetails._meta.db_table, field.column))
+
+        cards = PaymentDetails.objects.order_by("paymentId")
+        if not options["all"]:
+            cards = cards.filter(cardFingerprint__isnull=True)
+        # walking the primary key keeps each query to one chunk however many cards there are
+        count = 0
+        last = None
+        while True:
+            chunk = cards if last is None else cards.filter(paymentId__gt=last)
+            chunk = list(chunk.only("paymentId", "cardNumber")[:options["chunk_size"]])
+            if not chunk:
+                break
+            for card in chunk:
+                card.cardFingerprint = cardFingerprint(card.cardNumber)
+            with atomic():
+                PaymentDetails.objects.bulk_update(chunk, ["cardFingerprint"])
+            count += len(chunk)
+            last = chunk[-1].paymentId
+        self.stdout.write("Fingerprinted {} cards in {:.1f}s".format(count, time.perf_counter() - started))
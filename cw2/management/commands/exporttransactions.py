@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cw2.export import checkExportQuery, exportLines
+
+
+class Command(BaseCommand):
+    help = "Writes transactions joined with payer and payee names as CSV or NDJSON, a chunk of rows at a time."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", help="ISO date or datetime of the first transaction")
+        parser.add_argument("--to", help="ISO date or datetime before which transactions end")
+        parser.add_argument("--payee", help="only transactions paid to this business account")
+        parser.add_argument("--status", help="only transactions with this status, e.g. Complete")
+        parser.add_argument("--format", default="csv", help="csv or ndjson")
+        parser.add_argument("--output", help="file to write to, defaults to standard output")
+
+    def handle(self, *args, **options):
+        query, queryStatus = checkExportQuery({field: options[field] for field in ("from", "to", "payee", "status",
+                                                                                   "format")})
+        if not queryStatus:
+            raise CommandError(query.content.decode())
+
+        if options["output"] is None:
+            for line in exportLines(query):
+                self.stdout.write(line, ending="")
+            return
+        with open(options["output"], "w", newline="") as output:
+            output.writelines(exportLines(query))
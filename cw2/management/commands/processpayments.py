@@ -0,0 +1,37 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from cw2.payment_queue import getConfig
+from cw2.payment_worker import work
+
+
+class Command(BaseCommand):
+    help = "Sends payments accepted with 202 to the currency converter and the PNS, using a pool of worker threads."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, help="worker threads, defaults to PAYMENT_QUEUE['WORKERS']")
+        parser.add_argument("--once", action="store_true", help="exit once the queue is empty")
+
+    def handle(self, *args, **options):
+        config = getConfig()
+        workers = options["workers"] or config["WORKERS"]
+        stopping = threading.Event()
+
+        # finish the payments in hand and then exit when asked to stop
+        def stop(signum, frame):
+            stopping.set()
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+
+        threads = [threading.Thread(target=work, args=(stopping, config, options["once"]), daemon=True)
+                   for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        self.stdout.write("Processing payments with {} workers".format(workers))
+
+        # join with a timeout so the signal handlers still run on the main thread
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
@@ -0,0 +1,18 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from cw2.idempotency import getConfig, purgeExpiredKeys
+
+
+class Command(BaseCommand):
+    help = ("Deletes the Idempotency-Key rows whose responses are older than IDEMPOTENCY's TTL and so are no longer "
+            "replayed. Run it periodically, e.g. from cron, or the table keeps every key ever sent.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="keys deleted per query")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        deleted = purgeExpiredKeys(getConfig(), options["batch_size"])
+        self.stdout.write("Purged {} idempotency keys in {:.1f}s".format(deleted, time.perf_counter() - started))
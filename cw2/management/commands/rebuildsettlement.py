@@ -0,0 +1,50 @@
+import itertools
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from django.db.transaction import atomic
+
+from cw2.models import Transaction, TransactionStatus, ArchivedTransaction, SettlementSummary, RefundEntry, \
+    RefundState
+from cw2.settlement import STATUS_FIELDS, toMinorUnits, dayOf
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the settlement summaries from the transaction table, e.g. after loading transactions in bulk. "
+            "Payments made while it runs may be missed, so run it while the API is stopped.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=10000, help="transactions read per query")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        # each amount is converted on its own, as it was when the payment was recorded, so the totals match
+        totals = {}
+        # what has been refunded so far of each payment that is still complete, refunded in part
+        partlyRefunded = dict(RefundEntry.objects.filter(state=RefundState.COMPLETE).values("payment_id")
+                              .annotate(total=Sum("amount")).order_by().values_list("payment_id", "total"))
+        # archived payments are still settled
+        payments = itertools.chain.from_iterable(
+            model.objects.filter(transactionStatus__in=STATUS_FIELDS)
+            .values_list("id", "payee_id", "currency", "date", "transactionStatus", "amount")
+            .iterator(chunk_size=options["chunk_size"])
+            for model in (Transaction, ArchivedTransaction))
+        for paymentId, payeeId, currency, date, status, amount in payments:
+            countField, amountField = STATUS_FIELDS[status]
+            summary = totals.setdefault((payeeId, currency, dayOf(date)), {})
+            summary[countField] = summary.get(countField, 0) + 1
+            amount = toMinorUnits(amount, currency)
+            if status == TransactionStatus.COMPLETE and paymentId in partlyRefunded:
+                summary["refundedAmount"] = summary.get("refundedAmount", 0) + partlyRefunded[paymentId]
+                amount -= partlyRefunded[paymentId]
+            summary[amountField] = summary.get(amountField, 0) + amount
+
+        with atomic():
+            SettlementSummary.objects.all().delete()
+            SettlementSummary.objects.bulk_create((SettlementSummary(payee_id=payeeId, currency=currency, day=day,
+                                                                     **summary)
+                                                   for (payeeId, currency, day), summary in totals.items()),
+                                                  batch_size=options["chunk_size"])
+        self.stdout.write("Rebuilt {} settlement summaries in {:.1f}s".format(len(totals),
+                                                                             time.perf_counter() - started))
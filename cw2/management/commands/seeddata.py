@@ -0,0 +1,161 @@
+import bisect
+import itertools
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from cw2.models import Transaction, TransactionStatus, PersonalAccount, BusinessAccount, PaymentDetails, BankDetails, \
+    RefundEntry, RefundState, cardFingerprint
+from cw2.seed_data import BUSINESS_OFFSET, EXPIRY, cardNumber, cvv, sortCode, personName, personEmail, businessName
+from cw2.settlement import toMinorUnits
+
+# payee currencies and how often each is used
+CURRENCIES = (("GBP", 0.6), ("EUR", 0.25), ("USD", 0.15))
+
+
+class Command(BaseCommand):
+    help = ("Fills an empty database with personal and business accounts and a history of transactions between "
+            "them, then builds their settlement summaries. The same arguments always produce the same rows.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--accounts", type=int, default=10000, help="personal accounts, each with a card")
+        parser.add_argument("--businesses", type=int, default=100, help="business accounts")
+        parser.add_argument("--transactions", type=int, default=100000,
+                            help="payments, numbered from 1 like PNS transaction IDs")
+        parser.add_argument("--days", type=int, default=365, help="days the payments are spread over")
+        parser.add_argument("--until", type=datetime.fromisoformat,
+                            default=datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0),
+                            help="ISO date the payments end on, defaults to today")
+        parser.add_argument("--payee-skew", type=float, default=1.1,
+                            help="Zipf exponent of payments per business, higher means fewer busier businesses")
+        parser.add_argument("--refund-rate", type=float, default=0.03, help="fraction of payments refunded")
+        parser.add_argument("--cancel-rate", type=float, default=0.02, help="fraction of payments cancelled")
+        parser.add_argument("--chunk-size", type=int, default=20000, help="rows per transaction")
+        parser.add_argument("--seed", type=int, default=0, help="seeds every random choice")
+
+    def handle(self, *args, **options):
+        accounts = options["accounts"]
+        businesses = options["businesses"]
+        if not 0 < accounts <= BUSINESS_OFFSET or not 0 < businesses <= BUSINESS_OFFSET:
+            raise CommandError("--accounts and --businesses must be between 1 and {}".format(BUSINESS_OFFSET))
+
+        call_command("migrate", run_syncdb=True, verbosity=0)
+        if PaymentDetails.objects.exists() or Transaction.objects.exists():
+            raise CommandError("The database already has accounts or transactions, empty it first with flush")
+
+        if connection.vendor == "sqlite":
+            # nothing is lost if a seed is interrupted, so skip syncing every commit to disk
+            with connection.cursor() as cursor:
+                cursor.execute("PRAGMA synchronous = OFF")
+
+        generator = random.Random(options["seed"])
+        chunkSize = options["chunk_size"]
+        until = options["until"] if options["until"].tzinfo else options["until"].replace(tzinfo=timezone.utc)
+
+        self.insert(PaymentDetails, itertools.chain(
+            (PaymentDetails(paymentId=index, cardNumber=cardNumber(index), securityCode=cvv(index), expiryDate=EXPIRY,
+                            cardFingerprint=cardFingerprint(cardNumber(index)))
+             for index in itertools.chain(range(accounts), range(BUSINESS_OFFSET, BUSINESS_OFFSET + businesses)))),
+                    chunkSize)
+        self.insert(BankDetails, itertools.chain(
+            (BankDetails(accountNumber=index, sortCode=sortCode(index), accountName=personName(index))
+             for index in range(accounts)),
+            (BankDetails(accountNumber=BUSINESS_OFFSET + index, sortCode=sortCode(BUSINESS_OFFSET + index),
+                         accountName=businessName(index))
+             for index in range(businesses))), chunkSize)
+        self.insert(PersonalAccount, (PersonalAccount(accountNumber=index, paymentDetails_id=index,
+                                                      bankDetails_id=index, email=personEmail(index), password="",
+                                                      phoneNumber="", fullName=personName(index))
+                                      for index in range(accounts)), chunkSize)
+        self.insert(BusinessAccount, (BusinessAccount(accountNumber=BUSINESS_OFFSET + index,
+                                                      paymentDetails_id=BUSINESS_OFFSET + index,
+                                                      bankDetails_id=BUSINESS_OFFSET + index, businessNumber=index,
+                                                      businessName=businessName(index), businessEmail="",
+                                                      businessPhoneNumber="")
+                                      for index in range(businesses)), chunkSize)
+
+        refunds = []
+        self.insert(Transaction, self.payments(generator, options, until, refunds), chunkSize)
+        # each refund is in full, so the ledger has one complete entry per refunded payment, and each refund takes its
+        # entry's ID negated as the API would give it
+        self.insert(RefundEntry, (RefundEntry(id=number, payment_id=payment.id, refund_id=-number,
+                                              amount=toMinorUnits(payment.amount, payment.currency),
+                                              state=RefundState.COMPLETE, created=date)
+                                  for number, (payment, date) in enumerate(refunds, 1)), chunkSize)
+        self.insert(Transaction, (Transaction(id=-number, payer_id=payment.payer_id,
+                                              payee_id=payment.payee_id, amount=payment.amount,
+                                              currency=payment.currency, date=date,
+                                              transactionStatus=TransactionStatus.REFUND,
+                                              originalTransaction_id=payment.id)
+                                  for number, (payment, date) in enumerate(refunds, 1)), chunkSize)
+
+        # the entries were given their IDs, so the database must carry on numbering after them
+        with connection.cursor() as cursor:
+            for statement in connection.ops.sequence_reset_sql(no_style(), [RefundEntry]):
+                cursor.execute(statement)
+
+        # the settlement totals are kept up to date by the API, which the seeded rows never went through
+        call_command("rebuildsettlement", chunk_size=chunkSize, stdout=self.stdout)
+
+    def payments(self, generator, options, until, refunds):
+        """
+
+        :param generator: the seeded random number generator
+        :param options: the command's options
+        :param until: when the last payment is made
+        :param refunds: filled with each refunded payment and the date of its refund
+        :return: the payments, with IDs and dates both increasing
+        """
+        accounts = options["accounts"]
+        total = options["transactions"]
+        span = timedelta(days=options["days"]).total_seconds()
+        start = until - timedelta(seconds=span)
+        # a few businesses take most of the payments
+        payeeWeights = list(itertools.accumulate(1 / (rank + 1) ** options["payee_skew"]
+                                                 for rank in range(options["businesses"])))
+        currencies = [currency for currency, _ in CURRENCIES]
+        currencyWeights = list(itertools.accumulate(weight for _, weight in CURRENCIES))
+        cancelRate = options["cancel_rate"]
+        refundRate = cancelRate + options["refund_rate"]
+
+        for transactionId in range(1, total + 1):
+            date = start + timedelta(seconds=span * (transactionId - 1 + generator.random()) / total)
+            payment = Transaction(id=transactionId, payer_id=generator.randrange(accounts),
+                                  payee_id=BUSINESS_OFFSET + bisect.bisect(payeeWeights,
+                                                                           generator.random() * payeeWeights[-1]),
+                                  # most payments are small with a long tail of larger ones
+                                  amount=round(generator.lognormvariate(3.0, 1.0), 2),
+                                  currency=currencies[bisect.bisect(currencyWeights,
+                                                                    generator.random() * currencyWeights[-1])],
+                                  date=date, transactionStatus=TransactionStatus.COMPLETE)
+            outcome = generator.random()
+            if outcome < cancelRate:
+                payment.transactionStatus = TransactionStatus.CANCELLED
+            elif outcome < refundRate:
+                payment.transactionStatus = TransactionStatus.REFUNDED
+                refunds.append((payment, min(until, date + timedelta(days=generator.uniform(0, 30)))))
+            yield payment
+
+    def insert(self, model, rows, chunkSize):
+        """
+
+        :param model: the model the rows are instances of
+        :param rows: an iterable of unsaved instances, only one chunk of which is held in memory at a time
+        :param chunkSize: rows inserted per transaction
+        """
+        started = time.perf_counter()
+        count = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunkSize))
+            if not chunk:
+                break
+            with transaction.atomic():
+                model.objects.bulk_create(chunk, batch_size=chunkSize)
+            count += len(chunk)
+        self.stdout.write("{}: {} rows in {:.1f}s".format(model.__name__, count, time.perf_counter() - started))
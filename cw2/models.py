@@ -1,4 +1,8 @@
+import uuid
+
+from django.conf import settings
 from django.db import models
+from django.utils.crypto import salted_hmac
 
 
 # PAYMENT PROVIDERS
@@ -23,14 +27,128 @@ class BusinessAccount(models.Model):
     businessPhoneNumber = models.TextField(max_length=13)
 
 
+class TransactionStatus(models.TextChoices):
+    INITIATED = 'Initiated'
+    COMPLETE = 'Complete'
+    REFUNDED = 'Refunded'
+    CANCELLED = 'Cancelled'
+    REFUND = 'Refund'  # the row recording a refund of another transaction
+
+
 class Transaction(models.Model):
+    # payments keep the ID the PNS gave them and refunds take their ledger entry's ID negated, so the two never meet
+    id = models.IntegerField(primary_key=True)
+    payer = models.ForeignKey('PersonalAccount', on_delete=models.CASCADE)
+    payee = models.ForeignKey('BusinessAccount', on_delete=models.CASCADE)
+    amount = models.FloatField()
+    currency = models.TextField()
+    date = models.DateTimeField()
+    transactionStatus = models.CharField(max_length=16, choices=TransactionStatus.choices, db_index=True)
+    originalTransaction = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE,
+                                            related_name='refunds')
+
+    class Meta:
+        # history pages walk (date, id) backwards for one account, optionally for one status, and exports walk it
+        # forwards over a date range
+        indexes = [models.Index(fields=['date', 'id'], name='transaction_date_idx'),
+                   models.Index(fields=['payer', 'date', 'id'], name='transaction_payer_date_idx'),
+                   models.Index(fields=['payee', 'date', 'id'], name='transaction_payee_date_idx'),
+                   models.Index(fields=['payer', 'transactionStatus', 'date', 'id'],
+                                name='transaction_payer_status_idx'),
+                   models.Index(fields=['payee', 'transactionStatus', 'date', 'id'],
+                                name='transaction_payee_status_idx')]
+
+
+class RefundState(models.TextChoices):
+    PENDING = 'Pending'  # claimed before the PNS is asked, so the amount can't be refunded twice
+    COMPLETE = 'Complete'
+
+
+class RefundEntry(models.Model):
+    # one refund of all or part of a payment, amounts are in minor units of the payment's currency
+    # both links are kept when the transactions are archived, since they keep their IDs
+    payment = models.ForeignKey('Transaction', on_delete=models.DO_NOTHING, db_constraint=False,
+                                related_name='refundEntries')
+    refund = models.ForeignKey('Transaction', null=True, on_delete=models.DO_NOTHING, db_constraint=False,
+                               related_name='+')
+    amount = models.BigIntegerField()
+    state = models.CharField(max_length=16, choices=RefundState.choices)
+    created = models.DateTimeField()
+
+    class Meta:
+        # the amount left to refund is a sum over one payment's entries, read from the index alone
+        indexes = [models.Index(fields=['payment', 'state', 'amount'], name='refund_entry_payment_idx')]
+
+
+class ArchivedTransaction(models.Model):
+    # a finished transaction moved out of Transaction by "manage.py archivetransactions", under the same ID
     id = models.IntegerField(primary_key=True)
     payer = models.ForeignKey('PersonalAccount', on_delete=models.CASCADE)
     payee = models.ForeignKey('BusinessAccount', on_delete=models.CASCADE)
     amount = models.FloatField()
     currency = models.TextField()
     date = models.DateTimeField()
-    transactionStatus = models.TextField()  # initiated, completed, refunded, cancelled
+    transactionStatus = models.CharField(max_length=16, choices=TransactionStatus.choices)
+    originalTransaction = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE,
+                                            related_name='refunds')
+    archived = models.DateTimeField()
+
+    class Meta:
+        # only read by account history that asks for archived rows, walking (date, id) backwards
+        indexes = [models.Index(fields=['payer', 'date', 'id'], name='archived_payer_date_idx'),
+                   models.Index(fields=['payee', 'date', 'id'], name='archived_payee_date_idx')]
+
+
+class SettlementSummary(models.Model):
+    # totals of one payee's payments in one currency made on one day, split by what has since happened to them
+    payee = models.ForeignKey('BusinessAccount', on_delete=models.CASCADE)
+    currency = models.CharField(max_length=8)
+    day = models.DateField()
+    # amounts are in minor units, e.g. pence, so sums are exact
+    completedCount = models.IntegerField(default=0)
+    completedAmount = models.BigIntegerField(default=0)
+    refundedCount = models.IntegerField(default=0)
+    refundedAmount = models.BigIntegerField(default=0)
+    cancelledCount = models.IntegerField(default=0)
+    cancelledAmount = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['payee', 'day', 'currency'], name='settlement_payee_day_unique')]
+
+
+class QueueState(models.TextChoices):
+    QUEUED = 'Queued'
+    PROCESSING = 'Processing'  # converting the currency
+    SENDING = 'Sending'  # waiting on the PNS
+    COMPLETE = 'Complete'
+    FAILED = 'Failed'
+
+
+class QueuedPayment(models.Model):
+    # a payment accepted with 202 and waiting for a processpayments worker
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    payer = models.ForeignKey('PersonalAccount', on_delete=models.CASCADE)
+    payee = models.ForeignKey('BusinessAccount', on_delete=models.CASCADE)
+    # the validated request with the card number and CVV encrypted, cleared once the payment has finished
+    body = models.TextField()
+    state = models.CharField(max_length=16, choices=QueueState.choices)
+    attempts = models.IntegerField(default=0)
+    available = models.DateTimeField()  # when it may next be claimed, or when a worker's lease runs out
+    # kept when the transaction is archived, since it keeps its ID
+    transaction = models.ForeignKey('Transaction', null=True, on_delete=models.DO_NOTHING, db_constraint=False)
+    result = models.TextField(null=True)  # the response body InitiatePayment would have returned
+    created = models.DateTimeField()
+    updated = models.DateTimeField()
+
+    class Meta:
+        # workers look for the oldest claimable payments of each state
+        indexes = [models.Index(fields=['state', 'available'], name='queued_payment_state_idx')]
+
+
+def cardFingerprint(cardNumber):
+    # a keyed hash, so cards can be indexed and matched without the number itself being searched or revealed
+    secret = getattr(settings, "CARD_FINGERPRINT_KEY", None) or settings.SECRET_KEY
+    return salted_hmac("cw2.card_fingerprint", cardNumber, secret=secret, algorithm="sha256").hexdigest()
 
 
 class PaymentDetails(models.Model):
@@ -38,9 +156,35 @@ class PaymentDetails(models.Model):
     cardNumber = models.TextField()
     securityCode = models.TextField()
     expiryDate = models.DateTimeField()
+    # payer resolution looks cards up by this alone, set on save and by "manage.py backfillfingerprints"
+    cardFingerprint = models.CharField(max_length=64, unique=True, null=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        self.cardFingerprint = cardFingerprint(self.cardNumber)
+        super().save(*args, **kwargs)
 
 
 class BankDetails(models.Model):
     accountNumber = models.IntegerField(primary_key=True)
     sortCode = models.TextField()
     accountName = models.TextField()
+
+    class Meta:
+        # payee resolution filters on account number and sort code together
+        indexes = [models.Index(fields=['accountNumber', 'sortCode'], name='bank_account_sort_idx')]
+
+
+class IdempotencyKey(models.Model):
+    endpoint = models.CharField(max_length=64)
+    key = models.CharField(max_length=255)
+    requestHash = models.CharField(max_length=64)
+    state = models.CharField(max_length=10)  # processing, complete
+    responseStatus = models.IntegerField(null=True)
+    responseBody = models.TextField(null=True)
+    created = models.DateTimeField()
+    updated = models.DateTimeField()
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['endpoint', 'key'], name='idempotency_endpoint_key_unique')]
+        # expired keys are purged oldest first
+        indexes = [models.Index(fields=['created'], name='idempotency_created_idx')]
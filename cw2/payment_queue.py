@@ -0,0 +1,134 @@
+import base64
+import json
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+
+from cw2.error_handling import errorHandling
+from cw2.models import QueuedPayment, QueueState, cardFingerprint
+
+# defaults used when PAYMENT_QUEUE does not override them
+DEFAULT_PAYMENT_QUEUE = {
+    "ENABLED": False,  # only turn on where processpayments workers are running
+    "WORKERS": 4,  # worker threads started by processpayments
+    "POLL_INTERVAL": 1.0,  # seconds an idle worker waits before looking for work again
+    "LEASE": 60,  # seconds a worker has to finish a payment before another may take it over
+    "MAX_ATTEMPTS": 5,  # currency conversions tried before a payment is failed
+    "RETRY_DELAY": 2.0,  # seconds before the first retry, doubling with each attempt
+    "CARD_KEY": None,  # Fernet key queued card numbers and CVVs are encrypted with, None to derive it from SECRET_KEY
+}
+
+# clients opt in to the queue per request with this Prefer header value (RFC 7240)
+RESPOND_ASYNC = "respond-async"
+
+# the fields of the validated body the worker needs to make the payment, with dates sent as strings
+QUEUED_FIELDS = ("Expiry", "CardHolderName", "CardHolderAddress", "PayeeBankAccNum", "PayeeBankSortCode", "Amount",
+                 "PayerCurrencyCode", "PayeeCurrencyCode")
+
+# the fields that are only ever stored encrypted, the card itself is otherwise known by its fingerprint
+CARD_FIELDS = ("CardNumber", "CVV")
+
+
+def getConfig():
+    return dict(DEFAULT_PAYMENT_QUEUE, **getattr(settings, "PAYMENT_QUEUE", {}))
+
+
+def cardCipher():
+    """
+
+    :return: the Fernet cipher queued card details are encrypted with
+    """
+    # imported on first use, like the HTTP clients, so workers that never queue payments don't load it
+    from cryptography.fernet import Fernet
+    key = getConfig()["CARD_KEY"]
+    if key is None:
+        key = base64.urlsafe_b64encode(salted_hmac("cw2.queued_card", "", secret=settings.SECRET_KEY,
+                                                   algorithm="sha256").digest())
+    return Fernet(key)
+
+
+# builds what is stored for a queued payment, with the card number and CVV encrypted
+def queuedBody(data):
+    """
+
+    :param data: the validated payment body
+    :return: the text stored in QueuedPayment.body
+    """
+    body = {field: str(data[field]) if field == "Expiry" else data[field] for field in QUEUED_FIELDS}
+    body["CardFingerprint"] = cardFingerprint(data["CardNumber"])
+    body["Card"] = cardCipher().encrypt(json.dumps({field: data[field] for field in CARD_FIELDS}).encode()).decode()
+    return json.dumps(body)
+
+
+def readQueuedBody(body):
+    """
+
+    :param body: the text stored in QueuedPayment.body
+    :return: the fields the worker needs to make the payment, with the card number and CVV decrypted
+    """
+    data = json.loads(body)
+    # payments queued before card details were encrypted still hold them in the clear
+    if "Card" in data:
+        data.update(json.loads(cardCipher().decrypt(data.pop("Card").encode())))
+    return data
+
+
+def wantsQueue(request):
+    # the client must ask for it and the deployment must be running workers
+    prefer = request.META.get("HTTP_PREFER", "")
+    return RESPOND_ASYNC in (value.strip() for value in prefer.split(",")) and getConfig()["ENABLED"]
+
+
+# stores a validated payment for a worker to send to the upstreams
+def queuePayment(data, payerData, businessData):
+    """
+
+    :param data: the validated payment body
+    :param payerData: the resolved payer account
+    :param businessData: the resolved payee account
+    :return: an HTTP formatted response for the client
+    """
+    now = timezone.now()
+    try:
+        payment = QueuedPayment.objects.create(payer_id=payerData["accountNumber"],
+                                               payee_id=businessData["accountNumber"],
+                                               body=queuedBody(data),
+                                               state=QueueState.QUEUED, available=now, created=now, updated=now)
+    except Exception as e:
+        return errorHandling(401, str(e))
+
+    response = JsonResponse(paymentStatusData(payment), status=202)
+    response["Location"] = "/payments/{}/".format(payment.id)
+    return response
+
+
+def PaymentStatus(request, paymentId):
+    # lets clients poll a queued payment for its result
+    if request.method != "GET":
+        return errorHandling(111)
+
+    payment = QueuedPayment.objects.filter(id=paymentId).only("id", "state", "transaction_id", "result").first()
+    if payment is None:
+        return errorHandling(114, paymentId)
+
+    return JsonResponse(paymentStatusData(payment), status=200)
+
+
+def paymentStatusData(payment):
+    """
+
+    :param payment: a queued payment
+    :return: the body describing its progress to the client
+    """
+    responseData = {"PaymentUUID": str(payment.id),
+                    "Status": payment.state,
+                    "TransactionUUID": payment.transaction_id,
+                    "ErrorCode": None,
+                    "Comment": "Payment accepted for processing"
+                    }
+    # the final response of a finished payment, as InitiatePayment would have returned it
+    if payment.result:
+        responseData.update(json.loads(payment.result))
+    return responseData
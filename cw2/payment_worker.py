@@ -0,0 +1,110 @@
+from datetime import timedelta
+
+from django.db import connection
+from django.utils import timezone
+
+from cw2.error_handling import errorHandling, readUpstream
+from cw2.models import QueuedPayment, QueueState
+from cw2.payment_queue import readQueuedBody
+from cw2.views import paymentCurrencyData, paymentPNSData, storePayment, ConvertCurrency, RequestTransactionPNS
+
+
+# takes the oldest payment that is ready to be sent, or whose worker has stopped renewing its lease
+def claimPayment(config):
+    """
+
+    :param config: the queue settings
+    :return: the claimed payment, or None if there is nothing to do
+    """
+    now = timezone.now()
+    # a payment still processing once its lease has run out belongs to a worker that died
+    ready = QueuedPayment.objects.filter(state__in=(QueueState.QUEUED, QueueState.PROCESSING), available__lte=now)
+    # other workers may take the same candidate first, in which case the conditional update changes nothing
+    for candidate in ready.order_by("available").values("id", "state", "attempts")[:10]:
+        claimed = QueuedPayment.objects.filter(id=candidate["id"], state=candidate["state"],
+                                               attempts=candidate["attempts"], available__lte=now) \
+            .update(state=QueueState.PROCESSING, attempts=candidate["attempts"] + 1,
+                    available=now + timedelta(seconds=config["LEASE"]), updated=now)
+        if claimed:
+            return QueuedPayment.objects.get(id=candidate["id"])
+
+    # a worker died while waiting on the PNS, which may or may not have taken the payment, so it isn't sent again
+    for payment in QueuedPayment.objects.filter(state=QueueState.SENDING, available__lte=now).only("id", "attempts"):
+        finishPayment(payment, errorHandling(301), state=QueueState.SENDING)
+    return None
+
+
+# sends a claimed payment to the currency converter and the PNS and records the result
+def processPayment(payment, config):
+    """
+
+    :param payment: a payment claimed by claimPayment
+    :param config: the queue settings
+    """
+    data = readQueuedBody(payment.body)
+    currencyResponseData, currencyStatus = readUpstream(ConvertCurrency(paymentCurrencyData(data)), 201)
+    if not currencyStatus:
+        # nothing has been charged yet, so the conversion can be tried again later
+        if payment.attempts < config["MAX_ATTEMPTS"]:
+            delay = config["RETRY_DELAY"] * 2 ** (payment.attempts - 1)
+            QueuedPayment.objects.filter(id=payment.id, attempts=payment.attempts, state=QueueState.PROCESSING) \
+                .update(state=QueueState.QUEUED, available=timezone.now() + timedelta(seconds=delay),
+                        updated=timezone.now())
+            return
+        return finishPayment(payment, currencyResponseData)
+
+    # the PNS may have taken the payment even if its reply was lost, so from here on it is never retried, and the
+    # lease starts again so the PNS call gets all of it whatever the conversion took
+    if not QueuedPayment.objects.filter(id=payment.id, attempts=payment.attempts, state=QueueState.PROCESSING) \
+            .update(state=QueueState.SENDING, available=timezone.now() + timedelta(seconds=config["LEASE"]),
+                    updated=timezone.now()):
+        return
+    transactionResponse = RequestTransactionPNS(paymentPNSData(data, currencyResponseData["Amount"]))
+    transactionResponseData, transactionStatus = readUpstream(transactionResponse, 301)
+    if not transactionStatus:
+        return finishPayment(payment, transactionResponseData)
+
+    response = storePayment(data, {"accountNumber": payment.payer_id}, {"accountNumber": payment.payee_id},
+                            transactionResponseData["TransactionUUID"], currencyResponseData["Amount"])
+    transactionId = transactionResponseData["TransactionUUID"] if response.status_code == 200 else None
+    finishPayment(payment, response, transactionId)
+
+
+def finishPayment(payment, response, transactionId=None, state=None):
+    """
+
+    :param payment: the payment that has finished
+    :param response: the response InitiatePayment would have returned for it
+    :param transactionId: the ID of the stored transaction, if it succeeded
+    :param state: the state the payment must still be in, defaults to either state a worker holds it in
+    """
+    states = (QueueState.PROCESSING, QueueState.SENDING) if state is None else (state,)
+    # the card details are only needed until the PNS has been contacted
+    QueuedPayment.objects.filter(id=payment.id, attempts=payment.attempts, state__in=states) \
+        .update(state=QueueState.COMPLETE if response.status_code == 200 else QueueState.FAILED,
+                transaction_id=transactionId, result=response.content.decode(), body="", updated=timezone.now())
+
+
+# processes payments until told to stop
+def work(stopping, config, once=False):
+    """
+
+    :param stopping: a threading.Event set when the worker should exit
+    :param config: the queue settings
+    :param once: exit as soon as the queue is empty rather than waiting for more payments
+    """
+    try:
+        while not stopping.is_set():
+            payment = claimPayment(config)
+            if payment is None:
+                if once:
+                    return
+                stopping.wait(config["POLL_INTERVAL"])
+                continue
+            try:
+                processPayment(payment, config)
+            except Exception as e:
+                finishPayment(payment, errorHandling(401, str(e)))
+    finally:
+        # each worker thread has its own database connection
+        connection.close()
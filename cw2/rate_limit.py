@@ -0,0 +1,252 @@
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.decorators import sync_and_async_middleware
+
+from cw2.error_handling import errorHandling
+from cw2.models import cardFingerprint
+
+# defaults used when RATE_LIMIT does not override them
+DEFAULT_RATE_LIMIT = {
+    "ENABLED": True,
+    # endpoints that are limited, others pass straight through
+    "PATHS": ("/initiatepayment/", "/initiatepayments/", "/initiaterefund/", "/initiatecancellation/",
+              "/async/initiatepayment/", "/async/initiaterefund/", "/async/initiatecancellation/"),
+    # requests per second refilled into each bucket, and the most a bucket holds, None to not limit on that key
+    "CARD": {"RATE": 0.2, "BURST": 5},
+    "PAYEE": {"RATE": 50.0, "BURST": 100},
+    "CLIENT": {"RATE": 10.0, "BURST": 20},
+    "MAX_IN_FLIGHT": 200,  # requests handled at once by one process before more are shed, None for no cap
+    "CLIENT_IP_HEADER": None,  # e.g. "HTTP_X_FORWARDED_FOR" behind a trusted proxy, else REMOTE_ADDR is used
+    "BACKEND": "local",  # "local" for in-process buckets, "django" for Django's cache framework
+    "MAX_ENTRIES": 100000,  # in-process only, buckets unused for longest are evicted first
+    "CACHE_ALIAS": "default",  # django only, which entry of CACHES to use
+    "KEY_PREFIX": "cw2:bucket",  # django only, namespaces bucket keys in the shared cache
+}
+
+def getConfig():
+    return dict(DEFAULT_RATE_LIMIT, **getattr(settings, "RATE_LIMIT", {}))
+
+
+class LocalBucketBackend:
+    """
+    In-process token buckets, each a token count and the time it was last refilled.
+    """
+
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst, count=1):
+        """
+
+        :param key: the bucket to take tokens from
+        :param rate: tokens refilled per second
+        :param burst: the most tokens the bucket holds
+        :param count: the tokens to take, no more than burst
+        :return: 0 if the tokens were taken, else the seconds until they will be available
+        """
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (burst, now))
+            # refilling on read keeps each request to one dict lookup, with no timers
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= count else (count - tokens) / rate
+            self.buckets[key] = (tokens - count if not wait else tokens, now)
+            self.buckets.move_to_end(key)
+            if len(self.buckets) > self.maxEntries:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+class DjangoBucketBackend:
+    """
+    Token buckets stored in one of Django's configured caches, so limits hold across processes. Reads and writes
+    aren't atomic, so under contention a bucket can let through a few more requests than its limit.
+    """
+
+    def __init__(self, alias, prefix):
+        self.alias = alias
+        self.prefix = prefix
+
+    def take(self, key, rate, burst, count=1):
+        cache = caches[self.alias]
+        cacheKey = "{}:{}".format(self.prefix, ":".join(map(str, key)))
+        now = time.time()
+        tokens, updated = cache.get(cacheKey, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0 if tokens >= count else (count - tokens) / rate
+        # a full bucket is the same as no bucket, so entries expire once they would have refilled
+        cache.set(cacheKey, (tokens - count if not wait else tokens, now), timeout=int(burst / rate) + 1)
+        return wait
+
+
+_backend = None
+_backendLock = threading.Lock()
+
+
+def getBucketBackend(config):
+    """
+
+    :param config: the rate limit settings
+    :return: the bucket backend configured by RATE_LIMIT, created on first use
+    """
+    global _backend
+    if _backend is None:
+        with _backendLock:
+            if _backend is None:
+                if config["BACKEND"] == "django":
+                    _backend = DjangoBucketBackend(config["CACHE_ALIAS"], config["KEY_PREFIX"])
+                elif config["BACKEND"] == "local":
+                    _backend = LocalBucketBackend(config["MAX_ENTRIES"])
+                else:
+                    raise ValueError('Unknown rate limit backend "{}"'.format(config["BACKEND"]))
+    return _backend
+
+
+def resetBucketBackend():
+    """
+    Forgets the configured backend and its buckets so that it is rebuilt from settings on next use.
+    """
+    global _backend
+    with _backendLock:
+        _backend = None
+
+
+def clientAddress(request, header):
+    if header and request.META.get(header):
+        # the left-most address is the client, the rest are proxies
+        return request.META[header].split(",")[0].strip()
+    return request.META.get("REMOTE_ADDR", "")
+
+
+# works out which buckets a request draws from
+def bucketKeys(request, config):
+    """
+
+    :param request: the request sent to a limited endpoint
+    :param config: the rate limit settings
+    :return: a list of the limit name, the bucket key, the limit's settings and the tokens to take for each bucket
+    """
+    keys = []
+    if config["CLIENT"] is not None:
+        keys.append(("client", ("client", clientAddress(request, config["CLIENT_IP_HEADER"])), config["CLIENT"], 1))
+
+    if config["CARD"] is None and config["PAYEE"] is None:
+        return keys
+    # only a payment body has card and payee fields, anything malformed is left for the view to reject
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return keys
+    # a batch takes a card token for every payment in it, the same as sending each on its own would, but only one
+    # token from each payee, since a merchant's end of day batch pays itself many times over
+    items = data if isinstance(data, list) else [data]
+    counts = OrderedDict()
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        if config["CARD"] is not None and isinstance(item.get("CardNumber"), str):
+            key = ("card", cardFingerprint(item["CardNumber"].strip()))
+            counts[key] = counts.get(key, 0) + 1
+        if config["PAYEE"] is not None and isinstance(item.get("PayeeBankAccNum"), str):
+            try:
+                # the same account however it is written, as when the payee is looked up
+                key = ("payee", int(item["PayeeBankAccNum"]))
+            except ValueError:
+                continue
+            counts[key] = 1
+    keys.extend((key[0], key, config[key[0].upper()], count) for key, count in counts.items())
+    return keys
+
+
+def checkLimits(request, config):
+    """
+
+    :param request: the request sent to a limited endpoint
+    :param config: the rate limit settings
+    :return: None if the request may go ahead, else the error response to send instead
+    """
+    backend = getBucketBackend(config)
+    for name, key, limit, count in bucketKeys(request, config):
+        if count > limit["BURST"]:
+            # more payments than the bucket ever holds, so no retry of this batch can succeed
+            response = errorHandling(115, name)
+            response.status_code = 429
+            return response
+        wait = backend.take(key, limit["RATE"], limit["BURST"], count)
+        if wait:
+            response = errorHandling(115, name)
+            response.status_code = 429
+            response["Retry-After"] = str(int(wait) + 1)
+            return response
+    return None
+
+
+def shed():
+    # too many requests are already in flight, so this one is turned away before it adds to the queue
+    response = errorHandling(116)
+    response.status_code = 503
+    response["Retry-After"] = "1"
+    return response
+
+
+@sync_and_async_middleware
+def RateLimitMiddleware(get_response):
+    """
+    Rejects requests to the payment endpoints once their client, card or payee has used up its token bucket, and
+    sheds requests while too many are already being handled, before any of the view's work is done.
+    """
+
+    # settings are read once when the middleware is built, not on every request
+    config = getConfig()
+    paths = frozenset(config["PATHS"]) if config["ENABLED"] else frozenset()
+    maxInFlight = config["MAX_IN_FLIGHT"]
+    inFlight = [0]
+    lock = threading.Lock()
+
+    def enter():
+        with lock:
+            if maxInFlight is not None and inFlight[0] >= maxInFlight:
+                return False
+            inFlight[0] += 1
+            return True
+
+    def leave():
+        with lock:
+            inFlight[0] -= 1
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            if request.path_info not in paths:
+                return await get_response(request)
+            if not enter():
+                return shed()
+            try:
+                rejected = checkLimits(request, config)
+                if rejected is not None:
+                    return rejected
+                return await get_response(request)
+            finally:
+                leave()
+    else:
+        def middleware(request):
+            if request.path_info not in paths:
+                return get_response(request)
+            if not enter():
+                return shed()
+            try:
+                rejected = checkLimits(request, config)
+                if rejected is not None:
+                    return rejected
+                return get_response(request)
+            finally:
+                leave()
+
+    return middleware
@@ -0,0 +1,48 @@
+from datetime import datetime, timezone
+
+# business account and bank numbers start here so they never collide with personal ones
+BUSINESS_OFFSET = 10000000
+
+EXPIRY = datetime(2030, 1, 1, tzinfo=timezone.utc)
+
+
+def luhnCheckDigit(digits):
+    """
+
+    :param digits: a card number without its final check digit
+    :return: the check digit that makes the card number pass the Luhn check
+    """
+    total = 0
+    for position, digit in enumerate(reversed(digits)):
+        digit = int(digit)
+        if position % 2 == 0:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return str((10 - total % 10) % 10)
+
+
+def cardNumber(index):
+    digits = "4{:014d}".format(index)
+    return digits + luhnCheckDigit(digits)
+
+
+def cvv(index):
+    return "{:03d}".format(index % 1000)
+
+
+def sortCode(index):
+    return "{:06d}".format(100000 + index % 900000)
+
+
+def personName(index):
+    return "Person {}".format(index)
+
+
+def personEmail(index):
+    return "person{}@example.com".format(index)
+
+
+def businessName(index):
+    return "Business {}".format(index)
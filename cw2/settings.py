@@ -41,6 +41,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'cw2.timing.TimingMiddleware',
+    'cw2.rate_limit.RateLimitMiddleware',
+    'cw2.db_router.ReplicaPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,6 +85,154 @@ DATABASES = {
     }
 }
 
+# Read replicas
+# account lookups are spread over the DATABASES aliases in ALIASES, which must replicate 'default'
+
+DATABASE_ROUTERS = ['cw2.db_router.ReplicaRouter']
+
+DATABASE_REPLICAS = {
+    'ALIASES': [],
+    'HEALTH_CHECK_INTERVAL': 5,
+    'PIN_SECONDS': 2,
+}
+
+
+# Currency conversion
+# BACKEND is "local" for a per-process cache or "django" to share rates through CACHES
+
+CURRENCY_RATE_CACHE = {
+    'BACKEND': 'local',
+    'TTL': 3600,
+    'MIN_AMOUNT': 100,
+    'MAX_ENTRIES': 1024,
+    'CACHE_ALIAS': 'default',
+}
+
+
+# Account lookups
+# resolved payers and payees are cached for TTL seconds, BACKEND "django" shares them through CACHES
+
+ACCOUNT_CACHE = {
+    'ENABLED': True,
+    'BACKEND': 'local',
+    'TTL': 300,
+    'MAX_ENTRIES': 10000,
+    'CACHE_ALIAS': 'default',
+}
+
+
+# Upstream services
+# base urls of the currency converter and the Payment Network Service, plus the shared HTTP client settings, both
+# read once per process
+
+UPSTREAM_URLS = {
+    'CURRENCY': 'http://samshepherd.eu.pythonanywhere.com/currency/',
+    'PNS': 'http://samshepherd.eu.pythonanywhere.com/pns/',
+}
+
+UPSTREAM_HTTP = {
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 10,
+    'POOL_MAXSIZE': 20,
+    'RETRIES': 2,
+    'BACKOFF_FACTOR': 0.2,
+    'HEDGE_AFTER': None,
+}
+
+
+# Circuit breakers
+# calls to an upstream fail fast for OPEN_FOR seconds once ERROR_RATE of the last WINDOW calls have failed, or
+# SLOW_RATE of them took SLOW_CALL seconds or more
+
+CIRCUIT_BREAKER = {
+    'ENABLED': True,
+    'WINDOW': 20,
+    'MIN_CALLS': 10,
+    'ERROR_RATE': 0.5,
+    'SLOW_CALL': 2.0,
+    'SLOW_RATE': 0.8,
+    'OPEN_FOR': 30,
+}
+
+
+# Batch payments
+# MAX_SIZE payments per request, PNS_CONCURRENCY calls in flight per batch
+
+PAYMENT_BATCH = {
+    'MAX_SIZE': 5000,
+    'PNS_CONCURRENCY': 10,
+}
+
+
+# Payment queue
+# with ENABLED, payments sent with "Prefer: respond-async" get a 202 and are made by "manage.py processpayments"
+# queued card numbers and CVVs are encrypted with CARD_KEY, a Fernet key, or one derived from SECRET_KEY if None
+
+PAYMENT_QUEUE = {
+    'ENABLED': False,
+    'WORKERS': 4,
+    'POLL_INTERVAL': 1.0,
+    'LEASE': 60,
+    'MAX_ATTEMPTS': 5,
+    'CARD_KEY': None,
+}
+
+
+# Rate limiting
+# token buckets per client IP, card and payee account refill at RATE requests per second up to BURST, a batch takes
+# a card token for each payment in it and one token from each payee, and each process sheds requests to the limited
+# endpoints beyond MAX_IN_FLIGHT at once
+
+RATE_LIMIT = {
+    'ENABLED': True,
+    'CARD': {'RATE': 0.2, 'BURST': 5},
+    'PAYEE': {'RATE': 50.0, 'BURST': 100},
+    'CLIENT': {'RATE': 10.0, 'BURST': 20},
+    'MAX_IN_FLIGHT': 200,
+    'BACKEND': 'local',
+}
+
+
+# Idempotency keys
+# responses to payments and refunds sent with an Idempotency-Key header are replayed to repeats for TTL seconds
+
+IDEMPOTENCY = {
+    'TTL': 24 * 60 * 60,
+    'WAIT_TIMEOUT': 30,
+    'LOCK_TIMEOUT': 120,
+}
+
+
+# Transaction history
+# pages are PAGE_SIZE transactions unless the client asks for up to MAX_PAGE_SIZE
+
+TRANSACTION_HISTORY = {
+    'PAGE_SIZE': 50,
+    'MAX_PAGE_SIZE': 500,
+}
+
+
+# Transaction archive
+# "manage.py archivetransactions" moves completed payments older than COMPLETE_AFTER_DAYS, and cancelled and
+# refunded ones older than FINISHED_AFTER_DAYS, to the archive BATCH_SIZE at a time, pausing PAUSE seconds between
+
+TRANSACTION_ARCHIVE = {
+    'COMPLETE_AFTER_DAYS': 180,
+    'FINISHED_AFTER_DAYS': 30,
+    'BATCH_SIZE': 500,
+    'PAUSE': 0.1,
+}
+
+
+# Request timing
+# phases and upstream calls of sampled requests are reported in a Server-Timing header and as histograms at /metrics
+
+REQUEST_TIMING = {
+    'ENABLED': True,
+    'SAMPLE_RATE': 1.0,
+    'SERVER_TIMING_HEADER': True,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -0,0 +1,112 @@
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+from django.db import IntegrityError
+from django.db.models import F
+from django.db.transaction import atomic
+from django.utils import timezone
+
+from cw2.models import Transaction, TransactionStatus, SettlementSummary
+
+# digits after the decimal point for currencies that don't use two
+MINOR_UNITS = {"JPY": 0, "KRW": 0, "ISK": 0, "BHD": 3, "KWD": 3, "OMR": 3, "JOD": 3, "TND": 3}
+
+# the summary fields each transaction status is counted in, other statuses aren't settled
+STATUS_FIELDS = {TransactionStatus.COMPLETE: ("completedCount", "completedAmount"),
+                 TransactionStatus.REFUNDED: ("refundedCount", "refundedAmount"),
+                 TransactionStatus.CANCELLED: ("cancelledCount", "cancelledAmount")}
+
+
+def minorUnits(currency):
+    return MINOR_UNITS.get(currency, 2)
+
+
+def toMinorUnits(amount, currency):
+    """
+
+    :param amount: an amount as stored on a transaction
+    :param currency: the currency of the amount
+    :return: the amount as a whole number of the currency's minor unit, rounded half up
+    """
+    # repr gives the shortest decimal that round trips, so 0.1 is taken as 0.1 rather than its binary expansion
+    return int(Decimal(repr(float(amount))).scaleb(minorUnits(currency)).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def fromMinorUnits(amount, currency):
+    # exact decimal text, e.g. "12.30"
+    exponent = Decimal(1).scaleb(-minorUnits(currency))
+    return str((Decimal(amount) * exponent).quantize(exponent))
+
+
+def dayOf(value):
+    # payments are settled on their UTC day
+    if isinstance(value, datetime):
+        return timezone.localtime(value, timezone.utc).date() if timezone.is_aware(value) else value.date()
+    return value
+
+
+def adjustSummary(payeeId, currency, day, changes):
+    """
+
+    :param payeeId: the business account the transaction was paid to
+    :param currency: the currency of the transaction
+    :param day: the day the transaction was made
+    :param changes: the amount to add to each summary field
+    """
+    summaries = SettlementSummary.objects.filter(payee_id=payeeId, currency=currency, day=day)
+    if summaries.update(**{field: F(field) + change for field, change in changes.items()}):
+        return
+    # first transaction of the day for this payee and currency
+    try:
+        with atomic():
+            SettlementSummary.objects.create(payee_id=payeeId, currency=currency, day=day, **changes)
+    except IntegrityError:
+        # another request created it first
+        summaries.update(**{field: F(field) + change for field, change in changes.items()})
+
+
+def recordPayments(transactions):
+    """
+    Adds new payments to the summaries, call in the same database transaction as the payments are stored.
+
+    :param transactions: the payments that were stored
+    """
+    totals = {}
+    for payment in transactions:
+        countField, amountField = STATUS_FIELDS[payment.transactionStatus]
+        changes = totals.setdefault((payment.payee_id, payment.currency, dayOf(payment.date)), {})
+        changes[countField] = changes.get(countField, 0) + 1
+        changes[amountField] = changes.get(amountField, 0) + toMinorUnits(payment.amount, payment.currency)
+    for (payeeId, currency, day), changes in totals.items():
+        adjustSummary(payeeId, currency, day, changes)
+
+
+def recordRefund(payment, amount, fullyRefunded):
+    """
+    Moves a refunded amount from a payment's completed total to its refunded total, call in the same database
+    transaction as the refund is stored. The payment itself is counted as refunded once nothing is left to refund.
+
+    :param payment: the payment that was refunded
+    :param amount: the amount refunded, in minor units
+    :param fullyRefunded: whether the payment has now been refunded in full
+    """
+    changes = {"completedAmount": -amount, "refundedAmount": amount}
+    if fullyRefunded:
+        changes.update(completedCount=-1, refundedCount=1)
+    adjustSummary(payment.payee_id, payment.currency, dayOf(payment.date), changes)
+
+
+def moveSummary(transactionId, fromStatus, toStatus):
+    """
+    Moves a payment between the totals of two statuses, call in the same database transaction as its status changes.
+
+    :param transactionId: the ID of the payment
+    :param fromStatus: the status the payment had
+    :param toStatus: the status the payment has now
+    """
+    payment = Transaction.objects.filter(id=transactionId).values("payee_id", "currency", "date", "amount").get()
+    amount = toMinorUnits(payment["amount"], payment["currency"])
+    fromCount, fromAmount = STATUS_FIELDS[fromStatus]
+    toCount, toAmount = STATUS_FIELDS[toStatus]
+    adjustSummary(payment["payee_id"], payment["currency"], dayOf(payment["date"]),
+                  {fromCount: -1, fromAmount: -amount, toCount: 1, toAmount: amount})
@@ -0,0 +1,64 @@
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models import Sum
+from django.http import JsonResponse
+from django.utils.dateparse import parse_date
+
+from cw2.error_handling import errorHandling
+from cw2.models import SettlementSummary
+from cw2.settlement import fromMinorUnits
+
+SUMMARY_FIELDS = ("completedCount", "completedAmount", "refundedCount", "refundedAmount", "cancelledCount",
+                  "cancelledAmount")
+
+
+# lists one business account's settlement totals per day and currency, with the total for each currency, for staff
+# logins only as account numbers are sequential
+@staff_member_required
+def Settlement(request, accountNumber):
+    """
+
+    :param request: the request sent to the endpoint, with optional from and to dates and a currency
+    :param accountNumber: the business account being settled
+    :return: the totals for each day and currency in the range, or an error message
+    """
+
+    if request.method != "GET":
+        return errorHandling(111)
+
+    summaries = SettlementSummary.objects.filter(payee=accountNumber)
+    for field, lookup in (("from", "day__gte"), ("to", "day__lte")):
+        if request.GET.get(field):
+            try:
+                day = parse_date(request.GET[field])
+            except ValueError:
+                day = None
+            if day is None:
+                return errorHandling(104, field)
+            summaries = summaries.filter(**{lookup: day})
+    if request.GET.get("currency"):
+        summaries = summaries.filter(currency=request.GET["currency"])
+
+    days = [summaryData(row) for row in summaries.order_by("day", "currency").values("day", "currency",
+                                                                                      *SUMMARY_FIELDS)]
+    totals = [summaryData(row) for row in summaries.order_by("currency").values("currency")
+              .annotate(**{field: Sum(field) for field in SUMMARY_FIELDS})]
+
+    responseData = {"Days": days,
+                    "Totals": totals,
+                    "ErrorCode": None
+                    }
+
+    return JsonResponse(responseData, status=200)
+
+
+def summaryData(row):
+    # amounts are sent as exact decimal strings in the currency's major unit
+    data = {"Date": row["day"].isoformat()} if "day" in row else {}
+    data.update({"CurrencyCode": row["currency"],
+                 "CompletedCount": row["completedCount"],
+                 "CompletedAmount": fromMinorUnits(row["completedAmount"], row["currency"]),
+                 "RefundedCount": row["refundedCount"],
+                 "RefundedAmount": fromMinorUnits(row["refundedAmount"], row["currency"]),
+                 "CancelledCount": row["cancelledCount"],
+                 "CancelledAmount": fromMinorUnits(row["cancelledAmount"], row["currency"])})
+    return data
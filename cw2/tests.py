@@ -0,0 +1,446 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest import mock, skipUnless
+
+from django.db import transaction
+from django.test import TestCase, override_settings
+from django.utils import timezone as djangoTimezone
+
+from cw2.account_cache import resetAccountBackend
+from cw2.archive import archivable, getConfig as getArchiveConfig
+from cw2.circuit_breaker import resetBreakers
+from cw2.currency_cache import resetRateBackend
+from cw2.http_client import UnavailableResponse
+from cw2.idempotency import COMPLETE, getConfig as getIdempotencyConfig, purgeExpiredKeys
+from cw2.models import Transaction, TransactionStatus, ArchivedTransaction, PersonalAccount, BusinessAccount, \
+    PaymentDetails, BankDetails, RefundEntry, RefundState, SettlementSummary, QueuedPayment, QueueState, \
+    IdempotencyKey
+from cw2.payment_queue import RESPOND_ASYNC, getConfig as getQueueConfig
+from cw2.payment_worker import claimPayment, processPayment
+from cw2.rate_limit import resetBucketBackend
+from cw2.settlement import dayOf, recordPayments
+
+# the baselines only hold on the machine that measured them, so the timed cases run only when asked for
+LATENCY_TESTS = bool(os.environ.get("CW2_LATENCY_TESTS") or os.environ.get("CW2_UPDATE_BASELINES"))
+
+# wall-clock time of each case, written by running the tests with CW2_UPDATE_BASELINES=1
+BASELINES_FILE = Path(__file__).resolve().parent / "latency_baselines.json"
+
+# how much slower than its baseline a case may be before it fails, 0.5 is 50% slower, plus a few milliseconds
+# since requests this fast vary by about that much between runs whatever the code does
+LATENCY_MARGIN = float(os.environ.get("CW2_LATENCY_MARGIN", "0.5"))
+LATENCY_SLACK_MS = float(os.environ.get("CW2_LATENCY_SLACK_MS", "1.0"))
+
+# each case is timed this many times and the fastest kept, which is the least affected by other work on the machine
+LATENCY_REPEATS = 20
+
+EXPIRY = datetime(2030, 1, 1, tzinfo=timezone.utc)
+
+PAYMENT = {"CardNumber": "4111111111111111", "CVV": "123", "Expiry": "2030-01-01", "CardHolderName": "Alice",
+           "CardHolderAddress": "1 High Street", "Email": "alice@example.com", "PayeeBankAccNum": "22",
+           "PayeeBankSortCode": "44-55-66", "RecipientName": "Shop", "Amount": 10.0, "PayerCurrencyCode": "GBP",
+           "PayeeCurrencyCode": "EUR"}
+
+REFUND = {"TransactionUUID": "101", "Amount": 5.0, "CurrencyCode": "GBP"}
+
+# name, endpoint, body, queries, status, error code and the upstream paths that fail, for every outcome of each
+# endpoint. Each case runs against the same fixtures, in a savepoint that is rolled back afterwards.
+CASES = (
+    ("payment", "/initiatepayment/", PAYMENT, 9, 200, None, ()),
+    ("payment-bad-json", "/initiatepayment/", "{", 0, 400, 101, ()),
+    ("payment-missing-field", "/initiatepayment/", {field: value for field, value in PAYMENT.items() if field != "CardNumber"},
+     0, 400, 102, ()),
+    ("payment-invalid-field", "/initiatepayment/", dict(PAYMENT, Amount=-1.0), 0, 400, 104, ()),
+    ("payment-wrong-cvv", "/initiatepayment/", dict(PAYMENT, CVV="124"), 1, 400, 106, ()),
+    ("payment-wrong-expiry", "/initiatepayment/", dict(PAYMENT, Expiry="2031-01-01"), 1, 400, 106, ()),
+    ("payment-unknown-card", "/initiatepayment/", dict(PAYMENT, CardNumber="4000056655665556"), 1, 400, 106, ()),
+    ("payment-unknown-payee", "/initiatepayment/", dict(PAYMENT, PayeeBankAccNum="23"), 2, 400, 107, ()),
+    ("payment-no-personal-account", "/initiatepayment/", dict(PAYMENT, CardNumber="5555555555554444", CVV="999"),
+     1, 400, 108, ()),
+    ("payment-wrong-holder", "/initiatepayment/", dict(PAYMENT, CardHolderName="Bob"), 1, 400, 108, ()),
+    ("payment-no-business-account", "/initiatepayment/", dict(PAYMENT, PayeeBankAccNum="33",
+                                                               RecipientName="Nobody"), 2, 400, 109, ()),
+    ("payment-currency-down", "/initiatepayment/", PAYMENT, 2, 400, 201, ("convert/",)),
+    ("payment-pns-down", "/initiatepayment/", PAYMENT, 2, 400, 301, ("initiatetransactionpns/",)),
+    ("refund", "/initiaterefund/", REFUND, 13, 200, None, ()),
+    ("refund-in-full", "/initiaterefund/", dict(REFUND, Amount=50 / 3), 14, 200, None, ()),
+    ("refund-too-much", "/initiaterefund/", dict(REFUND, Amount=20.0), 5, 400, 118, ()),
+    ("refund-unknown", "/initiaterefund/", dict(REFUND, TransactionUUID="999"), 2, 400, 402, ()),
+    ("refund-not-an-id", "/initiaterefund/", dict(REFUND, TransactionUUID="abc"), 0, 400, 402, ()),
+    ("refund-cancelled", "/initiaterefund/", dict(REFUND, TransactionUUID="102"), 1, 400, 404, ()),
+    ("refund-archived", "/initiaterefund/", dict(REFUND, TransactionUUID="90"), 2, 400, 117, ()),
+    ("refund-currency-down", "/initiaterefund/", REFUND, 1, 400, 201, ("convert/",)),
+    ("refund-pns-down", "/initiaterefund/", REFUND, 7, 400, 403, ("initiaterefundpns/",)),
+    ("cancellation", "/initiatecancellation/", {"TransactionUUID": "101"}, 6, 200, None, ()),
+    ("cancellation-unknown", "/initiatecancellation/", {"TransactionUUID": "999"}, 5, 400, 402, ()),
+    ("cancellation-not-an-id", "/initiatecancellation/", {"TransactionUUID": "abc"}, 0, 400, 402, ()),
+    ("cancellation-refunded", "/initiatecancellation/", {"TransactionUUID": "103"}, 4, 400, 404, ()),
+    ("cancellation-archived", "/initiatecancellation/", {"TransactionUUID": "90"}, 5, 400, 117, ()),
+)
+
+
+class UpstreamResponse:
+    """
+    Stands in for a response from the currency converter or the PNS, data None for a body that isn't JSON.
+    """
+
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        if self.data is None:
+            raise ValueError("Expecting value: line 1 column 1 (char 0)")
+        return self.data
+
+
+def resetCaches():
+    # cached accounts and rates would let later requests skip queries the first one made
+    resetAccountBackend()
+    resetRateBackend()
+    resetBreakers()
+
+
+@override_settings(RATE_LIMIT={"ENABLED": False})
+class EndpointTestCase(TestCase):
+    """
+    Serves the endpoints against one payer, one payee and a few transactions, with the upstream services mocked.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        payerCard = PaymentDetails.objects.create(paymentId=1, cardNumber="4111111111111111", securityCode="123",
+                                                  expiryDate=EXPIRY)
+        PaymentDetails.objects.create(paymentId=2, cardNumber="5555555555554444", securityCode="999",
+                                      expiryDate=EXPIRY)
+        payeeCard = PaymentDetails.objects.create(paymentId=3, cardNumber="378282246310005", securityCode="456",
+                                                  expiryDate=EXPIRY)
+        payerBank = BankDetails.objects.create(accountNumber=11, sortCode="112233", accountName="Alice")
+        payeeBank = BankDetails.objects.create(accountNumber=22, sortCode="445566", accountName="Shop")
+        BankDetails.objects.create(accountNumber=33, sortCode="445566", accountName="Nobody")
+        payer = PersonalAccount.objects.create(accountNumber=1, paymentDetails=payerCard, bankDetails=payerBank,
+                                               email="alice@example.com", password="", phoneNumber="",
+                                               fullName="Alice")
+        payee = BusinessAccount.objects.create(accountNumber=2, paymentDetails=payeeCard, bankDetails=payeeBank,
+                                               businessNumber=1, businessName="Shop", businessEmail="",
+                                               businessPhoneNumber="")
+
+        payments = [Transaction(id=transactionId, payer=payer, payee=payee, amount=20.0, currency="EUR",
+                                date=datetime(2024, 1, 1, tzinfo=timezone.utc), transactionStatus=status)
+                    for transactionId, status in ((101, TransactionStatus.COMPLETE),
+                                                  (102, TransactionStatus.CANCELLED),
+                                                  (103, TransactionStatus.REFUNDED))]
+        Transaction.objects.bulk_create(payments)
+        recordPayments(payments)
+        ArchivedTransaction.objects.create(id=90, payer=payer, payee=payee, amount=20.0, currency="EUR",
+                                           date=datetime(2020, 1, 1, tzinfo=timezone.utc),
+                                           transactionStatus=TransactionStatus.COMPLETE,
+                                           archived=datetime(2021, 1, 1, tzinfo=timezone.utc))
+
+    def setUp(self):
+        resetCaches()
+        self.failing = ()
+        # failing upstreams answer with a JSON comment unless they are behind a gateway that answers with HTML
+        self.gatewayError = False
+        patcher = mock.patch("cw2.http_client.post", side_effect=self.upstream)
+        self.upstreamPost = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upstream(self, service, path, idempotent=False, **kwargs):
+        if path in self.failing:
+            if self.gatewayError:
+                return UpstreamResponse(502, None)
+            return UpstreamResponse(500, {"Comment": "{} is down".format(path)})
+        if path == "convert/":
+            return UpstreamResponse(200, {"Amount": json.loads(kwargs["data"])["Amount"] * 1.2})
+        if path == "initiatetransactionpns/":
+            return UpstreamResponse(200, {"TransactionUUID": 500})
+        return UpstreamResponse(200, {})
+
+    def send(self, url, body, **headers):
+        return self.client.post(url, body if isinstance(body, str) else json.dumps(body),
+                                content_type="application/json", **headers)
+
+    def isolated(self):
+        # each case starts from the fixtures, whatever the cases before it changed
+        resetCaches()
+        return RolledBack()
+
+
+class RolledBack(transaction.Atomic):
+    """
+    A savepoint that is always rolled back, so a case leaves no rows behind.
+    """
+
+    def __init__(self):
+        super().__init__(using=None, savepoint=True, durable=False)
+
+    def __exit__(self, excType, excValue, traceback):
+        transaction.set_rollback(True)
+        return super().__exit__(excType, excValue, traceback)
+
+
+class QueryCountTests(EndpointTestCase):
+    """
+    Fails when a change adds or removes a database round trip on any outcome of an endpoint, update the counts in
+    CASES when that was intended.
+    """
+
+    def test_cases(self):
+        for name, url, body, queries, status, errorCode, failing in CASES:
+            with self.subTest(name), self.isolated():
+                self.failing = failing
+                with self.assertNumQueries(queries):
+                    response = self.send(url, body)
+                self.assertEqual(response.status_code, status)
+                self.assertEqual(response.json()["ErrorCode"], errorCode)
+
+    def test_failed_refund_is_released(self):
+        # the claimed transaction can be refunded again once the upstream has failed
+        self.failing = ("initiaterefundpns/",)
+        self.send("/initiaterefund/", REFUND)
+        self.assertEqual(Transaction.objects.get(id=101).transactionStatus, TransactionStatus.COMPLETE)
+        self.assertFalse(RefundEntry.objects.filter(payment_id=101).exists())
+
+    def test_refund_in_parts(self):
+        # three refunds of 6.00 EUR leave 2.00 EUR of the 20.00 EUR payment, which a fourth can't exceed
+        for _ in range(3):
+            self.assertIsNone(self.send("/initiaterefund/", REFUND).json()["ErrorCode"])
+        response = self.send("/initiaterefund/", REFUND)
+        self.assertEqual(response.json()["ErrorCode"], 118)
+        self.assertIn("2.00 EUR", response.json()["Comment"])
+        # a payment refunded in part can't be cancelled
+        self.assertEqual(self.send("/initiatecancellation/", {"TransactionUUID": "101"}).json()["ErrorCode"], 404)
+        self.assertEqual(Transaction.objects.get(id=101).transactionStatus, TransactionStatus.COMPLETE)
+
+        self.assertIsNone(self.send("/initiaterefund/", dict(REFUND, Amount=2 / 1.2)).json()["ErrorCode"])
+        self.assertEqual(Transaction.objects.get(id=101).transactionStatus, TransactionStatus.REFUNDED)
+        refunds = Transaction.objects.filter(originalTransaction_id=101).values_list("amount", flat=True)
+        self.assertEqual(sorted(refunds), [2.0, 6.0, 6.0, 6.0])
+        summary = SettlementSummary.objects.get(payee_id=2, currency="EUR")
+        self.assertEqual((summary.completedCount, summary.completedAmount), (0, 0))
+        self.assertEqual((summary.refundedCount, summary.refundedAmount), (2, 4000))
+
+    def test_gateway_error_page(self):
+        # a proxy in front of the PNS answers with HTML, which is reported like any other failure
+        self.failing = ("initiatetransactionpns/",)
+        self.gatewayError = True
+        response = self.send("/initiatepayment/", PAYMENT)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["ErrorCode"], 301)
+
+    def test_cached_accounts_skip_lookups(self):
+        # a second payment by the same payer to the same payee only reads what it must write
+        self.send("/initiatepayment/", PAYMENT)
+        Transaction.objects.filter(id=500).delete()
+        with self.assertNumQueries(4):
+            self.send("/initiatepayment/", PAYMENT)
+
+
+class BatchPaymentTests(EndpointTestCase):
+    """
+    Covers what the batch endpoint stores when part of a batch can't be.
+    """
+
+    def test_failed_insert_keeps_the_rest(self):
+        # the PNS gives both payments ID 500, so only the second fails to store
+        response = self.send("/initiatepayments/", [PAYMENT, dict(PAYMENT, Amount=20.0)])
+        results = response.json()["Results"]
+        self.assertEqual([result["ErrorCode"] for result in results], [None, 401])
+        self.assertEqual(Transaction.objects.get(id=500).amount, 12.0)
+
+
+class PaymentDateTests(EndpointTestCase):
+    """
+    Covers the date a payment is stored with, which archiving and the settlement totals go by.
+    """
+
+    def test_payment_is_dated_when_it_is_made(self):
+        self.send("/initiatepayment/", PAYMENT)
+        payment = Transaction.objects.get(id=500)
+        self.assertLess(abs(djangoTimezone.now() - payment.date), timedelta(minutes=1))
+        self.assertFalse(any(candidates.filter(id=500).exists()
+                             for name, candidates in archivable(getArchiveConfig())))
+        self.assertTrue(SettlementSummary.objects.filter(day=dayOf(payment.date), payee_id=2).exists())
+
+
+@override_settings(RATE_LIMIT={"CARD": {"RATE": 0.001, "BURST": 2}, "PAYEE": None, "CLIENT": None})
+class RateLimitTests(EndpointTestCase):
+    """
+    Covers how many tokens a batch takes from the buckets of the cards and payees in it.
+    """
+
+    def setUp(self):
+        super().setUp()
+        resetBucketBackend()
+        self.addCleanup(resetBucketBackend)
+
+    def test_batch_takes_a_token_per_payment(self):
+        self.assertEqual(self.send("/initiatepayments/", [PAYMENT, PAYMENT]).status_code, 200)
+        response = self.send("/initiatepayment/", PAYMENT)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json()["ErrorCode"], 115)
+
+    def test_batch_larger_than_the_bucket_is_rejected(self):
+        response = self.send("/initiatepayments/", [PAYMENT, PAYMENT, PAYMENT])
+        self.assertEqual(response.status_code, 429)
+        self.assertNotIn("Retry-After", response)
+        self.upstreamPost.assert_not_called()
+
+    @override_settings(RATE_LIMIT={"CARD": None, "CLIENT": None})
+    def test_batch_takes_one_token_per_payee(self):
+        # a merchant's batch can pay the same payee more times than its bucket holds
+        response = self.send("/initiatepayments/", [PAYMENT] * 101)
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(RATE_LIMIT={"CARD": None, "PAYEE": {"RATE": 0.001, "BURST": 1}, "CLIENT": None})
+    def test_payee_bucket_ignores_leading_zeros(self):
+        self.assertEqual(self.send("/initiatepayment/", PAYMENT).status_code, 200)
+        response = self.send("/initiatepayment/", dict(PAYMENT, PayeeBankAccNum="0022"))
+        self.assertEqual(response.status_code, 429)
+
+
+class IdempotencyTests(EndpointTestCase):
+    """
+    Covers which failures a retry with the same Idempotency-Key runs again and which it replays.
+    """
+
+    def pnsCalls(self):
+        return sum(call.args[1] == "initiatetransactionpns/" for call in self.upstreamPost.call_args_list)
+
+    def test_replay_after_failed_save(self):
+        # the PNS took the payment but it couldn't be stored, so a retry must not charge the card again
+        Transaction.objects.create(id=500, payer_id=1, payee_id=2, amount=1.0, currency="EUR", date=EXPIRY,
+                                   transactionStatus=TransactionStatus.COMPLETE)
+        first = self.send("/initiatepayment/", PAYMENT, HTTP_IDEMPOTENCY_KEY="save-fails")
+        self.assertEqual(first.json()["ErrorCode"], 401)
+        second = self.send("/initiatepayment/", PAYMENT, HTTP_IDEMPOTENCY_KEY="save-fails")
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(self.pnsCalls(), 1)
+
+    def test_replay_after_unanswered_pns(self):
+        # a PNS that timed out may still have charged the card
+        self.upstreamPost.side_effect = lambda service, path, **kwargs: (
+            UnavailableResponse("Read timed out.", unanswered=True) if path == "initiatetransactionpns/"
+            else self.upstream(service, path, **kwargs))
+        self.assertEqual(self.send("/initiatepayment/", PAYMENT, HTTP_IDEMPOTENCY_KEY="timeout").json()["ErrorCode"],
+                         301)
+        self.send("/initiatepayment/", PAYMENT, HTTP_IDEMPOTENCY_KEY="timeout")
+        self.assertEqual(self.pnsCalls(), 1)
+
+    def test_retry_after_refused_pns(self):
+        # a PNS that answered with an error took nothing, so the retry goes through
+        self.failing = ("initiatetransactionpns/",)
+        self.assertEqual(self.send("/initiatepayment/", PAYMENT, HTTP_IDEMPOTENCY_KEY="refused").json()["ErrorCode"],
+                         301)
+        self.failing = ()
+        self.assertIsNone(self.send("/initiatepayment/", PAYMENT, HTTP_IDEMPOTENCY_KEY="refused").json()["ErrorCode"])
+        self.assertEqual(self.pnsCalls(), 2)
+
+    def test_purge_deletes_only_expired_keys(self):
+        now = djangoTimezone.now()
+        for key, age in (("old", timedelta(days=2)), ("recent", timedelta(hours=1))):
+            IdempotencyKey.objects.create(endpoint="InitiatePayment", key=key, requestHash="", state=COMPLETE,
+                                          created=now - age, updated=now - age)
+        self.assertEqual(purgeExpiredKeys(getIdempotencyConfig(), batchSize=1, now=now), 1)
+        self.assertEqual(list(IdempotencyKey.objects.values_list("key", flat=True)), ["recent"])
+
+
+@override_settings(PAYMENT_QUEUE={"ENABLED": True})
+class PaymentWorkerTests(EndpointTestCase):
+    """
+    Covers another worker looking for work while a queued payment is being sent.
+    """
+
+    def test_slow_conversion_keeps_the_lease_for_the_pns(self):
+        config = getQueueConfig()
+        self.send("/initiatepayment/", PAYMENT, HTTP_PREFER=RESPOND_ASYNC)
+        payment = claimPayment(config)
+        secondWorker = []
+
+        def upstream(service, path, **kwargs):
+            if path == "convert/":
+                # the conversion takes the whole lease
+                QueuedPayment.objects.filter(id=payment.id).update(available=djangoTimezone.now())
+            else:
+                secondWorker.append(claimPayment(config))
+            return self.upstream(service, path, **kwargs)
+
+        self.upstreamPost.side_effect = upstream
+        processPayment(payment, config)
+        self.assertEqual(secondWorker, [None])
+        self.assertEqual(QueuedPayment.objects.get(id=payment.id).state, QueueState.COMPLETE)
+
+
+class RefundClaimTests(EndpointTestCase):
+    """
+    Covers when the ledger entry claimed for a refund is given back after the PNS fails.
+    """
+
+    def test_unanswered_refund_keeps_its_claim(self):
+        # a PNS that timed out may still have refunded, so the payment can't be cancelled or refunded again
+        self.upstreamPost.side_effect = lambda service, path, **kwargs: (
+            UnavailableResponse("Read timed out.", unanswered=True) if path == "initiaterefundpns/"
+            else self.upstream(service, path, **kwargs))
+        self.assertEqual(self.send("/initiaterefund/", REFUND).json()["ErrorCode"], 403)
+        self.assertTrue(RefundEntry.objects.filter(payment_id=101, state=RefundState.PENDING).exists())
+        self.assertEqual(self.send("/initiatecancellation/", {"TransactionUUID": "101"}).json()["ErrorCode"], 404)
+
+    def test_refused_refund_gives_back_its_claim(self):
+        self.failing = ("initiaterefundpns/",)
+        self.assertEqual(self.send("/initiaterefund/", REFUND).json()["ErrorCode"], 403)
+        self.assertFalse(RefundEntry.objects.filter(payment_id=101).exists())
+        self.assertIsNone(self.send("/initiatecancellation/", {"TransactionUUID": "101"}).json()["ErrorCode"])
+
+
+@skipUnless(LATENCY_TESTS, "set CW2_LATENCY_TESTS=1 to time the cases against their baselines")
+class LatencyBudgetTests(EndpointTestCase):
+    """
+    Fails when a case is more than LATENCY_MARGIN and LATENCY_SLACK_MS slower than the time stored for it in
+    BASELINES_FILE. Set CW2_UPDATE_BASELINES=1 to store this run's times instead, on the machine the tests run on.
+    """
+
+    def test_cases(self):
+        baselines = json.loads(BASELINES_FILE.read_text()) if BASELINES_FILE.exists() else {}
+        measured = {}
+        # the first requests also pay for imports and connection setup, which no later request does
+        for name, url, body, queries, status, errorCode, failing in CASES:
+            self.failing = failing
+            with self.isolated():
+                self.send(url, body)
+        for name, url, body, queries, status, errorCode, failing in CASES:
+            self.failing = failing
+            measured[name] = self.timeCase(url, body)
+
+        if os.environ.get("CW2_UPDATE_BASELINES"):
+            BASELINES_FILE.write_text(json.dumps({name: round(seconds * 1000, 3)
+                                                  for name, seconds in measured.items()}, indent=2) + "\n")
+            return
+
+        for name, seconds in measured.items():
+            with self.subTest(name):
+                if name not in baselines:
+                    self.skipTest("no baseline for {}".format(name))
+                budget = baselines[name] * (1 + LATENCY_MARGIN) + LATENCY_SLACK_MS
+                self.assertLessEqual(seconds * 1000, budget,
+                                     "{} took {:.2f}ms, its budget is {:.2f}ms".format(name, seconds * 1000, budget))
+
+    def timeCase(self, url, body):
+        """
+
+        :param url: the endpoint
+        :param body: the request body
+        :return: the fastest of LATENCY_REPEATS requests, in seconds
+        """
+        fastest = None
+        for _ in range(LATENCY_REPEATS):
+            with self.isolated():
+                started = time.perf_counter()
+                self.send(url, body)
+                elapsed = time.perf_counter() - started
+            fastest = elapsed if fastest is None else min(fastest, elapsed)
+        return fastest
@@ -0,0 +1,214 @@
+import asyncio
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.decorators import sync_and_async_middleware
+
+# defaults used when REQUEST_TIMING does not override them
+DEFAULT_REQUEST_TIMING = {
+    "ENABLED": True,
+    "SAMPLE_RATE": 1.0,  # fraction of requests that are timed
+    "SERVER_TIMING_HEADER": True,  # report the phases of timed requests back to the client
+}
+
+# the phases a request can spend time in, each request keeps one float per phase
+PHASES = ("validate", "payer", "payee", "transaction", "currency", "pns", "save")
+PHASE_INDEX = {phase: index for index, phase in enumerate(PHASES)}
+
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# phase durations of the request being handled, or None if it isn't being timed
+_phases = ContextVar("phases", default=None)
+
+
+class Histogram:
+    """
+    Counts of observed durations per bucket, plus their sum, as exposed to Prometheus.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(BUCKETS, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum
+
+
+class Registry:
+    """
+    Histograms keyed on their metric name and label values, created the first time each is observed.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+        histogram.observe(value)
+
+    def render(self):
+        """
+
+        :return: every histogram in the Prometheus text exposition format
+        """
+        lines = []
+        seen = set()
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append("# HELP {} {}".format(name, METRICS[name]))
+                lines.append("# TYPE {} histogram".format(name))
+            counts, total = histogram.snapshot()
+            labelText = ",".join('{}="{}"'.format(key, value) for key, value in labels)
+            prefix = labelText + "," if labelText else ""
+            cumulative = 0
+            for bound, count in zip(BUCKETS, counts):
+                cumulative += count
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, prefix, bound, cumulative))
+            cumulative += counts[-1]
+            lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(name, prefix, cumulative))
+            lines.append("{}_sum{{{}}} {}".format(name, labelText, total))
+            lines.append("{}_count{{{}}} {}".format(name, labelText, cumulative))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = {
+    "cw2_request_duration_seconds": "Time taken to handle a request, per endpoint.",
+    "cw2_phase_duration_seconds": "Time a request spent in each phase, per endpoint.",
+    "cw2_upstream_duration_seconds": "Time taken by calls to upstream services.",
+}
+
+registry = Registry()
+
+
+def getConfig():
+    return dict(DEFAULT_REQUEST_TIMING, **getattr(settings, "REQUEST_TIMING", {}))
+
+
+def start():
+    """
+
+    :return: the time a phase started, or None if the request isn't being timed
+    """
+    if _phases.get() is None:
+        return None
+    return time.perf_counter()
+
+
+def stop(phase, started):
+    """
+
+    :param phase: one of PHASES
+    :param started: the value start returned when the phase began
+    """
+    if started is None:
+        return
+    phases = _phases.get()
+    if phases is not None:
+        phases[PHASE_INDEX[phase]] += time.perf_counter() - started
+
+
+def observeUpstream(upstream, started):
+    """
+
+    :param upstream: the name of the upstream endpoint that was called
+    :param started: the value of time.perf_counter() when the call began
+    """
+    # only calls made by a sampled request are recorded, so SAMPLE_RATE and ENABLED cover them as well
+    if _phases.get() is not None:
+        registry.observe("cw2_upstream_duration_seconds", (("upstream", upstream),), time.perf_counter() - started)
+
+
+def endpointOf(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unmatched"
+    return match.route or "root"
+
+
+def finish(request, response, phases, started, serverTiming):
+    # the request is done, so its durations go into the histograms and the Server-Timing header
+    elapsed = time.perf_counter() - started
+    endpoint = endpointOf(request)
+    labels = (("endpoint", endpoint),)
+    registry.observe("cw2_request_duration_seconds", labels, elapsed)
+    header = []
+    for phase, duration in zip(PHASES, phases):
+        if duration:
+            registry.observe("cw2_phase_duration_seconds", labels + (("phase", phase),), duration)
+            header.append("{};dur={:.3f}".format(phase, duration * 1000))
+    if serverTiming:
+        header.append("total;dur={:.3f}".format(elapsed * 1000))
+        response["Server-Timing"] = ", ".join(header)
+
+
+def sampled(rate):
+    return rate >= 1 or random.random() < rate
+
+
+@sync_and_async_middleware
+def TimingMiddleware(get_response):
+    """
+    Times each sampled request and the phases within it, records them in the histograms served at /metrics and
+    reports them in a Server-Timing header.
+    """
+
+    # settings are read once when the middleware is built, not on every request
+    config = getConfig()
+    rate = config["SAMPLE_RATE"] if config["ENABLED"] else 0
+    serverTiming = config["SERVER_TIMING_HEADER"]
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            if not sampled(rate):
+                return await get_response(request)
+            phases = [0.0] * len(PHASES)
+            token = _phases.set(phases)
+            started = time.perf_counter()
+            try:
+                response = await get_response(request)
+            finally:
+                _phases.reset(token)
+            finish(request, response, phases, started, serverTiming)
+            return response
+    else:
+        def middleware(request):
+            if not sampled(rate):
+                return get_response(request)
+            phases = [0.0] * len(PHASES)
+            token = _phases.set(phases)
+            started = time.perf_counter()
+            try:
+                response = get_response(request)
+            finally:
+                _phases.reset(token)
+            finish(request, response, phases, started, serverTiming)
+            return response
+
+    return middleware
+
+
+def Metrics(request):
+    # serves the histograms for Prometheus to scrape
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
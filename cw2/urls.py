@@ -15,11 +15,16 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
-import cw2.views as views
+import cw2.api_urls as api_urls
+import cw2.export as export
+import cw2.history_views as history_views
+import cw2.settlement_views as settlement_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('initiatepayment/', views.InitiatePayment),
-    path('initiaterefund/', views.InitiateRefund),
-    path('initiatecancellation/', views.InitiateCancellation)
-]
+    path('transactions/export/', export.ExportTransactions),
+    # staff only, so served where the admin's logins are
+    path('transactions/personal/<int:accountNumber>/', history_views.PersonalHistory),
+    path('transactions/business/<int:accountNumber>/', history_views.BusinessHistory),
+    path('settlement/<int:accountNumber>/', settlement_views.Settlement),
+] + api_urls.urlpatterns
@@ -0,0 +1,148 @@
+import re
+from datetime import date
+
+from cw2.error_handling import errorHandling
+
+# formats are compiled once at import rather than on every request
+EMAIL_REGEX = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b')
+CARD_NUMBER_REGEX = re.compile(r'[0-9]{8,16}')
+CVV_REGEX = re.compile(r'[0-9]{3,4}')
+ACCOUNT_NUMBER_REGEX = re.compile(r'[0-9]{1,8}')
+SORT_CODE_REGEX = re.compile(r'[0-9]{6}')
+ISO_DATE_REGEX = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+
+
+class Field:
+    """
+    One field of a request body: the type it must have, an optional normalisation applied to its value and an
+    optional check the normalised value must pass.
+    """
+
+    def __init__(self, fieldType, normalise=None, check=None):
+        self.fieldType = fieldType
+        self.normalise = normalise
+        self.check = check
+
+
+class Schema:
+    """
+    The fields an endpoint's body must have, compiled once so each request is validated in a single pass.
+    """
+
+    def __init__(self, fields):
+        """
+
+        :param fields: a dict of field name to Field, in the order errors should be reported
+        """
+        self.fields = tuple((name, field.fieldType, field.normalise, field.check) for name, field in fields.items())
+        self.names = frozenset(fields)
+
+    def validate(self, data):
+        """
+
+        :param data: the body sent to the endpoint
+        :return: the normalised data or error message and then boolean indicating which it is
+        """
+
+        # check body isn't empty
+        if not data:
+            return errorHandling(100), False
+        if not isinstance(data, dict):
+            return errorHandling(101), False
+
+        # missing fields and wrong types are reported before any invalid value, so the first invalid value is
+        # remembered and only reported once every field has been seen
+        invalid = None
+        for name, fieldType, normalise, check in self.fields:
+            if name not in data:
+                return errorHandling(102, name), False
+            value = data[name]
+            if not isinstance(value, fieldType):
+                return errorHandling(103, [name, value, fieldType]), False
+            if invalid is not None:
+                continue
+            try:
+                if normalise is not None:
+                    value = data[name] = normalise(value)
+                if check is not None and not check(value):
+                    invalid = name
+            except ValueError:
+                invalid = name
+
+        # check for no addition fields in the body
+        if len(data) != len(self.fields):
+            return errorHandling(104, next(name for name in data if name not in self.names)), False
+
+        if invalid is not None:
+            return errorHandling(104, invalid), False
+
+        # if here then validation has been passed
+        return data, True
+
+
+def maxLength(limit):
+    return lambda value: len(value) <= limit
+
+
+def matches(regex):
+    return lambda value: regex.fullmatch(value) is not None
+
+
+def positive(value):
+    return value > 0.00
+
+
+def luhnValid(value):
+    # every second digit from the right is doubled, and the digits of the result summed
+    total = 0
+    for position, digit in enumerate(reversed(value)):
+        digit = ord(digit) - 48
+        if position % 2:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return total % 10 == 0
+
+
+def cardNumber(value):
+    return CARD_NUMBER_REGEX.fullmatch(value) is not None and luhnValid(value)
+
+
+def isoDate(value):
+    match = ISO_DATE_REGEX.fullmatch(value)
+    if match is None:
+        raise ValueError(value)
+    return date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+
+
+def stripSeparators(value):
+    return value.replace("-", "")
+
+
+PAYMENT_SCHEMA = Schema({
+    # in case of spaces in credit card number
+    "CardNumber": Field(str, normalise=str.strip, check=cardNumber),
+    "CVV": Field(str, check=matches(CVV_REGEX)),
+    "Expiry": Field(str, normalise=isoDate),
+    "CardHolderName": Field(str, check=maxLength(80)),
+    "CardHolderAddress": Field(str),
+    "Email": Field(str, check=matches(EMAIL_REGEX)),
+    "PayeeBankAccNum": Field(str, check=matches(ACCOUNT_NUMBER_REGEX)),
+    # remove any - separators before checking the length
+    "PayeeBankSortCode": Field(str, normalise=stripSeparators, check=matches(SORT_CODE_REGEX)),
+    "RecipientName": Field(str, check=maxLength(80)),
+    "Amount": Field(float, check=positive),
+    "PayerCurrencyCode": Field(str),
+    "PayeeCurrencyCode": Field(str),
+})
+
+REFUND_SCHEMA = Schema({
+    "TransactionUUID": Field(str),
+    "Amount": Field(float, check=positive),
+    "CurrencyCode": Field(str),
+})
+
+CANCELLATION_SCHEMA = Schema({
+    "TransactionUUID": Field(str),
+})
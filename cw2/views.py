@@ -1,16 +1,26 @@
 import json
-import random
-import re
-from datetime import date, datetime
+from datetime import date
 
+from django.db.models import Sum
+from django.db.transaction import atomic, set_rollback
 from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
-from cw2.error_handling import errorHandling, checkBody, checkMethod
-import requests
-import luhn
-from cw2.models import Transaction, PersonalAccount, BusinessAccount, PaymentDetails, BankDetails
+from cw2.error_handling import errorHandling, checkMethod, readUpstream
+from cw2.validators import PAYMENT_SCHEMA, REFUND_SCHEMA, CANCELLATION_SCHEMA
+from cw2 import http_client, timing
+from cw2.idempotency import idempotent
+from cw2.payment_queue import wantsQueue, queuePayment
+from cw2.currency_cache import cachedConversion, rememberConversion
+from cw2.account_cache import payerKey, payeeKey, getRows, storeRows
+from cw2.settlement import recordPayments, recordRefund, moveSummary, toMinorUnits, fromMinorUnits
+from cw2.archive import isArchived
+from cw2.models import Transaction, TransactionStatus, PaymentDetails, BankDetails, RefundEntry, RefundState, \
+    cardFingerprint
 
 @csrf_exempt
+@idempotent
 def InitiatePayment(request):
     # returns the data or error message and boolean indicating which that is
     data, methodStatus = checkMethod(request)
@@ -19,184 +29,313 @@ def InitiatePayment(request):
     if not methodStatus:
         return data
 
-    correct_keys = {"CardNumber": str,
-                    "CVV": str,
-                    "Expiry": str,
-                    "CardHolderName": str,
-                    "CardHolderAddress": str,
-                    "Email": str,
-                    "PayeeBankAccNum": str,
-                    "PayeeBankSortCode": str,
-                    "RecipientName": str,
-                    "Amount": float,
-                    "PayerCurrencyCode": str,
-                    "PayeeCurrencyCode": str
-                    }
+    # stores the cleaned data if formatted correctly, else returns an error message
+    data, bodyStatus = checkPayment(data)
+    if not bodyStatus:
+        return data
 
-    # stores None if formatted correctly, else returns an error message
-    bodyStatus = checkBody(data, correct_keys)
-    if bodyStatus is not None:
-        return bodyStatus
+    # check that the payer card and personal account exist and match
+    payerData, payerStatus = lookupPayer(data)
+    if not payerStatus:
+        return payerData
+
+    # make sure that the payee details match those of a registered business account and
+    # that the corresponding bank details also match
+    businessData, payeeStatus = lookupPayee(data)
+    if not payeeStatus:
+        return businessData
 
-    # check all fields fit their specific criteria
+    # clients that asked for it are answered now and the upstreams are contacted by a processpayments worker
+    if wantsQueue(request):
+        return queuePayment(data, payerData, businessData)
 
-    # in case of spaces in credit card number
-    data["CardNumber"] = data["CardNumber"].strip()
-    # check correct length and card number formatting
-    if len(data["CardNumber"]) < 8 or len(data["CardNumber"]) > 16 or not luhn.verify(data["CardNumber"]):
-        return errorHandling(104, "CardNumber")
+    # for testing purposes
+    currencyResponse = ConvertCurrency(paymentCurrencyData(data))  # status, error code, amount
 
-    # check made up of only numbers and is 3-4 characters long
-    if not data["CVV"].isdigit() or len(data["CVV"]) not in (3, 4):
-        return errorHandling(104, "CVV")
+    # error has occurred when converting currency
+    currencyResponseData, currencyStatus = readUpstream(currencyResponse, 201)
+    if not currencyStatus:
+        return currencyResponseData
 
-    # check expiry is in date format
+    # we now talk to PNS and get them to initiate the payment itself
+    transactionResponse = RequestTransactionPNS(paymentPNSData(data, currencyResponseData["Amount"]))
+
+    # error has occurred when doing transaction
+    transactionResponseData, transactionStatus = readUpstream(transactionResponse, 301)
+    if not transactionStatus:
+        return transactionResponseData
+
+    return storePayment(data, payerData, businessData, transactionResponseData["TransactionUUID"],
+                        currencyResponseData["Amount"])
+
+
+# checks the payment body has every field and that each fits its specific criteria
+def checkPayment(data):
+    """
+
+    :param data: the body sent to the payment endpoint
+    :return: the cleaned data or error message and then boolean indicating which it is
+    """
+    started = timing.start()
+    result = PAYMENT_SCHEMA.validate(data)
+    timing.stop("validate", started)
+    return result
+
+
+# builds the currency converter body for a payment
+def paymentCurrencyData(data):
+    """
+
+    :param data: the validated payment body
+    :return: the body to send to the currency converter
+    """
+    return {"CurrencyFrom": data["PayerCurrencyCode"], "CurrencyTo": data["PayeeCurrencyCode"],
+            "Date": str(date.today()), "Amount": data["Amount"]}
+
+
+# builds the PNS body for a payment
+def paymentPNSData(data, amount):
+    """
+
+    :param data: the validated payment body
+    :param amount: the payment amount in the payee's currency
+    :return: the body to send to the PNS
+    """
+    return {"CardNumber": data["CardNumber"],
+            "Expiry": data["Expiry"],
+            "CVV": data["CVV"],
+            "HolderName": data["CardHolderName"],
+            "BillingAddress": data["CardHolderAddress"],
+            "Amount": amount,
+            "CurrencyCode": data["PayeeCurrencyCode"],
+            "AccountNumber": data["PayeeBankAccNum"],
+            "Sort-Code": data["PayeeBankSortCode"],
+            }
+
+
+# stores a payment the PNS has accepted
+def storePayment(data, payerData, businessData, transactionId, amount):
+    """
+
+    :param data: the validated payment body
+    :param payerData: the resolved payer account
+    :param businessData: the resolved payee account
+    :param transactionId: the ID the PNS gave the transaction
+    :param amount: the payment amount in the payee's currency
+    :return: an HTTP formatted response for the client
+    """
+
+    # store the transaction in the database, along with its payee's settlement totals
+    started = timing.start()
     try:
-        data["Expiry"] = datetime.strptime(data["Expiry"], '%Y-%m-%d').date()
-    except:
-        return errorHandling(104, "Expiry")
+        confirmedTransaction = makePaymentTransaction(data, payerData, businessData, transactionId, amount)
+        with atomic():
+            # the ID comes from the PNS, so Django would otherwise try an UPDATE first
+            confirmedTransaction.save(force_insert=True)
+            recordPayments([confirmedTransaction])
+    except Exception as e:
+        return errorHandling(401, str(e))
+    finally:
+        timing.stop("save", started)
 
-    # Check card-holder name isn't too long
-    if len(data["CardHolderName"]) > 80:
-        return errorHandling(104, "CardHolderName")
+    # returning positive response
+    responseData = {"TransactionUUID": transactionId,
+                    "ErrorCode": None,
+                    "Comment": "Transaction processed successfully"
+                    }
 
-    # Check email is valid syntactically
-    emailRegex = r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,7}\b'
-    if not re.fullmatch(emailRegex, data["Email"]):
-        return errorHandling(104, "Email")
+    return JsonResponse(responseData, status=200)
 
-    if not data["PayeeBankAccNum"].isdigit() or len(data["PayeeBankAccNum"]) > 8 or len(data["PayeeBankAccNum"]) < 1:
-        return errorHandling(104, "PayeeBankAccNum")
 
-    # remove any - separators and ensure length is 6
-    data["PayeeBankSortCode"] = data["PayeeBankSortCode"].replace("-", "")
-    if not data["PayeeBankSortCode"].isdigit() or len(data["PayeeBankSortCode"]) != 6:
-        return errorHandling(104, "PayeeBankSortCode")
+# fields read when resolving a payer, one row per personal account linked to each card
+PAYER_FIELDS = ("paymentId", "expiryDate", "personalaccount__accountNumber", "personalaccount__fullName",
+                "personalaccount__email")
 
-    # Check card-holder name isn't too long
-    if len(data["RecipientName"]) > 80:
-        return errorHandling(104, "RecipientName")
+# fields read when resolving a payee, bank details are one to one with business accounts
+PAYEE_FIELDS = ("accountNumber", "businessaccount__accountNumber", "businessaccount__businessName")
 
-    # positive amounts only
-    if data["Amount"] <= 0.00:
-        return errorHandling(104, "Amount")
 
-    # check that the payment account of the payer exists
-    allPaymentData = PaymentDetails.objects.filter(cardNumber=data["CardNumber"],
-                                                   securityCode=data["CVV"]).values()
-    # incorrect card number of CVV
-    if len(allPaymentData) != 1:
-        return errorHandling(106)
+# builds the transaction row for a payment the PNS has accepted
+def makePaymentTransaction(data, payerData, businessData, transactionId, amount):
+    """
 
-    # queryset can be condensed
-    paymentData = allPaymentData[0]
+    :param data: the validated payment body
+    :param payerData: the resolved payer account
+    :param businessData: the resolved payee account
+    :param transactionId: the ID the PNS gave the transaction
+    :param amount: the payment amount in the payee's currency
+    :return: an unsaved transaction
+    """
+    confirmedTransaction = Transaction()
+    confirmedTransaction.id = transactionId
+    confirmedTransaction.payer_id = payerData["accountNumber"]
+    confirmedTransaction.payee_id = businessData["accountNumber"]
+    confirmedTransaction.amount = amount
+    confirmedTransaction.currency = data["PayeeCurrencyCode"]
+    confirmedTransaction.date = timezone.now()
+    confirmedTransaction.transactionStatus = TransactionStatus.COMPLETE
+    return confirmedTransaction
 
-    # incorrect expiry date
-    if paymentData["expiryDate"].date() != data["Expiry"]:
-        return errorHandling(106)
 
-    # check that the payee details provided match those linked to the bank account
-    allPayerData = PersonalAccount.objects.filter(paymentDetails=paymentData["paymentId"]).all()
+# resolves the payer card and its personal account in a single joined query
+def lookupPayer(data):
+    """
 
-    # personal account does not exist
-    if len(allPayerData) != 1:
-        return errorHandling(108)
+    :param data: the validated payment body
+    :return: the payer account fields or error message and then boolean indicating which it is
+    """
+
+    # one row per personal account linked to the card, or one row with nulls if none
+    started = timing.start()
+    key = payerKey(data["CardNumber"], data["CVV"])
+    rows = getRows(key)
+    if rows is None:
+        rows = PaymentDetails.objects.filter(cardFingerprint=cardFingerprint(data["CardNumber"])) \
+            .values("securityCode", *PAYER_FIELDS)
+        rows = withSecurityCode(rows, data["CVV"])
+        storeRows(key, rows)
+    timing.stop("payer", started)
+
+    return matchPayer(data, rows)
+
+
+def withSecurityCode(rows, securityCode):
+    # the card was found by its fingerprint alone, so the CVV is checked here, in constant time
+    return [{field: row[field] for field in PAYER_FIELDS} for row in rows
+            if constant_time_compare(row["securityCode"], securityCode)]
+
+
+# checks the rows found for a payer card against the payment body
+def matchPayer(data, rows):
+    """
+
+    :param data: the validated payment body
+    :param rows: the PAYER_FIELDS rows for the card number in the body whose CVV matched
+    :return: the payer account fields or error message and then boolean indicating which it is
+    """
+
+    # incorrect card number or CVV
+    if len({row["paymentId"] for row in rows}) != 1:
+        return errorHandling(106), False
+
+    # incorrect expiry date
+    if rows[0]["expiryDate"].date() != data["Expiry"]:
+        return errorHandling(106), False
 
-    # queryset can be condensed
-    payerData = allPayerData[0]
+    # personal account does not exist
+    accounts = [row for row in rows if row["personalaccount__accountNumber"] is not None]
+    if len(accounts) != 1:
+        return errorHandling(108), False
 
     # make sure all other fields for personal accounts match
-    if payerData.fullName != data["CardHolderName"] or payerData.email != data["Email"]:
-        return errorHandling(108)
+    account = accounts[0]
+    if account["personalaccount__fullName"] != data["CardHolderName"] or \
+            account["personalaccount__email"] != data["Email"]:
+        return errorHandling(108), False
 
-    # make sure that the payee details match those of a registered business account and
-    # that the corresponding bank details also match
+    return {"accountNumber": account["personalaccount__accountNumber"],
+            "fullName": account["personalaccount__fullName"],
+            "email": account["personalaccount__email"]}, True
 
-    allBankData = BankDetails.objects.filter(accountNumber=data["PayeeBankAccNum"],
-                                             sortCode=data["PayeeBankSortCode"],
-                                             accountName=data["RecipientName"]).all()
-    # if no bank details found
-    if len(allBankData) != 1:
-        return errorHandling(107)
 
-    # see if bank corresponds to business account
-    allBusinessData = BusinessAccount.objects.filter(bankDetails=allBankData[0].accountNumber).all()
+# resolves the payee bank details and their business account in a single joined query
+def lookupPayee(data):
+    """
+
+    :param data: the validated payment body
+    :return: the payee account fields or error message and then boolean indicating which it is
+    """
+
+    # at most one row per bank account, busy payees are almost always found in the cache
+    started = timing.start()
+    key = payeeKey(data["PayeeBankAccNum"], data["PayeeBankSortCode"], data["RecipientName"])
+    rows = getRows(key)
+    if rows is None:
+        rows = BankDetails.objects.filter(accountNumber=data["PayeeBankAccNum"],
+                                          sortCode=data["PayeeBankSortCode"],
+                                          accountName=data["RecipientName"]).values(*PAYEE_FIELDS)
+        rows = list(rows)
+        storeRows(key, rows)
+    timing.stop("payee", started)
+
+    return matchPayee(data, rows)
 
-    # if no corresponding account
-    if len(allBusinessData) != 1:
-        return errorHandling(109)
 
-    # trim query
-    businessData = allBusinessData[0]
+# checks the rows found for a payee bank account against the payment body
+def matchPayee(data, rows):
+    """
+
+    :param data: the validated payment body
+    :param rows: the PAYEE_FIELDS rows for the bank account, sort code and name in the body
+    :return: the payee account fields or error message and then boolean indicating which it is
+    """
+
+    # if no bank details found
+    if len(rows) != 1:
+        return errorHandling(107), False
+
+    # if no corresponding account
+    account = rows[0]
+    if account["businessaccount__accountNumber"] is None:
+        return errorHandling(109), False
 
     # if other details don't also match
-    if businessData.businessName != data["RecipientName"]:
-        return errorHandling(109)
+    if account["businessaccount__businessName"] != data["RecipientName"]:
+        return errorHandling(109), False
 
+    return {"accountNumber": account["businessaccount__accountNumber"],
+            "businessName": account["businessaccount__businessName"]}, True
 
-    currencyData = {"CurrencyFrom": data["PayerCurrencyCode"], "CurrencyTo": data["PayeeCurrencyCode"],
-                    "Date": str(date.today()), "Amount": data["Amount"]}
 
-    # for testing purposes
-    currencyResponse = ConvertCurrency(currencyData)  # status, error code, amount
-    currencyResponseData = currencyResponse.json()
+@csrf_exempt
+@idempotent
+def InitiateRefund(request):
+    # returns the data or error message and boolean indicating which that is
+    data, methodStatus = checkMethod(request)
+    print(data)
+    # data contains error message if the body wasn't in the correct format
+    if not methodStatus:
+        return data
 
-    # error has occurred when converting currency
-    if currencyResponse.status_code != 200:
-        if "Comment" in currencyResponseData:
-            return errorHandling(201, body=currencyResponseData["Comment"], passedComment=True)
-        else:
-            return errorHandling(201)
+    # stores the data if formatted correctly, else returns an error message
+    data, bodyStatus = checkRefund(data)
+    if not bodyStatus:
+        return data
 
-    # currencyResponseData = {"Status": 200, "Error code": None, "Amount": data["Amount"]}
+    # check transaction exists and can still be refunded
+    oldTransaction, transactionStatus = findCompleteTransaction(data["TransactionUUID"])
+    if not transactionStatus:
+        return oldTransaction
 
-    # we now talk to PNS and get them to initiate the payment itself
-    paymentData = {"CardNumber": data["CardNumber"],
-                   "Expiry": data["Expiry"],
-                   "CVV": data["CVV"],
-                   "HolderName": data["CardHolderName"],
-                   "BillingAddress": data["CardHolderAddress"],
-                   "Amount": currencyResponseData["Amount"],
-                   "CurrencyCode": currencyData["CurrencyTo"],
-                   "AccountNumber": data["PayeeBankAccNum"],
-                   "Sort-Code": data["PayeeBankSortCode"],
-                   }
-
-    transactionResponse = RequestTransactionPNS(paymentData)
-    transactionResponseData = transactionResponse.json()
-    # error has occurred when doing transaction
-    if transactionResponse.status_code != 200:
-        if "Comment" in transactionResponseData:
-            return errorHandling(301, body=transactionResponseData["Comment"], passedComment=True)
-        else:
-            return errorHandling(301)
+    # the refund is converted into the currency the payment was made in
+    currencyResponse = ConvertCurrency(refundCurrencyData(data, oldTransaction))  # status, error code, amount
 
+    # error has occurred when converting currency
+    currencyResponseData, currencyStatus = readUpstream(currencyResponse, 201)
+    if not currencyStatus:
+        return currencyResponseData
 
-    # store the transaction in the database
-    try:
-        confirmedTransaction = Transaction()
-        confirmedTransaction.id = transactionResponseData["TransactionUUID"]
-        confirmedTransaction.payer = payerData
-        confirmedTransaction.payee = businessData
-        confirmedTransaction.amount = currencyResponseData["Amount"]
-        confirmedTransaction.currency = data["PayeeCurrencyCode"]
-        confirmedTransaction.date = date(year=2000,month=1,day=1) #datetime.now()
-        confirmedTransaction.transactionStatus = "Complete"
-        confirmedTransaction.save()
-    except Exception as e:
-        return errorHandling(401, str(e))
+    # claim the amount before contacting the PNS, so concurrent refunds and cancellations can't also spend it
+    entry, claimStatus = claimRefund(oldTransaction, currencyResponseData["Amount"])
+    if not claimStatus:
+        return entry
 
-    # returning positive response
-    responseData = {"TransactionUUID": transactionResponseData["TransactionUUID"],
-                    "ErrorCode": None,
-                    "Comment": "Transaction processed successfully"
-                    }
+    # we now talk to PNS and get them to initiate the refund itself
+    transactionResponse = RequestRefundPNS(refundPNSData(data, oldTransaction, entry))
 
-    return JsonResponse(responseData, status=200)
+    # error has occurred when doing transaction
+    transactionResponseData, transactionStatus = readUpstream(transactionResponse, 403)
+    if not transactionStatus:
+        # the PNS may have refunded without answering, so the claim is kept until someone checks with it
+        if not getattr(transactionResponseData, "upstreamUnanswered", False):
+            releaseRefund(entry)
+        return transactionResponseData
+
+    return storeRefund(oldTransaction, entry)
 
 
 @csrf_exempt
-def InitiateRefund(request):
+def InitiateCancellation(request):
     # returns the data or error message and boolean indicating which that is
     data, methodStatus = checkMethod(request)
     print(data)
@@ -204,72 +343,218 @@ def InitiateRefund(request):
     if not methodStatus:
         return data
 
-    correct_keys = {"TransactionUUID": str,
-                    "Amount": float,
-                    "CurrencyCode": str,
-                    }
+    # stores the data if formatted correctly, else returns an error message
+    data, bodyStatus = checkCancellation(data)
+    if not bodyStatus:
+        return data
+
+    return cancelTransaction(data["TransactionUUID"])
+
+
+# checks the refund body has every field and that each fits its specific criteria
+def checkRefund(data):
+    """
 
-    # stores None if formatted correctly, else returns an error message
-    bodyStatus = checkBody(data, correct_keys)
-    if bodyStatus is not None:
-        return bodyStatus
+    :param data: the body sent to the refund endpoint
+    :return: the data or error message and then boolean indicating which it is
+    """
+    started = timing.start()
+    result = REFUND_SCHEMA.validate(data)
+    timing.stop("validate", started)
+    return result
 
-    # amount needs to be more than zero
-    if data["Amount"] <= 0.00:
-        return errorHandling(104, "Amount")
+
+# checks the cancellation body has every field
+def checkCancellation(data):
+    """
+
+    :param data: the body sent to the cancellation endpoint
+    :return: the data or error message and then boolean indicating which it is
+    """
+    started = timing.start()
+    result = CANCELLATION_SCHEMA.validate(data)
+    timing.stop("validate", started)
+    return result
+
+
+# finds a transaction that has completed and not yet been refunded or cancelled
+def findCompleteTransaction(transactionId):
+    """
+
+    :param transactionId: the ID of the transaction
+    :return: the transaction or error message and then boolean indicating which it is
+    """
+
+    # IDs are integers, so anything else can't exist
+    if not isTransactionId(transactionId):
+        return errorHandling(402, transactionId), False
 
     # check transaction exists
-    queriedTransactions = Transaction.objects.filter(id=data["TransactionUUID"]).all()
+    started = timing.start()
+    queriedTransactions = list(Transaction.objects.filter(id=transactionId))
+    timing.stop("transaction", started)
 
     # if no corresponding account
     if len(queriedTransactions) != 1:
-        return errorHandling(402, data["TransactionUUID"])
+        if isArchived(transactionId):
+            return errorHandling(117, transactionId), False
+        return errorHandling(402, transactionId), False
 
     oldTransaction = queriedTransactions[0]
-    if oldTransaction.transactionStatus != "Complete":
+    if oldTransaction.transactionStatus != TransactionStatus.COMPLETE:
+        return errorHandling(404), False
+
+    return oldTransaction, True
+
+
+def isTransactionId(transactionId):
+    return transactionId.isascii() and transactionId.isdigit()
+
+
+# moves a transaction from one status to another in a single conditional update
+def transitionTransaction(transactionId, fromStatus, toStatus, blockedBy=None):
+    """
+
+    :param transactionId: the ID of the transaction
+    :param fromStatus: the status the transaction must currently have
+    :param toStatus: the status to give it
+    :param blockedBy: a queryset that stops the transition if it finds anything, defaults to None
+    :return: whether the transaction had fromStatus and was moved to toStatus
+    """
+    with atomic():
+        if not Transaction.objects.filter(id=transactionId,
+                                          transactionStatus=fromStatus).update(transactionStatus=toStatus):
+            return False
+        # checked once the update holds the row's lock, so whatever locked it before has committed and is seen
+        if blockedBy is not None and blockedBy.exists():
+            set_rollback(True)
+            return False
+        # the payee's settlement totals change with the status
+        moveSummary(transactionId, fromStatus, toStatus)
+        return True
+
+
+# works out why a transition found nothing to update
+def transitionError(transactionId):
+    """
+
+    :param transactionId: the ID of the transaction
+    :return: an HTTP formatted error message
+    """
+    if isTransactionId(transactionId) and Transaction.objects.filter(id=transactionId).exists():
         return errorHandling(404)
+    if isTransactionId(transactionId) and isArchived(transactionId):
+        return errorHandling(117, transactionId)
+    return errorHandling(402, transactionId)
 
-    currencyData = {"CurrencyFrom": data["CurrencyCode"], "CurrencyTo": oldTransaction.currency,
-                    "Date": str(date.today()), "Amount": oldTransaction.amount}
-    currencyResponse = ConvertCurrency(currencyData)  # status, error code, amount
-    currencyResponseData = currencyResponse.json()
 
-    # error has occurred when converting currency
-    if currencyResponse.status_code != 200:
-        if "Comment" in currencyResponseData:
-            return errorHandling(201, body=currencyResponseData["Comment"], passedComment=True)
-        else:
-            return errorHandling(201)
-    # currencyResponseData = {"Status": 200, "Error code": None, "Amount": data["Amount"]}
+# claims part of a complete transaction for refunding
+def claimRefund(oldTransaction, amount):
+    """
 
-    # we now talk to PNS and get them to initiate the payment itself
-    paymentData = {"TransactionUUID": data["TransactionUUID"],
-                   "Amount": currencyResponseData["Amount"],
-                   "CurrencyCode": data["CurrencyCode"],
-                   }
+    :param oldTransaction: the transaction being refunded
+    :param amount: the amount to refund, in the transaction's currency
+    :return: the pending ledger entry or error message and then boolean indicating which it is
+    """
+    amount = toMinorUnits(amount, oldTransaction.currency)
+    if amount <= 0:
+        return errorHandling(104, "Amount"), False
 
-    transactionResponse = RequestRefundPNS(paymentData)
-    transactionResponseData = transactionResponse.json()
-    # error has occurred when doing transaction
-    if transactionResponse.status_code != 200:
-        if "Comment" in transactionResponseData:
-            return errorHandling(403, body=transactionResponseData["Comment"], passedComment=True)
-        else:
-            return errorHandling(403)
+    started = timing.start()
+    try:
+        with atomic():
+            # the payment stays locked until the entry is written, so two refunds can't both spend what is left
+            if not Transaction.objects.select_for_update().filter(id=oldTransaction.id,
+                                                                  transactionStatus=TransactionStatus.COMPLETE) \
+                    .values_list("id", flat=True):
+                # another refund or a cancellation got there first
+                return errorHandling(404), False
+            claimed = RefundEntry.objects.filter(payment_id=oldTransaction.id).aggregate(total=Sum("amount"))
+            remaining = toMinorUnits(oldTransaction.amount, oldTransaction.currency) - (claimed["total"] or 0)
+            if amount > remaining:
+                return errorHandling(118, "{} {}".format(fromMinorUnits(remaining, oldTransaction.currency),
+                                                         oldTransaction.currency)), False
+            entry = RefundEntry.objects.create(payment_id=oldTransaction.id, amount=amount,
+                                               state=RefundState.PENDING, created=timezone.now())
+    except Exception as e:
+        return errorHandling(401, str(e)), False
+    finally:
+        timing.stop("transaction", started)
+
+    return entry, True
+
+
+def releaseRefund(entry):
+    # the refund didn't happen, so its amount can be refunded or the transaction cancelled again
+    RefundEntry.objects.filter(id=entry.id, state=RefundState.PENDING).delete()
 
-    # store the transaction in the database
+
+# builds the currency converter body for a refund
+def refundCurrencyData(data, oldTransaction):
+    """
+
+    :param data: the validated refund body
+    :param oldTransaction: the transaction being refunded
+    :return: the body to send to the currency converter
+    """
+    return {"CurrencyFrom": data["CurrencyCode"], "CurrencyTo": oldTransaction.currency,
+            "Date": str(date.today()), "Amount": data["Amount"]}
+
+
+# builds the PNS body for a refund
+def refundPNSData(data, oldTransaction, entry):
+    """
+
+    :param data: the validated refund body
+    :param oldTransaction: the transaction being refunded
+    :param entry: the ledger entry claimed for the refund
+    :return: the body to send to the PNS
+    """
+    return {"TransactionUUID": data["TransactionUUID"],
+            "Amount": float(fromMinorUnits(entry.amount, oldTransaction.currency)),
+            "CurrencyCode": oldTransaction.currency,
+            }
+
+
+# stores a refund the PNS has accepted
+def storeRefund(oldTransaction, entry):
+    """
+
+    :param oldTransaction: the transaction that was refunded
+    :param entry: the ledger entry claimed for the refund
+    :return: an HTTP formatted response for the client
+    """
+
+    # store the refund in the database, linked to the transaction it refunds, and complete its ledger entry
+    started = timing.start()
     try:
-        refundedTransaction = Transaction()
-        refundedTransaction.id = None
-        refundedTransaction.payer = oldTransaction.payer
-        refundedTransaction.payee = oldTransaction.payee
-        refundedTransaction.amount = oldTransaction.amount
-        refundedTransaction.currency = oldTransaction.currency
-        refundedTransaction.date = datetime.now()
-        refundedTransaction.transactionStatus = "Refund"
-        refundedTransaction.save()
+        with atomic():
+            # of two refunds finishing at once, only the one that locks the payment second sees it fully refunded
+            Transaction.objects.select_for_update().filter(id=oldTransaction.id).values_list("id", flat=True).get()
+            refundedTransaction = Transaction()
+            refundedTransaction.id = -entry.id
+            refundedTransaction.payer_id = oldTransaction.payer_id
+            refundedTransaction.payee_id = oldTransaction.payee_id
+            refundedTransaction.amount = float(fromMinorUnits(entry.amount, oldTransaction.currency))
+            refundedTransaction.currency = oldTransaction.currency
+            refundedTransaction.date = timezone.now()
+            refundedTransaction.transactionStatus = TransactionStatus.REFUND
+            refundedTransaction.originalTransaction_id = oldTransaction.id
+            refundedTransaction.save(force_insert=True)
+            RefundEntry.objects.filter(id=entry.id).update(state=RefundState.COMPLETE, refund=refundedTransaction)
+
+            refunded = RefundEntry.objects.filter(payment_id=oldTransaction.id, state=RefundState.COMPLETE) \
+                .aggregate(total=Sum("amount"))["total"]
+            fullyRefunded = refunded >= toMinorUnits(oldTransaction.amount, oldTransaction.currency)
+            if fullyRefunded:
+                Transaction.objects.filter(id=oldTransaction.id, transactionStatus=TransactionStatus.COMPLETE) \
+                    .update(transactionStatus=TransactionStatus.REFUNDED)
+            # the payee's settlement totals change with each part refunded
+            recordRefund(oldTransaction, entry.amount, fullyRefunded)
     except Exception as e:
         return errorHandling(401, str(e))
+    finally:
+        timing.stop("save", started)
 
     # returning positive response
     responseData = {"ErrorCode": None,
@@ -279,38 +564,27 @@ def InitiateRefund(request):
     return JsonResponse(responseData, status=200)
 
 
-@csrf_exempt
-def InitiateCancellation(request):
-    # returns the data or error message and boolean indicating which that is
-    data, methodStatus = checkMethod(request)
-    print(data)
-    # data contains error message if the body wasn't in the correct format
-    if not methodStatus:
-        return data
-
-    correct_keys = {"TransactionUUID": str}
-
-    # stores None if formatted correctly, else returns an error message
-    bodyStatus = checkBody(data, correct_keys)
-    if bodyStatus is not None:
-        return bodyStatus
-
-    # check transaction exists
-    queriedTransactions = Transaction.objects.filter(id=data["TransactionUUID"]).all()
-
-    # if no corresponding account
-    if len(queriedTransactions) != 1:
-        return errorHandling(402, data["TransactionUUID"])
+# marks a complete transaction as cancelled
+def cancelTransaction(transactionId):
+    """
 
-    oldTransaction = queriedTransactions[0]
-    if oldTransaction.transactionStatus != "Complete":
-        return errorHandling(404)
+    :param transactionId: the ID of the transaction being cancelled
+    :return: an HTTP formatted response for the client
+    """
 
+    # check the transaction exists and is complete as part of the update itself
+    started = timing.start()
     try:
-        oldTransaction.transactionStatus = "Cancelled"
-        oldTransaction.save()
+        # a transaction with any part refunded, or being refunded, can't also be cancelled
+        cancelled = isTransactionId(transactionId) and transitionTransaction(
+            transactionId, TransactionStatus.COMPLETE, TransactionStatus.CANCELLED,
+            blockedBy=RefundEntry.objects.filter(payment_id=transactionId))
+        if not cancelled:
+            return transitionError(transactionId)
     except Exception as e:
         return errorHandling(401, str(e))
+    finally:
+        timing.stop("save", started)
 
     # returning positive response
     responseData = {"ErrorCode": None,
@@ -321,16 +595,26 @@ def InitiateCancellation(request):
 
 
 def ConvertCurrency(data):
-    data = json.dumps(data)
-    # post to currency converter API and get response
-    response = requests.post('http://samshepherd.eu.pythonanywhere.com/currency/convert/', data=data)
+    started = timing.start()
+
+    # convert locally if the rate is already known
+    response = cachedConversion(data)
+    if response is None:
+        # post to currency converter API and get response, conversions are safe to retry
+        response = http_client.post("CURRENCY", "convert/", idempotent=True, data=json.dumps(data))
+
+        # remember the rate for later conversions
+        rememberConversion(data, response)
 
+    timing.stop("currency", started)
     return response
 
 
 def RequestTransactionPNS(data):
-    # post to currency converter API and get response
-    response = requests.post('http://samshepherd.eu.pythonanywhere.com/pns/initiatetransactionpns/', data=data)
+    # post to the PNS and get response
+    started = timing.start()
+    response = http_client.post("PNS", "initiatetransactionpns/", data=data)
+    timing.stop("pns", started)
 
     # this will be changed once their API is up and running
     # content = response.content
@@ -340,8 +624,10 @@ def RequestTransactionPNS(data):
     return response
 
 def RequestRefundPNS(data):
-    # post to currency converter API and get response
-    response = requests.post('http://samshepherd.eu.pythonanywhere.com/pns/initiaterefundpns/', data=data)
+    # post to the PNS and get response
+    started = timing.start()
+    response = http_client.post("PNS", "initiaterefundpns/", data=data)
+    timing.stop("pns", started)
 
     # this will be changed once their API is up and running
     # content = response.content